@@ -3,7 +3,7 @@ from cryptofeed.connection import AsyncConnection, RestEndpoint, Routes, Websock
 from cryptofeed.defines import  L3_BOOK
 import time
 import hashlib
-import json
+from runtime import json
 import hmac 
 import base64
 # import logging
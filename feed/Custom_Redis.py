@@ -3,16 +3,34 @@ import sys
 import os
 from redis import asyncio as aioredis
 import asyncio
-from yapic import json
+from runtime import json
 import logging
 from cryptofeed.backends.backend import BackendBookCallback, BackendCallback, BackendQueue
 from cryptofeed.backends.redis import BookRedis, BookStream, CandlesRedis, FundingRedis, OpenInterestRedis, TradeRedis, BookSnapshotRedisKey, RedisZSetCallback, RedisCallback
+from batching import MicroBatchQueue
+from redis_codecs import get_codec
+from retry_buffer import RetryBuffer
 logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)s:%(levelname)s:%(message)s')
 #logger = logging.getLogger(__name__)
-class CustomRedisCallback(RedisCallback):
-    def __init__(self, host='127.0.0.1', port=6379, socket=None, key=None, none_to='None', numeric_type=float, score_key='timestamp', ttl=3600, ssl=True, decode_responses=True, password=None, **kwargs):
+
+# errors worth retrying after a reconnect: connection loss, timeouts, and a failed over primary turned read-only replica
+RETRYABLE_ERRORS = (aioredis.ConnectionError, aioredis.TimeoutError, aioredis.ReadOnlyError, OSError, asyncio.TimeoutError)
+
+class CustomRedisCallback(MicroBatchQueue, RedisCallback):
+    def __init__(self, host='127.0.0.1', port=6379, socket=None, key=None, none_to='None', numeric_type=float, score_key='timestamp', ttl=3600, ssl=True, decode_responses=True, password=None, codec='json',
+                 batch_max_rows=None, batch_max_bytes=None, batch_linger=0.0, batch_metrics_interval=60.0,
+                 socket_timeout=5.0, retry_backoff=0.5, retry_backoff_max=30.0, retry_buffer_rows=100000, overflow='drop-oldest', spill_path=None, **kwargs):
         """
         Custom Redis Callback with SSL and decode_responses support.
+        codec selects how updates are serialized (see redis_codecs): 'json' (default), 'msgpack', or 'struct'
+        for fixed-layout float64 price/size level arrays in book streams. Consumers decode with
+        redis_codecs.decode_stream_entry / decode_zset_member, reading with decode_responses=False for binary codecs.
+        Batches handed to the writer are bounded by batch_max_rows, batch_max_bytes and batch_linger (see MicroBatchQueue.init_batching).
+        The writer survives Redis outages: batches that fail with a connection error, a timeout (socket_timeout seconds)
+        or a READONLY reply are kept in a RetryBuffer of retry_buffer_rows rows and retried after reconnecting, with
+        exponential backoff from retry_backoff to retry_backoff_max seconds. The queue keeps being drained into the buffer
+        meanwhile, so memory stays bounded; on overflow the oldest rows are dropped ('drop-oldest') or written to
+        spill_path ('spill') and replayed once Redis is back, including by the next run after a restart.
         """
         prefix = 'rediss://' if ssl else 'redis://'
         if socket:
@@ -31,6 +49,12 @@ class CustomRedisCallback(RedisCallback):
         self.score_key = score_key
         self.ttl = ttl  # Add this line to store the TTL value
         self.conn = None  # Add this line
+        self.codec = get_codec(codec)
+        self.socket_timeout = socket_timeout
+        self.retry_backoff = retry_backoff
+        self.retry_backoff_max = retry_backoff_max
+        self.retry_buffer = RetryBuffer(max_rows=retry_buffer_rows, overflow=overflow, spill_path=spill_path)
+        self.init_batching(batch_max_rows=batch_max_rows, batch_max_bytes=batch_max_bytes, batch_linger=batch_linger, batch_metrics_interval=batch_metrics_interval)
     
     async def get_connection(self):
         if self.conn is None:
@@ -51,9 +75,18 @@ class CustomRedisCallback(RedisCallback):
                 ssl_keyfile=ssl_keyfile,
                 ssl_certfile=ssl_certfile,
                 ssl_ca_certs=ssl_ca_certs,
-                
+                socket_timeout=self.socket_timeout,
+                socket_connect_timeout=self.socket_timeout,
                 )
         return self.conn
+
+    async def reset_connection(self):
+        conn, self.conn = self.conn, None
+        if conn is not None:
+            try:
+                await conn.aclose()
+            except Exception as e:
+                logging.error(f"Error closing Redis connection: {e}")
     def __del__(self):
         # Cleanup code, if synchronous closing is possible
         if self.conn:
@@ -65,54 +98,120 @@ class CustomRedisCallback(RedisCallback):
         except Exception as e:
             logging.error(f"Error publishing message: {e}")
 
-        
-class CustomRedisZSetCallback(CustomRedisCallback):
-    def __init__(self, host='127.0.0.1', port=6379, socket=None, key=None, numeric_type=float, score_key='timestamp', ttl=3600, ssl=True, decode_responses=True, **kwargs):
+    async def write_batch(self, conn, updates: list):
+        raise NotImplementedError
+
+    async def deliver(self, updates: list) -> bool:
         """
-        Custom Redis ZSet Callback with SSL and decode_responses support.
+        Write one batch. Returns False when it should be retried, after dropping the connection.
+        Any other error is logged and the batch is given up, as a retry would fail the same way.
         """
-        super().__init__(host=host, port=port, socket=socket, key=key, numeric_type=numeric_type, score_key=score_key, decode_responses=decode_responses, **kwargs)
-        
-    async def writer(self):
-        # Modify the Redis connection to include decode_responses
-        #print("CustomRedisZSetCallback writer started")
         try:
             conn = await self.get_connection()
-            while self.running:
-                #print("Entering the async with self.read_queue() block")
+            await self.write_batch(conn, updates)
+        except RETRYABLE_ERRORS as e:
+            logging.error(f"Error writing to Redis: {e!r}")
+            await self.reset_connection()
+            return False
+        except Exception as e:
+            logging.error(f"Error executing pipeline: {e}")
+        return True
+
+    async def flush(self) -> bool:
+        # oldest rows first, in batches, so a long outage is replayed without one huge pipeline
+        while self.retry_buffer:
+            batch = self.retry_buffer.peek(self.batch_max_rows or 5000)
+            if not await self.deliver(batch):
+                return False
+            self.retry_buffer.commit(len(batch))
+        return True
+
+    async def writer(self):
+        loop = asyncio.get_running_loop()
+        delay = self.retry_backoff
+        retry_at = 0.0
+        while self.running:
+            if self.retry_buffer and self.queue.empty():
+                if retry_at > loop.time():
+                    await asyncio.sleep(min(retry_at - loop.time(), 1.0))
+                    continue
+            else:
                 async with self.read_queue() as updates:
-                    #print("Updates received, processing...")
-                    #if not updates:
-                        #print("No updates to process")
-                        #continue
-                    async with conn.pipeline(transaction=False) as pipe:
-                        for update in updates:
-                            try:
-                                #print(f"Processing update: {update}")
-                                key = f"{self.key}-{update['exchange']}-{update['symbol']}"
-                                score = update[self.score_key]
-                                value = json.dumps(update)
-                                #print(f"Adding to pipeline - Key: {key}, Score: {score}, Value: {value}")
-                                pipe.zadd(key, {value: score}, nx=True)
-                                # Set TTL for the key
-                                pipe.expire(key, self.ttl)
-                            except Exception as e:
-                                logging.error(f"Error processing update: {e}")
-                        #print("Executing pipeline")
-                        try:
-                            await pipe.execute()
-                            await self.publish_message(key, "NEWT")
-                            #print("Pipeline executed successfully")
-                        except Exception as e:
-                            logging.error(f"Error executing pipeline: {e}")
-            # await conn.aclose()
-            # await conn.connection_pool.disconnect()
-        except (aioredis.ConnectionError, aioredis.RedisError) as e:
-            # Handle connection error, possibly logging it
-            self.conn = None  # Reset connection
-            conn = await self.get_connection()  # Re-establish connection
-            # Retry Redis operations or handle the situation appropriately
+                    if not updates:
+                        continue
+                    if self.retry_buffer or retry_at > loop.time():
+                        # keep the arrival order behind what is already buffered
+                        self.retry_buffer.append(updates)
+                    elif not await self.deliver(updates):
+                        self.retry_buffer.append(updates)
+                        retry_at = loop.time() + delay
+                        logging.error(f"{self.__class__.__name__} {self.key}: Redis unavailable, retrying in {delay:.1f}s; {self.retry_buffer.stats()}")
+                        delay = min(delay * 2, self.retry_backoff_max)
+                        continue
+                if retry_at > loop.time() or not self.retry_buffer:
+                    continue
+            if await self.flush():
+                logging.info(f"{self.__class__.__name__} {self.key}: Redis writes resumed; {self.retry_buffer.stats()}")
+                delay = self.retry_backoff
+                retry_at = 0.0
+            else:
+                retry_at = loop.time() + delay
+                logging.error(f"{self.__class__.__name__} {self.key}: Redis unavailable, retrying in {delay:.1f}s; {self.retry_buffer.stats()}")
+                delay = min(delay * 2, self.retry_backoff_max)
+        # shutting down: one last attempt, spilled rows are picked up by the next run
+        if self.retry_buffer and not await self.flush():
+            if self.retry_buffer.overflow == 'spill':
+                self.retry_buffer.spill_pending()
+            logging.error(f"{self.__class__.__name__} {self.key}: stopped with undelivered rows; {self.retry_buffer.stats()}")
+
+        
+class CustomRedisZSetCallback(CustomRedisCallback):
+    def __init__(self, host='127.0.0.1', port=6379, socket=None, key=None, numeric_type=float, score_key='timestamp', ttl=3600, ssl=True, decode_responses=True, retention_seconds=None, retention_members=None, **kwargs):
+        """
+        Custom Redis ZSet Callback with SSL and decode_responses support.
+        retention_seconds: float
+            Rolling window: drop members scored more than this many seconds below the newest score of the key (ZREMRANGEBYSCORE).
+            Only meaningful when score_key holds a timestamp.
+        retention_members: int
+            Keep only the newest this many members of each key (ZREMRANGEBYRANK).
+        Trimming runs once per touched key in the same pipeline as the batch, so zset size and ZRANGE
+        latency stay bounded; the key TTL only clears keys of symbols that stop updating.
+        """
+        self.retention_seconds = retention_seconds
+        self.retention_members = retention_members
+        super().__init__(host=host, port=port, socket=socket, key=key, numeric_type=numeric_type, score_key=score_key, ttl=ttl, ssl=ssl, decode_responses=decode_responses, **kwargs)
+
+    def zset_key(self, update: dict) -> str:
+        return f"{self.key}-{update['exchange']}-{update['symbol']}"
 
+    def trim(self, pipe, key: str, score: float):
+        if self.retention_seconds:
+            pipe.zremrangebyscore(key, '-inf', f"({score - self.retention_seconds}")
+        if self.retention_members:
+            pipe.zremrangebyrank(key, 0, -self.retention_members - 1)
+        
+    async def write_batch(self, conn, updates: list):
+        async with conn.pipeline(transaction=False) as pipe:
+            # newest score per key touched by the batch
+            latest = {}
+            for update in updates:
+                try:
+                    #print(f"Processing update: {update}")
+                    key = self.zset_key(update)
+                    score = update[self.score_key]
+                    value = self.codec.dumps(update)
+                    #print(f"Adding to pipeline - Key: {key}, Score: {score}, Value: {value}")
+                    pipe.zadd(key, {value: score}, nx=True)
+                    latest[key] = max(score, latest.get(key, score))
+                except Exception as e:
+                    logging.error(f"Error processing update: {e}")
+            for touched_key, latest_score in latest.items():
+                self.trim(pipe, touched_key, latest_score)
+                # Set TTL for the key
+                pipe.expire(touched_key, self.ttl)
+                # one notification per key and batch, carrying the newest score
+                pipe.publish(touched_key, f"NEWT {latest_score}")
+            await pipe.execute()
 
 class CustomBookRedis(CustomRedisZSetCallback, BackendBookCallback):
     default_key = 'book'
@@ -126,6 +225,16 @@ class CustomBookRedis(CustomRedisZSetCallback, BackendBookCallback):
 class CustomTradeRedis(CustomRedisZSetCallback, BackendCallback):
     default_key = 'trades'
     logging.info("Initializing TradeRedis")
+
+class CustomBarRedis(CustomRedisZSetCallback, BackendCallback):
+    """
+    OHLCV bars built from trades by bars.BarBuilder, one zset per bar kind at bars-<bar>-<exchange>-<symbol>,
+    e.g. bars-1m-BINANCE-BTC-USDT, scored by the bar start time.
+    """
+    default_key = 'bars'
+
+    def zset_key(self, update: dict) -> str:
+        return f"{self.key}-{update['bar']}-{update['exchange']}-{update['symbol']}"
     
 class CustomFundingRedis(CustomRedisZSetCallback, BackendCallback):
     default_key = 'funding'
@@ -140,46 +249,138 @@ class CustomLiquidationsRedis(CustomRedisZSetCallback, BackendCallback):
     logging.info("Initializing LiquidationsRedis")
     
 class CustomRedisStreamCallback(CustomRedisCallback):
-    async def writer(self):
+    def __init__(self, *args, maxlen=None, minid_window=None, approximate=True, **kwargs):
+        """
+        maxlen: int
+            Trim each stream to about this many entries on every XADD (MAXLEN).
+        minid_window: float
+            Trim entries older than this many seconds on every XADD (MINID). Stream IDs are generated from the
+            Redis server clock, so the cutoff is taken from the newest entry ID already written to the key
+            rather than from the local receipt timestamps, which may be skewed from it. The first batch written
+            to a key is not trimmed. Ignored when maxlen is set.
+        approximate: bool
+            Use '~' trimming, which only drops whole radix tree nodes and is much cheaper than exact trimming.
+        The key TTL is still refreshed once per batch, so streams of symbols that stop updating expire.
+        """
+        self.maxlen = maxlen
+        self.minid_window = minid_window
+        self.approximate = approximate
+        # milliseconds part of the newest entry ID written to each key, on the Redis server clock
+        self.latest_ms = {}
+        super().__init__(*args, **kwargs)
+
+    def trim_args(self, key: str) -> dict:
+        if self.maxlen:
+            return {'maxlen': self.maxlen, 'approximate': self.approximate}
+        if self.minid_window and key in self.latest_ms:
+            return {'minid': self.latest_ms[key] - int(self.minid_window * 1000), 'approximate': self.approximate}
+        return {}
+
+    async def notify(self, conn, latest_ids: dict):
+        """
+        Publish one "NEWB <stream id>" per key touched by a batch, with the newest entry ID of that key.
+        The IDs are generated by Redis on XADD, so the notifications go out in a second pipeline right
+        after the batch: one extra round trip per batch rather than one per key.
+        """
+        if not latest_ids:
+            return
         try:
-            conn = await self.get_connection()
-            while self.running:
-                async with self.read_queue() as updates:
-                    async with conn.pipeline(transaction=False) as pipe:
-                        
-                        for update in updates:
-                            #logging.info("Book updates received, processing...")
-                            try:
-                                if 'delta' in update:
-                                    update['delta'] = json.dumps(update['delta'])
-                                    #logging.info(f"Processing delta for {update['exchange']}-{update['symbol']}")
-                                elif 'book' in update:
-                                    update['book'] = json.dumps(update['book'])
-                                    #logging.info(f"Processing full snapshot for {update['exchange']}-{update['symbol']}")
-                                elif 'closed' in update:
-                                    update['closed'] = str(update['closed'])
-                                # SET  <key> <value>    
-                                full_key = f"{self.key}-{update['exchange']}-{update['symbol']}"
-                                pipe = pipe.xadd(full_key, update)
-                                # Set TTL for the key
-                                pipe.expire(full_key, self.ttl)
-                            except Exception as e:
-                                logging.error(f"Error processing update: {e}")
-                                
-                        try:
-                            await pipe.execute()
-                            await self.publish_message(full_key, "NEWB")
-                        except Exception as e:
-                                logging.error(f"Error executing pipeline: {e}")
-
-            # await conn.aclose()
-            # await conn.connection_pool.disconnect()
-        except (aioredis.ConnectionError, aioredis.RedisError) as e:
-            # Handle connection error, possibly logging it
-            self.conn = None  # Reset connection
-            conn = await self.get_connection()  # Re-establish connection
-            # Retry Redis operations or handle the situation appropriately
-        
+            async with conn.pipeline(transaction=False) as pipe:
+                for touched_key, stream_id in latest_ids.items():
+                    stream_id = stream_id.decode() if isinstance(stream_id, bytes) else stream_id
+                    pipe.publish(touched_key, f"NEWB {stream_id}")
+                await pipe.execute()
+        except Exception as e:
+            logging.error(f"Error publishing message: {e}")
+
+    def encode(self, update: dict) -> dict:
+        """
+        The stream entry fields of one update, with the book or delta serialized by the codec.
+        Encodes a copy, as the update is written again as is if the batch has to be retried.
+        """
+        update = dict(update)
+        if 'delta' in update:
+            update['delta'] = self.codec.encode_book(update['delta'])
+        elif 'book' in update:
+            update['book'] = self.codec.encode_book(update['book'])
+        elif 'closed' in update:
+            update['closed'] = str(update['closed'])
+        if self.codec.name != 'json':
+            # lets consumers pick the decoder, see redis_codecs.decode_stream_entry
+            update['codec'] = self.codec.name
+        return update
+
+    def stream_key(self, update: dict) -> str:
+        return f"{self.key}-{update['exchange']}-{update['symbol']}"
+
+    async def write_batch(self, conn, updates: list):
+        async with conn.pipeline(transaction=False) as pipe:
+            # pipeline position of the last XADD of every key touched by the batch
+            touched = {}
+            for update in updates:
+                #logging.info("Book updates received, processing...")
+                try:
+                    update = self.encode(update)
+                    # SET  <key> <value>    
+                    full_key = self.stream_key(update)
+                    pipe = pipe.xadd(full_key, update, **self.trim_args(full_key))
+                    touched[full_key] = len(pipe) - 1
+                except Exception as e:
+                    logging.error(f"Error processing update: {e}")
+            for touched_key in touched:
+                # Set TTL for the key
+                pipe.expire(touched_key, self.ttl)
+            results = await pipe.execute()
+        latest_ids = {touched_key: results[position] for touched_key, position in touched.items()}
+        if self.minid_window:
+            for touched_key, stream_id in latest_ids.items():
+                stream_id = stream_id.decode() if isinstance(stream_id, bytes) else stream_id
+                self.latest_ms[touched_key] = int(stream_id.split('-')[0])
+        await self.notify(conn, latest_ids)
+
+class CustomNBBOStream(CustomRedisStreamCallback, BackendCallback):
+    """
+    Consolidated top of book written by nbbo.NBBOEngine, one stream per symbol at nbbo-<symbol>.
+    The cross-venue spreads are stored as a JSON object in the spreads field.
+    """
+    default_key = 'nbbo'
+
+    def stream_key(self, update: dict) -> str:
+        return f"{self.key}-{update['symbol']}"
+
+    def encode(self, update: dict) -> dict:
+        update = super().encode(update)
+        update['spreads'] = json.dumps(update['spreads'])
+        return update
+
+
+class CustomSpreadStream(CustomRedisStreamCallback, BackendCallback):
+    """
+    Spread statistics written by spreads.SpreadEngine, one stream per pair at spread-<pair name>.
+    Statistics that are not defined yet (z-scores before the window fills) are left out of the entry.
+    """
+    default_key = 'spread'
+
+    def stream_key(self, update: dict) -> str:
+        return f"{self.key}-{update['symbol']}"
+
+    def encode(self, update: dict) -> dict:
+        return {field: value for field, value in super().encode(update).items() if value is not None}
+
+
+class CustomHedgeStream(CustomSpreadStream):
+    """
+    Hedge ratios and rolling ADF statistics written by hedge.HedgeEngine, one stream per pair at hedge-<pair name>.
+    """
+    default_key = 'hedge'
+
+
+class CustomBasisStream(CustomSpreadStream):
+    """
+    Spot-perp basis and funding carry written by basis.BasisEngine, one stream per spot symbol at basis-<symbol>.
+    """
+    default_key = 'basis'
+
 
 class CustomBookStream(CustomRedisStreamCallback, BackendBookCallback):
     default_key = 'book'
@@ -188,4 +389,32 @@ class CustomBookStream(CustomRedisStreamCallback, BackendBookCallback):
         self.snapshot_interval = snapshot_interval
         self.snapshot_count = defaultdict(int)
         super().__init__(*args, **kwargs)
-        logging.info("Initializing BookStreamRedis")
\ No newline at end of file
+        logging.info("Initializing BookStreamRedis")
+
+class CustomBookSnapshotRedis(CustomRedisStreamCallback, BackendCallback):
+    """
+    Book keyframes written by snapshots.SnapshotService: one hash per (exchange, symbol) at
+    book-snap-<exchange>-<symbol>, replaced by every new snapshot. The hash holds the fields of a book
+    stream entry (book encoded by the codec, timestamps, and codec for binary codecs) plus stream_id,
+    the ID of the last book-<exchange>-<symbol> entry folded into the snapshot, so a reader applies the
+    snapshot and then only the stream entries after stream_id (see orderbook.load_book).
+    """
+    default_key = 'book-snap'
+
+    async def write_batch(self, conn, updates: list):
+        # only the newest snapshot of each key matters
+        latest = {}
+        for update in updates:
+            latest[f"{self.key}-{update['exchange']}-{update['symbol']}"] = update
+        async with conn.pipeline(transaction=True) as pipe:
+            for full_key, update in latest.items():
+                try:
+                    mapping = {field: value for field, value in self.encode(update).items() if value is not None}
+                    # a new snapshot replaces the whole hash, so no field of an older codec is left behind
+                    pipe.delete(full_key)
+                    pipe.hset(full_key, mapping=mapping)
+                    pipe.expire(full_key, self.ttl)
+                    pipe.publish(full_key, f"SNAP {update['stream_id']}")
+                except Exception as e:
+                    logging.error(f"Error processing update: {e}")
+            await pipe.execute()
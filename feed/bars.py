@@ -0,0 +1,285 @@
+from cryptofeed.backends.backend import BackendCallback
+import asyncio
+import logging
+import sys
+import time
+import numpy as np
+from Custom_Redis import CustomBarRedis
+from custom_timescaledb import BarsTimeScale
+from service import fan_out, redis_args
+logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)s:%(levelname)s:%(message)s')
+logger = logging.getLogger(__name__)
+
+# columns of the bar arrays, ordered so a trade updates contiguous slices
+START, OPEN, HIGH, LOW, END, RECEIPT, CLOSE, VOLUME, NOTIONAL, BUY_VOLUME, TRADES = range(11)
+FIELDS = 11
+# bar kinds, each closing on a different measure of the open bar
+TIME, VOLUME_BAR, DOLLAR_BAR = range(3)
+
+
+def bar_name(seconds: float) -> str:
+    """
+    Name of a time bar, e.g. 1s, 1m, 4h.
+    """
+    for unit, size in (('d', 86400), ('h', 3600), ('m', 60)):
+        if seconds >= size and seconds % size == 0:
+            return f"{int(seconds // size)}{unit}"
+    return f"{seconds:g}s"
+
+
+class BarBuilder(BackendCallback):
+    """
+    Streaming OHLCV bars built from trades, used as one more TRADES callback of a feed (or a drained backend in
+    a runner.py writer process). Every (exchange, symbol) gets a bar of each kind configured for it:
+        time bars of each of time_frames seconds, aligned to the epoch on the trade timestamps;
+        volume bars closing on the trade that brings the base volume to volume[symbol];
+        dollar bars closing on the trade that brings the notional to dollar[symbol].
+    volume and dollar map symbols to thresholds, with '*' as the default of unlisted symbols; a symbol with no
+    threshold gets no bar of that kind. Volume and dollar bars do not split the closing trade, so they overshoot
+    their threshold by at most one trade. Time bars close on the first trade of a later interval, or once the
+    interval is over by lateness seconds of wall clock; intervals without trades have no bar, and a trade
+    arriving after its interval was closed goes into the next bar.
+
+    The open bars live in one (bars, 11) float64 array, the bars of one symbol in consecutive rows so a trade
+    updates them all with a few vectorized operations on one slice. Closed bars are copied into a preallocated
+    (batch, 11) array and written to sinks batch at a time, when it is full or every flush_interval seconds,
+    as update dicts {'exchange', 'symbol', 'bar', 'timestamp' (bar start), 'receipt_timestamp' (of the last
+    trade), 'end' (timestamp of the last trade), 'open', 'high', 'low', 'close', 'volume', 'notional', 'vwap',
+    'buy_volume', 'trades'}. In the feed modules the sinks are CustomBarRedis and BarsTimeScale, see bar_builder.
+
+    sinks: list
+        Backends the bars are written to. They are started and stopped with the builder.
+    capacity: int
+        Initial number of open bar rows; the array doubles when more symbols show up.
+    """
+    def __init__(self, sinks: list = (), time_frames: tuple = (1, 60), volume: dict = None, dollar: dict = None, batch: int = 1000,
+                 flush_interval: float = 1.0, lateness: float = 2.0, capacity: int = 256):
+        self.sinks = list(sinks)
+        self.time_frames = tuple(float(frame) for frame in time_frames)
+        self.volume = volume or {}
+        self.dollar = dollar or {}
+        self.flush_interval = flush_interval
+        self.lateness = lateness
+        self.numeric_type = float
+        self.none_to = None
+        # open bars, and per row: kind, length in seconds or threshold, (volume, notional) closing it, earliest start of its next bar
+        self.bars = np.zeros((capacity, FIELDS))
+        self.kinds = np.zeros(capacity, dtype=np.int64)
+        self.sizes = np.zeros(capacity)
+        self.targets = np.full((capacity, 2), np.inf)
+        self.next_start = np.full(capacity, -np.inf)
+        self.names = []
+        self.keys = []
+        self.row_slots = []
+        self.rows = 0
+        # per (exchange, symbol) slot: its rows [lo, hi), which are time bars, the earliest end of its open
+        # time bars, and how many rows wait for a trade to open a bar
+        self.index = {}
+        self.spans = []
+        self.timed = []
+        self.deadlines = []
+        self.empty = []
+        # closed bars waiting to be written, with their rows
+        self.closed = np.zeros((batch, FIELDS))
+        self.closed_rows = np.zeros(batch, dtype=np.int64)
+        self.pending = 0
+        self.written = 0
+        self.task = None
+        self.started = False
+
+    def start(self, loop: asyncio.AbstractEventLoop, multiprocess: bool = False):
+        # cryptofeed's Feed.start passes multiprocess, runner.py's writer does not
+        if not self.started:
+            for sink in self.sinks:
+                sink.start(loop, multiprocess=multiprocess)
+            self.task = loop.create_task(self.ticker())
+            self.started = True
+
+    async def stop(self):
+        if self.started:
+            self.started = False
+            self.task.cancel()
+            await self.flush()
+            for sink in self.sinks:
+                await sink.stop()
+            logger.info(f"Bar builder wrote {self.written} bars, {int((self.bars[:self.rows, TRADES] > 0).sum())} open bars dropped")
+
+    def threshold(self, thresholds: dict, symbol: str):
+        return thresholds.get(symbol, thresholds.get('*'))
+
+    def add(self, exchange: str, symbol: str) -> int:
+        specs = [(TIME, frame, bar_name(frame)) for frame in self.time_frames]
+        volume, dollar = self.threshold(self.volume, symbol), self.threshold(self.dollar, symbol)
+        if volume:
+            specs.append((VOLUME_BAR, float(volume), f"v{volume:g}"))
+        if dollar:
+            specs.append((DOLLAR_BAR, float(dollar), f"d{dollar:g}"))
+        lo, hi = self.rows, self.rows + len(specs)
+        if hi > len(self.bars):
+            size = max(hi, 2 * len(self.bars))
+            self.bars = np.resize(self.bars, (size, FIELDS))
+            self.kinds = np.resize(self.kinds, size)
+            self.sizes = np.resize(self.sizes, size)
+            self.targets = np.resize(self.targets, (size, 2))
+            self.next_start = np.resize(self.next_start, size)
+        kinds = [kind for kind, _, _ in specs]
+        self.bars[lo:hi] = 0.0
+        self.kinds[lo:hi] = kinds
+        self.sizes[lo:hi] = [size for _, size, _ in specs]
+        # volume and notional that close the bar, infinite for the measure a kind does not close on
+        self.targets[lo:hi] = np.inf
+        self.targets[lo:hi, 0] = np.where(self.kinds[lo:hi] == VOLUME_BAR, self.sizes[lo:hi], np.inf)
+        self.targets[lo:hi, 1] = np.where(self.kinds[lo:hi] == DOLLAR_BAR, self.sizes[lo:hi], np.inf)
+        self.next_start[lo:hi] = -np.inf
+        self.names.extend(name for _, _, name in specs)
+        slot = len(self.spans)
+        self.keys.extend((exchange, symbol) for _ in specs)
+        self.row_slots.extend(slot for _ in specs)
+        self.spans.append((lo, hi))
+        self.timed.append(self.kinds[lo:hi] == TIME)
+        self.deadlines.append(np.inf)
+        self.empty.append(len(specs))
+        self.rows = hi
+        self.index[(exchange, symbol)] = slot
+        return slot
+
+    def update(self, exchange: str, symbol: str, price: float, amount: float, buy: bool, timestamp: float, receipt_timestamp: float):
+        """
+        Fold one trade into the open bars of its symbol, closing the ones it completes.
+        """
+        slot = self.index.get((exchange, symbol))
+        if slot is None:
+            slot = self.add(exchange, symbol)
+        lo, hi = self.spans[slot]
+        bars = self.bars[lo:hi]
+        if timestamp >= self.deadlines[slot]:
+            # time bars whose interval this trade is past
+            ended = self.timed[slot] & (bars[:, TRADES] > 0) & (timestamp >= bars[:, START] + self.sizes[lo:hi])
+            self.close(lo + np.flatnonzero(ended))
+        if self.empty[slot]:
+            self.open(slot, price, timestamp)
+        np.maximum(bars[:, HIGH], price, out=bars[:, HIGH])
+        np.minimum(bars[:, LOW], price, out=bars[:, LOW])
+        bars[:, END:VOLUME] = (timestamp, receipt_timestamp, price)
+        bars[:, VOLUME:] += (amount, price * amount, amount if buy else 0.0, 1.0)
+        done = bars[:, VOLUME:BUY_VOLUME] >= self.targets[lo:hi]
+        if done.any():
+            self.close(lo + np.flatnonzero(done.any(axis=1)))
+
+    def open(self, slot: int, price: float, timestamp: float):
+        """
+        Start a bar at the trade for every empty row of slot.
+        """
+        lo, hi = self.spans[slot]
+        bars, sizes, timed = self.bars[lo:hi], self.sizes[lo:hi], self.timed[slot]
+        empty = bars[:, TRADES] == 0
+        starts = np.where(timed, timestamp - timestamp % np.where(timed, sizes, 1.0), timestamp)
+        bars[empty, START] = np.maximum(starts, self.next_start[lo:hi])[empty]
+        bars[empty, OPEN:END] = price
+        self.empty[slot] = 0
+        if timed.any():
+            self.deadlines[slot] = float((bars[timed, START] + sizes[timed]).min())
+
+    def close(self, rows: np.ndarray):
+        """
+        Move the open bars of rows to the closed batch and reset them.
+        """
+        for row in rows.tolist():
+            if self.pending == len(self.closed):
+                # write() flushes a full batch; until then grow rather than lose bars
+                self.closed = np.resize(self.closed, (2 * len(self.closed), FIELDS))
+                self.closed_rows = np.resize(self.closed_rows, 2 * len(self.closed_rows))
+            self.closed[self.pending] = self.bars[row]
+            self.closed_rows[self.pending] = row
+            self.pending += 1
+            self.empty[self.row_slots[row]] += 1
+        timed = self.kinds[rows] == TIME
+        self.next_start[rows] = np.where(timed, self.bars[rows, START] + self.sizes[rows], self.bars[rows, START] + 1e-6)
+        self.bars[rows, VOLUME:] = 0.0
+
+    def close_elapsed(self, now: float):
+        """
+        Close the time bars whose interval ended more than lateness seconds before now.
+        """
+        bars = self.bars[:self.rows]
+        elapsed = (self.kinds[:self.rows] == TIME) & (bars[:, TRADES] > 0) & (bars[:, START] + self.sizes[:self.rows] + self.lateness <= now)
+        if elapsed.any():
+            self.close(np.flatnonzero(elapsed))
+
+    def drain(self) -> list:
+        """
+        The closed bars as update dicts, emptying the batch.
+        """
+        closed, rows = self.closed[:self.pending].tolist(), self.closed_rows[:self.pending].tolist()
+        self.pending = 0
+        updates = []
+        for bar, row in zip(closed, rows):
+            exchange, symbol = self.keys[row]
+            updates.append({
+                'exchange': exchange,
+                'symbol': symbol,
+                'bar': self.names[row],
+                'timestamp': bar[START],
+                'receipt_timestamp': bar[RECEIPT],
+                'end': bar[END],
+                'open': bar[OPEN],
+                'high': bar[HIGH],
+                'low': bar[LOW],
+                'close': bar[CLOSE],
+                'volume': bar[VOLUME],
+                'notional': bar[NOTIONAL],
+                'vwap': bar[NOTIONAL] / bar[VOLUME] if bar[VOLUME] else bar[CLOSE],
+                'buy_volume': bar[BUY_VOLUME],
+                'trades': int(bar[TRADES]),
+            })
+        return updates
+
+    async def flush(self):
+        updates = self.drain()
+        for update in updates:
+            await fan_out(self.sinks, update)
+        self.written += len(updates)
+
+    async def ticker(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                self.close_elapsed(time.time())
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing bars: {e}")
+
+    async def write(self, data: dict):
+        try:
+            self.update(data['exchange'], data['symbol'], float(data['price']), float(data['amount']), data['side'] == 'buy',
+                        data['timestamp'] or data['receipt_timestamp'], data['receipt_timestamp'])
+        except Exception as e:
+            logger.error(f"Error building bars of {data.get('exchange')} {data.get('symbol')}: {e}")
+            return
+        if self.pending >= len(self.closed):
+            await self.flush()
+
+
+def bar_builder(config: dict, postgres_cfg: dict) -> BarBuilder:
+    """
+    The BarBuilder the feed modules add to their TRADES callbacks, writing to the bars-<bar>-<exchange>-<symbol>
+    Redis zsets and the bars hypertable. postgres_cfg are the TimescaleDB arguments of the feed's other backends.
+    Config keys: bar_time_frames (seconds, default [1, 60]), bar_volume and bar_dollar (symbol to threshold, '*'
+    for every symbol, default none), bar_flush_interval (seconds, default 1), redis_bars_ttl (seconds, default
+    86400) and redis_bars_members (newest bars kept per zset, default all).
+    """
+    return BarBuilder(
+        sinks=[
+            CustomBarRedis(
+                **redis_args(config),
+                decode_responses=True,
+                ttl=config.get('redis_bars_ttl', 86400),
+                retention_members=config.get('redis_bars_members'),
+            ),
+            BarsTimeScale(**postgres_cfg),
+        ],
+        time_frames=config.get('bar_time_frames') or (1, 60),
+        volume=config.get('bar_volume'),
+        dollar=config.get('bar_dollar'),
+        flush_interval=config.get('bar_flush_interval', 1.0),
+    )
@@ -0,0 +1,151 @@
+import logging
+import sys
+import time
+from Custom_Redis import CustomBasisStream
+from custom_timescaledb import BasisTimeScale
+from redis_codecs import decode_zset_member
+from service import redis_args, run_service, timescale_args
+from spreads import PairEngine
+logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)s:%(levelname)s:%(message)s')
+logger = logging.getLogger(__name__)
+
+YEAR = 365 * 24 * 3600
+# Binance Futures settles funding every 8 hours unless a contract says otherwise
+FUNDING_INTERVAL = 8 * 3600
+
+
+class Funding:
+    """
+    The latest funding of one perpetual, as read from the funding zset written by CustomFundingRedis.
+    The funding interval is taken from how far next_funding_time moves when a funding period rolls over.
+    """
+    __slots__ = ('rate', 'next_funding_time', 'interval', 'timestamp')
+
+    def __init__(self, interval: float = FUNDING_INTERVAL):
+        self.rate = None
+        self.next_funding_time = None
+        self.interval = interval
+        self.timestamp = None
+
+    def update(self, funding: dict):
+        next_funding_time = funding.get('next_funding_time')
+        next_funding_time = float(next_funding_time) if next_funding_time not in (None, 'None') else None
+        if next_funding_time and self.next_funding_time and next_funding_time > self.next_funding_time:
+            self.interval = next_funding_time - self.next_funding_time
+        self.next_funding_time = next_funding_time
+        self.rate = float(funding['rate']) if funding.get('rate') not in (None, 'None') else None
+        self.timestamp = funding.get('timestamp')
+
+
+class BasisEngine(PairEngine):
+    """
+    Spot-perp basis and funding carry: each pair is (spot exchange, spot symbol, perp exchange, perp symbol),
+    joined on the mid prices of both books and the latest funding of the perpetual, read every funding_poll
+    seconds from the newest member of its funding-<exchange>-<symbol> zset.
+
+    On every mid price change of either leg:
+        basis = perp mid / spot mid - 1
+        annualized_basis = basis * YEAR / basis_horizon, the premium taken as converging over basis_horizon
+            seconds; None without a basis_horizon, as a perpetual has no expiry to converge at
+        annualized_funding = rate * YEAR / funding interval
+        carry = annualized_funding, the annualized return of holding long spot / short perp at the current
+            funding rate. The premium is what the funding pays down, so it is not added on top.
+    The state of a pair is a fixed set of scalars (mids, one Funding), so memory does not grow with time.
+
+    Each observation is written to sinks at most once per publish_interval seconds per pair, as an update dict
+    {'exchange': 'BASIS', 'symbol': spot symbol, 'timestamp', 'receipt_timestamp', 'spot', 'perp', 'basis',
+    'annualized_basis', 'funding_rate', 'annualized_funding', 'next_funding_time', 'carry'}, the funding fields
+    being None until the first funding is read. In main() the sinks are CustomBasisStream and BasisTimeScale.
+    See PairEngine for the other arguments.
+
+    funding_key: str
+        Key prefix of the funding zsets.
+    funding_codec: str
+        Codec of the funding zsets, see redis_codecs.decode_zset_member. The reader needs decode_responses=False
+        for a binary codec.
+    basis_horizon: float
+        Seconds over which the basis is annualized, see above.
+    """
+    def __init__(self, pairs: list, sinks: list, reader, funding_key: str = 'funding', funding_codec: str = 'json', funding_poll: float = 5.0,
+                 basis_horizon: float = None, **kwargs):
+        super().__init__(pairs, sinks, reader, **kwargs)
+        self.funding_keys = [f"{funding_key}-{b}-{sb}" for _, _, b, sb in self.pairs]
+        self.funding_codec = funding_codec
+        self.funding_poll = funding_poll
+        self.basis_horizon = basis_horizon
+        self.funding = [Funding() for _ in self.pairs]
+        self.polled = 0.0
+
+    async def refresh_funding(self, conn):
+        async with conn.pipeline(transaction=False) as pipe:
+            for key in self.funding_keys:
+                pipe.zrange(key, -1, -1)
+            results = await pipe.execute()
+        for funding, members in zip(self.funding, results):
+            if members:
+                try:
+                    funding.update(decode_zset_member(members[0], self.funding_codec))
+                except Exception as e:
+                    logger.error(f"Error decoding funding: {e}")
+
+    def update_pairs(self, indices: list, receipt_timestamp: float) -> list:
+        updates = []
+        for index in indices:
+            spot_stream, perp_stream = self.legs[index]
+            spot, perp = self.mids[spot_stream], self.mids[perp_stream]
+            self.observations += 1
+            if not self.due(index, receipt_timestamp):
+                continue
+            funding = self.funding[index]
+            basis = perp / spot - 1.0
+            annualized_funding = funding.rate * YEAR / funding.interval if funding.rate is not None else None
+            updates.append({
+                'exchange': 'BASIS',
+                'symbol': self.pairs[index][1],
+                'timestamp': receipt_timestamp,
+                'receipt_timestamp': receipt_timestamp,
+                'spot': spot,
+                'perp': perp,
+                'basis': basis,
+                'annualized_basis': basis * YEAR / self.basis_horizon if self.basis_horizon else None,
+                'funding_rate': funding.rate,
+                'annualized_funding': annualized_funding,
+                'next_funding_time': funding.next_funding_time,
+                'carry': annualized_funding,
+            })
+        return updates
+
+    async def follow(self, conn):
+        while self.running:
+            if time.time() - self.polled >= self.funding_poll:
+                await self.refresh_funding(conn)
+                self.polled = time.time()
+            await self.read(conn)
+
+
+def main():
+    """
+    Publish the basis and funding carry of every bn_symbols spot symbol whose perpetual is in bnf_symbols to the
+    basis-<symbol> Redis streams and the basis hypertable.
+    Config keys: basis_publish_interval (seconds, default 1), basis_funding_poll (seconds, default 5), basis_horizon
+    (seconds, no annualized basis by default) and redis_funding_codec (the codec the funding zsets are written with,
+    default json).
+    """
+    def build(config: dict):
+        perps = set(config.get('bnf_symbols') or [])
+        pairs = [('BINANCE', symbol, 'BINANCE_FUTURES', f"{symbol}-PERP") for symbol in config.get('bn_symbols') or [] if f"{symbol}-PERP" in perps]
+        if not pairs:
+            logger.error('No spot symbol with a perpetual configured, nothing to run')
+            return None
+        funding_codec = config.get('redis_funding_codec', 'json')
+        # the connection also reads the funding zsets
+        redis = CustomBasisStream(**redis_args(config), decode_responses=funding_codec == 'json', ttl=3600, maxlen=config.get('redis_basis_maxlen'))
+        timescale = BasisTimeScale(**timescale_args(config))
+        engine = BasisEngine(pairs, [redis, timescale], reader=redis, funding_codec=funding_codec, funding_poll=config.get('basis_funding_poll', 5.0),
+                             basis_horizon=config.get('basis_horizon'), publish_interval=config.get('basis_publish_interval', 1.0))
+        return engine, [redis, timescale]
+    run_service('basis engine', build)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+from contextlib import asynccontextmanager
+from collections import Counter
+import asyncio
+import logging
+import sys
+import time
+from cryptofeed.backends.backend import BackendQueue, SHUTDOWN_SENTINEL
+logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)s:%(levelname)s:%(message)s')
+
+
+def estimate_size(value) -> int:
+    """
+    Cheap approximation of the serialized size of an update in bytes, used for the max bytes bound.
+    Strings count their length, every other scalar counts 8 bytes.
+    """
+    if isinstance(value, str):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(estimate_size(k) + estimate_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(estimate_size(v) for v in value)
+    return 8
+
+
+class BatchStats:
+    """
+    Batch sizes actually achieved by a MicroBatchQueue, with the reason each batch was flushed:
+    'rows' and 'bytes' when a bound was hit, 'linger' when the linger time ran out, 'drain' when
+    the queue was empty and no linger was configured. Bytes are only estimated when a max bytes bound is set.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.batches = 0
+        self.rows = 0
+        self.bytes = 0
+        self.max_rows = 0
+        self.reasons = Counter()
+        # batch count per power of two bucket: bucket n holds batches of 2**(n-1) to 2**n - 1 rows
+        self.histogram = Counter()
+        self.since = time.time()
+
+    def record(self, rows: int, size: int, reason: str):
+        self.batches += 1
+        self.rows += rows
+        self.bytes += size
+        self.max_rows = max(self.max_rows, rows)
+        self.reasons[reason] += 1
+        self.histogram[rows.bit_length()] += 1
+
+    def summary(self) -> str:
+        mean = self.rows / self.batches if self.batches else 0
+        buckets = ', '.join(f"<{2 ** b}: {n}" for b, n in sorted(self.histogram.items()))
+        return (f"{self.batches} batches, {self.rows} rows in {time.time() - self.since:.0f}s, mean {mean:.1f} rows, "
+                f"max {self.max_rows} rows, {self.bytes} bytes, flushed on {dict(self.reasons)}, sizes {{{buckets}}}")
+
+
+class MicroBatchQueue(BackendQueue):
+    """
+    BackendQueue whose read_queue hands the writer batches bounded by row count, approximate size
+    and linger time, instead of whatever happens to be queued when the writer wakes up.
+    """
+    def init_batching(self, batch_max_rows: int = None, batch_max_bytes: int = None, batch_linger: float = 0.0, batch_metrics_interval: float = 60.0):
+        """
+        batch_max_rows: int
+            Flush once a batch holds this many updates. None means no row bound.
+        batch_max_bytes: int
+            Flush before a batch grows past this many bytes, as estimated by estimate_size. None means no size bound.
+        batch_linger: float
+            Seconds to wait for more updates after the first one of a batch arrives. 0 flushes as soon as the queue is empty.
+        batch_metrics_interval: float
+            Seconds between batch size reports in the log. None or 0 disables the reports; batch_stats is kept either way.
+        """
+        self.batch_max_rows = batch_max_rows
+        self.batch_max_bytes = batch_max_bytes
+        self.batch_linger = batch_linger
+        self.batch_metrics_interval = batch_metrics_interval
+        self.batch_stats = BatchStats()
+        self._carry = None
+
+    def _log_batch_stats(self):
+        if self.batch_metrics_interval and time.time() - self.batch_stats.since >= self.batch_metrics_interval:
+            logging.info(f"{self.__class__.__name__} {getattr(self, 'key', None) or getattr(self, 'table', '')} batching: {self.batch_stats.summary()}")
+            self.batch_stats.reset()
+
+    @asynccontextmanager
+    async def read_queue(self) -> list:
+        if self.multiprocess:
+            async with super().read_queue() as updates:
+                yield updates
+            return
+
+        batch = []
+        size = 0
+        count = 0
+        if self._carry is not None:
+            update, size = self._carry
+            self._carry = None
+            batch.append(update)
+        else:
+            update = await self.queue.get()
+            count += 1
+            if update == SHUTDOWN_SENTINEL:
+                self.running = False
+                yield []
+                self.queue.task_done()
+                return
+            batch.append(update)
+            if self.batch_max_bytes:
+                size = estimate_size(update)
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.batch_linger
+        reason = 'drain'
+        while True:
+            if self.batch_max_rows and len(batch) >= self.batch_max_rows:
+                reason = 'rows'
+                break
+            if self.batch_max_bytes and size >= self.batch_max_bytes:
+                reason = 'bytes'
+                break
+            if self.queue.empty():
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    reason = 'linger' if self.batch_linger else 'drain'
+                    break
+                try:
+                    update = await asyncio.wait_for(self.queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    reason = 'linger'
+                    break
+            else:
+                update = self.queue.get_nowait()
+            count += 1
+            if update == SHUTDOWN_SENTINEL:
+                self.running = False
+                break
+            update_size = estimate_size(update) if self.batch_max_bytes else 0
+            if self.batch_max_bytes and size + update_size > self.batch_max_bytes:
+                # keep the update for the next batch rather than overshoot the size bound
+                self._carry = (update, update_size)
+                reason = 'bytes'
+                break
+            batch.append(update)
+            size += update_size
+
+        yield batch
+
+        for _ in range(count):
+            self.queue.task_done()
+        self.batch_stats.record(len(batch), size, reason)
+        self._log_batch_stats()
@@ -12,7 +12,9 @@ import sys
 from datetime import datetime, timezone
 from redis import asyncio as aioredis
 from Custom_Redis import CustomBookRedis, CustomTradeRedis, CustomBookStream
-from custom_timescaledb import BookTimeScale, TradesTimeScale
+from custom_timescaledb import BookTimeScale, book_levels, TradesTimeScale
+from bars import bar_builder
+import runtime
 from statistics import mean
 logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)s:%(levelname)s:%(message)s')
 logger = logging.getLogger(__name__)
@@ -61,83 +63,123 @@ custom_columns_trades= {
     'price': 'price',            
     'id': 'id',                  # Maps Cryptofeed's 'id' field to the 'id' column in TimescaleDB
 }
-def main():
-    logger.info('Starting binance feed')
-    path_to_config = '/config_cf.yaml'
+def backends(fh: FeedHandler, channel: str, shard: str = 'binance') -> list:
+    """
+    The Redis and TimescaleDB callbacks storing channel. shard names the spill log directory, see add_feeds.
+    """
     snapshot_interval = 10000
     ttl=3600
-    try:
-        fh = FeedHandler(config=path_to_config)
-        postgres_cfg = {
-            'host': fh.config.config['pg_host'], 
-            'user': 'postgres', 
-            'db': 'db0', 
-            'pw': fh.config.config['timescaledb_password'], 
-            'port': '5432',
-                        }
-        
-        symbols = fh.config.config['bn_symbols']
-        pairs = Binance.symbols()[:]
-        [print(f"{symbol} is {'in' if symbol in pairs else 'not in'} symbols list") for symbol in symbols]
-        #symbols = ['BTC-USDT','ETH-BTC']
-        fh.run(start_loop=False)
+    postgres_cfg = {
+        'host': fh.config.config['pg_host'], 
+        'user': 'postgres', 
+        'db': 'db0', 
+        'pw': fh.config.config['timescaledb_password'], 
+        'port': '5432',
+        'write_mode': fh.config.config.get('timescaledb_write_mode', 'insert'),
+        'pool_size': fh.config.config.get('timescaledb_pool_size', 10),
+        'writers': fh.config.config.get('timescaledb_writers', 1),
+        # each process keeps its own spill log, see TimeScaleCallback spill_dir
+        'spill_dir': f"{fh.config.config['timescaledb_spill_dir']}/{shard}" if fh.config.config.get('timescaledb_spill_dir') else None,
+                    }
+    if channel == L2_BOOK:
+        return [
+            CustomBookStream(
+            host=fh.config.config['redis_host'], 
+            port=fh.config.config['redis_port'],
+            password=fh.config.config['redis_password'], 
+            snapshots_only=False,
+            ssl=True,
+            decode_responses=True,
+            snapshot_interval=snapshot_interval,
+            ttl=ttl,
+            maxlen=fh.config.config.get('redis_book_maxlen'),
+            minid_window=fh.config.config.get('redis_book_minid_window'),
+            #score_key='timestamp',
+                ),
+            BookTimeScale(
+                snapshots_only=False,
+                snapshot_interval=snapshot_interval,
+                #table='book',
+                custom_columns=custom_columns, 
+                **postgres_cfg
+                ),
+            # the same updates as typed level arrays when timescaledb_book_levels is set, see BookLevelsTimeScale
+            *book_levels(fh.config.config, postgres_cfg, snapshot_interval),
+        ]
+    if channel == TRADES:
+        return [
+            CustomTradeRedis(
+            host=fh.config.config['redis_host'], 
+            port=fh.config.config['redis_port'],
+            password=fh.config.config['redis_password'],
+            score_key='timestamp',
+            ssl=True,
+            decode_responses=True,
+            ttl=ttl,
+            # the trade zsets are bounded by retention rather than stream trimming
+            retention_seconds=fh.config.config.get('redis_trades_retention_seconds'),
+            retention_members=fh.config.config.get('redis_trades_retention_members'),
+                ),
+            TradesTimeScale(
+                custom_columns=custom_columns_trades,
+                #table='trades',
+                **postgres_cfg
+                ),
+            # OHLCV bars of the same trades, see bars.bar_builder
+            bar_builder(fh.config.config, postgres_cfg),
+        ]
+    return []
+
+
+def add_feeds(fh: FeedHandler, symbols: list, channels: tuple = (L2_BOOK, TRADES), shard: str = 'binance', sinks=None):
+    """
+    Add the Binance feeds of channels for symbols to fh, with their Redis and TimescaleDB callbacks.
+    main() adds every channel for every configured symbol; runner.py calls this once per shard of
+    (channels, symbols) in each worker process. shard names the spill log directory of the shard.
+    sinks(channel) returns the callbacks of a channel, backends(fh, channel, shard) by default; runner.py
+    replaces them with ring buffer producers when storage runs in separate writer processes.
+    """
+    if sinks is None:
+        sinks = lambda channel: backends(fh, channel, shard)
+    if L2_BOOK in channels:
         fh.add_feed(Binance(
                     max_depth=50,
                     subscription={
                         L2_BOOK: symbols,   
                     },
                     callbacks={
-                            L2_BOOK:[
-                                    CustomBookStream(
-                                    host=fh.config.config['redis_host'], 
-                                    port=fh.config.config['redis_port'],
-                                    password=fh.config.config['redis_password'], 
-                                    snapshots_only=False,
-                                    ssl=True,
-                                    decode_responses=True,
-                                    snapshot_interval=snapshot_interval,
-                                    ttl=ttl,
-                                    #score_key='timestamp',
-                                        ),
-                                    BookTimeScale(
-                                        snapshots_only=False,
-                                        snapshot_interval=snapshot_interval,
-                                        #table='book',
-                                        custom_columns=custom_columns, 
-                                        **postgres_cfg
-                                        )
-                            ]
+                            L2_BOOK: sinks(L2_BOOK)
                         },
                         cross_check=True,
                         )
                         )
+    if TRADES in channels:
         fh.add_feed(Binance(
                         subscription={
                             TRADES: symbols,
                         },
                         callbacks={
-                            TRADES:[ 
-                                    CustomTradeRedis(
-                                    host=fh.config.config['redis_host'], 
-                                    port=fh.config.config['redis_port'],
-                                    password=fh.config.config['redis_password'],
-                                    score_key='timestamp',
-                                    ssl=True,
-                                    decode_responses=True,
-                                    ttl=ttl,
-                                        ),
-                                    TradesTimeScale(
-                                        custom_columns=custom_columns_trades,
-                                        #table='trades',
-                                        **postgres_cfg
-                                        )
-                                    
-                            ]
+                            TRADES: sinks(TRADES)
                         },
                         #cross_check=True,
                         #timeout=-1
                         )
                         )
+
+
+def main():
+    logger.info('Starting binance feed')
+    path_to_config = '/config_cf.yaml'
+    try:
+        fh = FeedHandler(config=path_to_config)
+        runtime.setup()
+        
+        symbols = fh.config.config['bn_symbols']
+        pairs = Binance.symbols()[:]
+        [print(f"{symbol} is {'in' if symbol in pairs else 'not in'} symbols list") for symbol in symbols]
+        #symbols = ['BTC-USDT','ETH-BTC']
+        fh.run(start_loop=False)
+        add_feeds(fh, symbols)
         loop = asyncio.get_event_loop()
         # loop.create_task()
         loop.run_forever()
@@ -12,7 +12,9 @@ import logging
 from datetime import datetime
 import sys
 from Custom_Redis import CustomBookRedis, CustomTradeRedis, CustomBookStream
-from custom_timescaledb import BookTimeScale, TradesTimeScale
+from custom_timescaledb import BookTimeScale, book_levels, TradesTimeScale
+from bars import bar_builder
+import runtime
 logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)s:%(levelname)s:%(message)s')
 logger = logging.getLogger(__name__)
 async def trade(t, receipt_timestamp):
@@ -64,81 +66,121 @@ custom_columns_trades= {
     'price': 'price',            
     'id': 'id',                  # Maps Cryptofeed's 'id' field to the 'id' column in TimescaleDB
 }
-def main():
-    logger.info('Starting bitfinex feed')
-    path_to_config = '/config_cf.yaml'
+def backends(fh: FeedHandler, channel: str, shard: str = 'bitfinex') -> list:
+    """
+    The Redis and TimescaleDB callbacks storing channel. shard names the spill log directory, see add_feeds.
+    """
     snapshot_interval = 10000
     ttl = 3600
-    try:
-        fh = FeedHandler(config=path_to_config)  
-        postgres_cfg = {
-            'host': fh.config.config['pg_host'],
-            'user': 'postgres', 
-            'db': 'db0', 
-            'pw': fh.config.config['timescaledb_password'], 
-            'port': '5432',
-                        }
-        symbols = fh.config.config['bf_symbols']
-        pairs = Bitfinex.symbols()[:]
-        [print(f"{symbol} is {'in' if symbol in pairs else 'not in'} symbols list") for symbol in symbols]
-        fh.run(start_loop=False)
+    postgres_cfg = {
+        'host': fh.config.config['pg_host'],
+        'user': 'postgres', 
+        'db': 'db0', 
+        'pw': fh.config.config['timescaledb_password'], 
+        'port': '5432',
+        'write_mode': fh.config.config.get('timescaledb_write_mode', 'insert'),
+        'pool_size': fh.config.config.get('timescaledb_pool_size', 10),
+        'writers': fh.config.config.get('timescaledb_writers', 1),
+        # each process keeps its own spill log, see TimeScaleCallback spill_dir
+        'spill_dir': f"{fh.config.config['timescaledb_spill_dir']}/{shard}" if fh.config.config.get('timescaledb_spill_dir') else None,
+                    }
+    if channel == L3_BOOK:
+        return [
+            CustomBookStream(
+            host=fh.config.config['redis_host'], 
+            port=fh.config.config['redis_port'],
+            password=fh.config.config['redis_password'], 
+            snapshots_only=False,
+            ssl=True,
+            decode_responses=True,
+            snapshot_interval=snapshot_interval,
+            ttl=ttl,
+            maxlen=fh.config.config.get('redis_book_maxlen'),
+            minid_window=fh.config.config.get('redis_book_minid_window'),
+            #score_key='timestamp',
+                ),
+            BookTimeScale(
+                snapshots_only=False,
+                snapshot_interval=snapshot_interval,
+                #table='book',
+                custom_columns=custom_columns, 
+                **postgres_cfg
+                ),
+            # the same updates as typed level arrays when timescaledb_book_levels is set, see BookLevelsTimeScale
+            *book_levels(fh.config.config, postgres_cfg, snapshot_interval),
+        ]
+    if channel == TRADES:
+        return [
+            CustomTradeRedis(
+            host=fh.config.config['redis_host'], 
+            port=fh.config.config['redis_port'],
+            password=fh.config.config['redis_password'],
+            score_key='timestamp',
+            ssl=True,
+            decode_responses=True,
+            ttl=ttl,
+            # the trade zsets are bounded by retention rather than stream trimming
+            retention_seconds=fh.config.config.get('redis_trades_retention_seconds'),
+            retention_members=fh.config.config.get('redis_trades_retention_members'),
+                ),
+            TradesTimeScale(
+                custom_columns=custom_columns_trades,
+                #table='trades',
+                **postgres_cfg
+                ),
+            # OHLCV bars of the same trades, see bars.bar_builder
+            bar_builder(fh.config.config, postgres_cfg),
+        ]
+    return []
+
+
+def add_feeds(fh: FeedHandler, symbols: list, channels: tuple = (L3_BOOK, TRADES), shard: str = 'bitfinex', sinks=None):
+    """
+    Add the Bitfinex feeds of channels for symbols to fh, with their Redis and TimescaleDB callbacks.
+    main() adds every channel for every configured symbol; runner.py calls this once per shard of
+    (channels, symbols) in each worker process. shard names the spill log directory of the shard.
+    sinks(channel) returns the callbacks of a channel, backends(fh, channel, shard) by default; runner.py
+    replaces them with ring buffer producers when storage runs in separate writer processes.
+    """
+    if sinks is None:
+        sinks = lambda channel: backends(fh, channel, shard)
+    if L3_BOOK in channels:
         fh.add_feed(BITFINEX,
                         max_depth=50,
                         subscription={
                             L3_BOOK: symbols, 
                         },
                         callbacks={
-                            L3_BOOK:[
-                                    CustomBookStream(
-                                    host=fh.config.config['redis_host'], 
-                                    port=fh.config.config['redis_port'],
-                                    password=fh.config.config['redis_password'], 
-                                    snapshots_only=False,
-                                    ssl=True,
-                                    decode_responses=True,
-                                    snapshot_interval=snapshot_interval,
-                                    ttl=ttl,
-                                    #score_key='timestamp',
-                                        ),
-                                    BookTimeScale(
-                                        snapshots_only=False,
-                                        snapshot_interval=snapshot_interval,
-                                        #table='book',
-                                        custom_columns=custom_columns, 
-                                        **postgres_cfg
-                                        )
-                            ]
+                            L3_BOOK: sinks(L3_BOOK)
                         },
                         cross_check=True,
                         )
                         
+    if TRADES in channels:
         fh.add_feed(Bitfinex(
                         subscription={
                             TRADES: symbols,
                         },
                         callbacks={
-                            TRADES:[ 
-                                    CustomTradeRedis(
-                                    host=fh.config.config['redis_host'], 
-                                    port=fh.config.config['redis_port'],
-                                    password=fh.config.config['redis_password'],
-                                    score_key='timestamp',
-                                    ssl=True,
-                                    decode_responses=True,
-                                    ttl=ttl,
-                                        ),
-                                    TradesTimeScale(
-                                        custom_columns=custom_columns_trades,
-                                        #table='trades',
-                                        **postgres_cfg
-                                        )
-                                    
-                            ]
+                            TRADES: sinks(TRADES)
                         },
                         #cross_check=True,
                         #timeout=-1
                         )
                         )
+
+
+def main():
+    logger.info('Starting bitfinex feed')
+    path_to_config = '/config_cf.yaml'
+    try:
+        fh = FeedHandler(config=path_to_config)
+        runtime.setup()
+        symbols = fh.config.config['bf_symbols']
+        pairs = Bitfinex.symbols()[:]
+        [print(f"{symbol} is {'in' if symbol in pairs else 'not in'} symbols list") for symbol in symbols]
+        fh.run(start_loop=False)
+        add_feeds(fh, symbols)
         loop = asyncio.get_event_loop()
         # loop.create_task()
         loop.run_forever()
@@ -0,0 +1,182 @@
+from cryptofeed import FeedHandler
+from cryptofeed.config import Config
+import base64
+import gzip
+import importlib
+import logging
+import os
+import sys
+import time
+import runtime
+from runtime import json
+logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)s:%(levelname)s:%(message)s')
+logger = logging.getLogger(__name__)
+
+PATH_TO_CONFIG = '/config_cf.yaml'
+
+
+def feed_key(feed) -> str:
+    """
+    Identifies a feed across a capture and its replay: exchange, channels and symbols.
+    """
+    return f"{feed.id} " + json.dumps({channel: sorted(symbols) for channel, symbols in sorted(feed._feed_config.items())})
+
+
+class Recorder:
+    """
+    Raw data collection callback for FeedHandler(raw_data_collection=...), like cryptofeed's AsyncFileCallback:
+    records every message a feed receives, every request it sends and every REST response it reads, but as
+    gzipped JSON lines in a single file for all connections, with what is needed to replay them (see
+    tests/replay_harness.py).
+
+    Each line is one record {"t": receipt time, "kind": ..., "conn": connection id, "addr": ..., "data": ...}
+    where kind is 'recv' (websocket message), 'http' (REST response read from addr), 'send', 'connect',
+    or one of the metadata kinds written by track(): 'feed' (how to rebuild the feed) and 'conn' (which
+    feed a connection belongs to). Binary messages are base64 encoded with "encoding": "base64".
+    A new file is started every rotate_seconds; lines are buffered and written flush_lines at a time
+    or at least every flush_interval seconds.
+    """
+    def __init__(self, directory: str, prefix: str = 'capture', rotate_seconds: float = 3600, flush_lines: int = 1000, flush_interval: float = 1.0, compresslevel: int = 1):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.prefix = prefix
+        self.rotate_seconds = rotate_seconds
+        self.flush_lines = flush_lines
+        self.flush_interval = flush_interval
+        self.compresslevel = compresslevel
+        self.buffer = []
+        self.meta = []
+        self.file = None
+        self.opened = 0.0
+        self.flushed = time.time()
+        self.records = 0
+
+    def _open(self, now: float):
+        if self.file is not None:
+            self.file.close()
+        path = os.path.join(self.directory, f"{self.prefix}-{time.strftime('%Y%m%dT%H%M%S', time.gmtime(now))}.jsonl.gz")
+        self.file = gzip.open(path, 'at', compresslevel=self.compresslevel)
+        self.opened = now
+        # every file starts with the feed and connection metadata, so it can be replayed on its own
+        self.file.writelines(self.meta)
+        logger.info(f"Capturing raw feed data to {path}")
+
+    def flush(self):
+        now = time.time()
+        if self.file is None or now - self.opened >= self.rotate_seconds:
+            self._open(now)
+        self.file.writelines(self.buffer)
+        self.buffer = []
+        self.flushed = now
+
+    def record(self, record: dict, meta: bool = False):
+        line = json.dumps(record) + '\n'
+        self.records += 1
+        if meta:
+            self.meta.append(line)
+            if self.file is None:
+                # written at the start of the first file
+                return
+        self.buffer.append(line)
+        if len(self.buffer) >= self.flush_lines or record['t'] - self.flushed >= self.flush_interval:
+            self.flush()
+
+    def sync_callback(self, data, timestamp: float, conn_id: str, endpoint: str = None, send: str = None, connect: str = None, header: dict = None):
+        if connect:
+            record = {'t': timestamp, 'kind': 'connect', 'conn': conn_id, 'addr': connect}
+        else:
+            record = {'t': timestamp, 'kind': 'send' if send else 'http' if endpoint else 'recv', 'conn': conn_id, 'addr': send or endpoint}
+            if isinstance(data, bytes):
+                record['data'] = base64.b64encode(data).decode()
+                record['encoding'] = 'base64'
+            else:
+                record['data'] = data
+            if header:
+                record['header'] = header
+        self.record(record)
+
+    async def __call__(self, data, timestamp: float, conn_id: str, **kwargs):
+        self.sync_callback(data, timestamp, conn_id, **kwargs)
+
+    def write_header(self, feed_id: str, config: str):
+        # called by FeedHandler.add_feed; track() writes the richer 'feed' record
+        pass
+
+    def track(self, feed, module: str):
+        """
+        Record how to rebuild feed, added by module.add_feeds, and which feed each of its connections belongs to.
+        Call before the feed is started.
+        """
+        key = feed_key(feed)
+        self.record({'t': time.time(), 'kind': 'feed', 'key': key, 'module': module, 'channels': list(feed._feed_config),
+                     'symbols': sorted({symbol for symbols in feed._feed_config.values() for symbol in symbols})}, meta=True)
+        connect = feed.connect
+
+        def tracked():
+            connections = connect()
+            for conn, *_ in connections:
+                subscription = {channel: list(symbols) for channel, symbols in (getattr(conn, 'subscription', None) or {}).items()}
+                self.record({'t': time.time(), 'kind': 'conn', 'conn': conn.id, 'key': key, 'subscription': subscription}, meta=True)
+            return connections
+        feed.connect = tracked
+
+    def stop(self):
+        if self.buffer or self.file is None:
+            self.flush()
+        self.file.close()
+        self.file = None
+        logger.info(f"Captured {self.records} records to {self.directory}")
+
+
+def read_capture(paths: list):
+    """
+    Records of capture files in the order they were written, decoding base64 messages.
+    Metadata repeated at the start of every file is only returned once.
+    """
+    seen = set()
+    for path in sorted(paths):
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt') as f:
+            for line in f:
+                record = json.loads(line)
+                if record['kind'] in ('feed', 'conn'):
+                    if line in seen:
+                        continue
+                    seen.add(line)
+                if record.get('encoding') == 'base64':
+                    record['data'] = base64.b64decode(record['data'])
+                yield record
+
+
+def main():
+    """
+    Record the raw messages of the feeds runner.py would run, without storing anything.
+    Config keys: capture_dir (default ./captures), capture_exchanges (default all), capture_rotate_seconds.
+    """
+    from runner import EXCHANGES
+    logger.info('Starting raw feed capture')
+    recorder = None
+    try:
+        config = Config(config=PATH_TO_CONFIG).config
+        recorder = Recorder(config.get('capture_dir', 'captures'), rotate_seconds=config.get('capture_rotate_seconds', 3600))
+        fh = FeedHandler(config=PATH_TO_CONFIG, raw_data_collection=recorder)
+        runtime.setup()
+        exchanges = config.get('capture_exchanges') or list(EXCHANGES)
+        for exchange in exchanges:
+            key, groups = EXCHANGES[exchange]
+            symbols = config.get(key) or []
+            module = importlib.import_module(exchange)
+            for channels in groups:
+                added = len(fh.feeds)
+                module.add_feeds(fh, symbols, channels=channels, shard=exchange, sinks=lambda channel: [])
+                for feed in fh.feeds[added:]:
+                    recorder.track(feed, exchange)
+        fh.run()
+    except Exception as e:
+        logger.error(f"An error occurred: {e}")
+        if recorder is not None and recorder.buffer:
+            recorder.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -11,6 +11,7 @@ from decimal import Decimal
 import asyncio
 import logging
 from Custom_Coinbase import CustomCoinbase
+import runtime
 import sys
 logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)s:%(levelname)s:%(message)s')
 logger = logging.getLogger(__name__)
@@ -38,6 +39,7 @@ def main():
     
     path_to_config = '/config_cf.yaml'
     fh = FeedHandler(config=path_to_config)
+    runtime.setup()
     #symbols = fh.config.config['cb_symbols']
     symbols = ['BTC-USDT','ETH-BTC']
     fh.run(start_loop=False)
@@ -0,0 +1,271 @@
+from datetime import datetime as dt, timezone
+from itertools import repeat
+import operator
+import struct
+import numpy as np
+from runtime import json
+
+# Batch-at-once formatting for the TimescaleDB backends: a batch of updates is turned into one array per
+# column in a single pass (datetime64 timestamps, float64 / int64 numbers, categorical codes for the few
+# distinct exchanges, symbols and sides), and the arrays are written straight into PostgreSQL's binary COPY
+# format with vectorized scatters, so no per-row tuple, datetime or dict is built in Python.
+
+# PostgreSQL binary COPY framing, see https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4
+COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+COPY_TRAILER = struct.pack('!h', -1)
+# postgres timestamps count microseconds from 2000-01-01 UTC
+PG_EPOCH_US = 946684800 * 1000000
+
+# column kind of each supported postgres type (without modifiers); fixed width kinds map to their wire dtype
+COLUMN_KINDS = {
+    'double precision': 'float8',
+    'real': 'float4',
+    'bigint': 'int8',
+    'integer': 'int4',
+    'smallint': 'int2',
+    'boolean': 'bool',
+    'timestamp with time zone': 'timestamp',
+    'timestamp without time zone': 'timestamp',
+    'text': 'text',
+    'character varying': 'text',
+    'character': 'text',
+    'json': 'json',
+    'jsonb': 'jsonb',
+}
+WIRE_DTYPES = {'float8': '>f8', 'float4': '>f4', 'int8': '>i8', 'int4': '>i4', 'int2': '>i2', 'bool': '?', 'timestamp': '>i8'}
+ARRAY_DTYPES = {'float8': np.float64, 'float4': np.float32, 'int8': np.int64, 'int4': np.int32, 'int2': np.int16, 'bool': np.bool_}
+
+# text fields with a handful of distinct values per batch, encoded once per category instead of once per row
+CATEGORICAL_FIELDS = frozenset(('exchange', 'symbol', 'side', 'update_type', 'type', 'status'))
+# fields taken from the row tuple rather than the update dict
+ROW_FIELDS = {'exchange': 0, 'symbol': 1, 'timestamp': 2, 'receipt': 3}
+
+
+def column_kind(pg_type: str) -> str:
+    """
+    The column kind ColumnBatch uses for a postgres column type, or a ValueError when it cannot be
+    written by the columnar path (numeric and array columns need the record based COPY).
+    """
+    if pg_type not in COLUMN_KINDS:
+        raise ValueError(f"Columnar writes do not support {pg_type} columns")
+    return COLUMN_KINDS[pg_type]
+
+
+def _exclusive_cumsum(lengths: np.ndarray) -> np.ndarray:
+    starts = np.zeros(len(lengths), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=starts[1:])
+    return starts
+
+
+def _epoch_seconds(value) -> float:
+    # naive datetimes are UTC, as written by TimeScaleCallback.writer in the other write modes
+    if isinstance(value, dt):
+        return (value if value.tzinfo else value.replace(tzinfo=timezone.utc)).timestamp()
+    return float(value)
+
+
+def _text(value) -> str:
+    return value if isinstance(value, str) else str(value)
+
+
+def _json(value) -> str:
+    return value if isinstance(value, str) else json.dumps(value)
+
+
+class Column:
+    """
+    One column of a ColumnBatch.
+
+    kind: str
+        One of the COLUMN_KINDS values.
+    values:
+        float / int / bool kinds: a numpy array of the column dtype.
+        timestamp: a datetime64[us] array, NaT for NULL.
+        category: int32 codes into categories, -1 for NULL.
+        text / json / jsonb: a list of str, None for NULL.
+    nulls: np.ndarray
+        True where the value is NULL.
+    categories: list
+        The distinct values of a categorical column, in order of first appearance.
+    """
+    __slots__ = ('kind', 'values', 'nulls', 'categories')
+
+    def __init__(self, kind: str, values, nulls: np.ndarray, categories: list = None):
+        self.kind = kind
+        self.values = values
+        self.nulls = nulls
+        self.categories = categories
+
+    @classmethod
+    def build(cls, kind: str, values: list, categorical: bool = False):
+        """
+        Convert the python values of one column, None meaning NULL.
+        """
+        count = len(values)
+        if categorical and kind in ('text', 'json', 'jsonb'):
+            distinct = [v for v in dict.fromkeys(values) if v is not None]
+            codes = dict(zip(distinct, range(len(distinct))))
+            codes[None] = -1
+            codes = np.fromiter(map(codes.__getitem__, values), dtype=np.int32, count=count)
+            return cls(kind, codes, codes < 0, [_text(v) if kind == 'text' else _json(v) for v in distinct])
+        if None in values:
+            nulls = np.fromiter(map(operator.is_, values, repeat(None)), dtype=bool, count=count)
+        else:
+            nulls = np.zeros(count, dtype=bool)
+        if kind in ('text', 'json', 'jsonb'):
+            convert = _text if kind == 'text' else _json
+            return cls(kind, [None if v is None else convert(v) for v in values], nulls)
+        if nulls.any():
+            values = [0 if v is None else v for v in values]
+        if kind == 'timestamp':
+            try:
+                seconds = np.array(values, dtype=np.float64)
+            except TypeError:
+                seconds = np.fromiter((_epoch_seconds(v) for v in values), dtype=np.float64, count=count)
+            # rounded like datetime.fromtimestamp: whole seconds, plus the fraction rounded to microseconds
+            whole = np.floor(seconds)
+            array = (whole.astype(np.int64) * 1000000 + np.rint((seconds - whole) * 1e6).astype(np.int64)).view('datetime64[us]')
+            array[nulls] = np.datetime64('NaT', 'us')
+            return cls(kind, array, nulls)
+        try:
+            array = np.array(values, dtype=ARRAY_DTYPES[kind])
+        except (TypeError, ValueError):
+            # numeric strings such as trade ids, Decimals
+            array = np.array(values, dtype=object).astype(ARRAY_DTYPES[kind])
+        return cls(kind, array, nulls)
+
+    def wire(self) -> np.ndarray:
+        """
+        Fixed width kinds: the values as big-endian bytes, one row of itemsize bytes per value.
+        """
+        if self.kind == 'timestamp':
+            values = self.values.view(np.int64) - PG_EPOCH_US
+        else:
+            values = self.values
+        wire = np.ascontiguousarray(values, dtype=WIRE_DTYPES[self.kind])
+        return wire.view(np.uint8).reshape(len(wire), wire.dtype.itemsize)
+
+    def to_list(self) -> list:
+        """
+        The values as a python list for an array parameter, None for NULL. Timestamps are integer
+        microseconds since the unix epoch.
+        """
+        if self.categories is not None:
+            # code -1 picks the trailing None
+            return np.array(self.categories + [None], dtype=object)[self.values].tolist()
+        if self.kind in ('text', 'json', 'jsonb'):
+            return self.values
+        values = (self.values.view(np.int64) if self.kind == 'timestamp' else self.values).tolist()
+        if self.nulls.any():
+            values = [None if null else v for v, null in zip(values, self.nulls.tolist())]
+        return values
+
+    def payload(self):
+        """
+        Variable width kinds: (flat bytes, start of each row's bytes, byte length of each row or -1 for NULL).
+        """
+        prefix = b'\x01' if self.kind == 'jsonb' else b''
+        if self.categories is not None:
+            codes = self.values.astype(np.int64)
+            if not self.categories:
+                # every row is NULL
+                return b'', codes, codes
+            encoded = [prefix + c.encode() for c in self.categories]
+            lengths = np.fromiter((len(e) for e in encoded), dtype=np.int64, count=len(encoded))
+            codes[self.nulls] = 0
+            return b''.join(encoded), _exclusive_cumsum(lengths)[codes], np.where(self.nulls, -1, lengths[codes])
+        encoded = [b'' if v is None else prefix + v.encode() for v in self.values]
+        lengths = np.fromiter((len(e) for e in encoded), dtype=np.int64, count=len(encoded))
+        return b''.join(encoded), _exclusive_cumsum(lengths), np.where(self.nulls, -1, lengths)
+
+
+def _scatter_fixed(buffer: np.ndarray, offsets: np.ndarray, rows: np.ndarray):
+    # rows[i] (itemsize bytes) is written at buffer[offsets[i]:]
+    buffer[offsets[:, None] + np.arange(rows.shape[1])] = rows
+
+
+def _scatter_ragged(buffer: np.ndarray, offsets: np.ndarray, source: np.ndarray, starts: np.ndarray, lengths: np.ndarray):
+    # source[starts[i]:starts[i] + lengths[i]] is written at buffer[offsets[i]:]
+    total = int(lengths.sum())
+    if total == 0:
+        return
+    within = np.arange(total) - np.repeat(_exclusive_cumsum(lengths), lengths)
+    buffer[np.repeat(offsets, lengths) + within] = source[np.repeat(starts, lengths) + within]
+
+
+class ColumnBatch:
+    """
+    A batch of updates as one Column per table column, built in one pass by from_rows.
+    """
+    def __init__(self, columns: list, length: int):
+        self.columns = columns
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    @classmethod
+    def from_rows(cls, rows: list, fields: list, kinds: list):
+        """
+        rows: list
+            (exchange, symbol, timestamp, receipt, update) tuples, as built by TimeScaleCallback.writer.
+            Timestamps are epoch seconds or datetimes.
+        fields: list
+            The update field of each column, as in TimeScaleCallback.copy_fields.
+        kinds: list
+            The column kind of each column, see column_kind.
+        """
+        columns = []
+        updates = None
+        for field, kind in zip(fields, kinds):
+            if field in ROW_FIELDS:
+                values = list(map(operator.itemgetter(ROW_FIELDS[field]), rows))
+            else:
+                if updates is None:
+                    updates = list(map(operator.itemgetter(4), rows))
+                values = list(map(operator.methodcaller('get', field), updates))
+            columns.append(Column.build(kind, values, categorical=field in CATEGORICAL_FIELDS))
+        return cls(columns, len(rows))
+
+    def to_arrays(self) -> list:
+        """
+        One python list per column, for typed array parameters such as the unnest INSERT of TimeScaleCallback.
+        """
+        return [column.to_list() for column in self.columns]
+
+    def to_copy(self) -> memoryview:
+        """
+        The whole batch in PostgreSQL's binary COPY format, for copy_to_table(..., format='binary').
+        Returned as a memoryview, as asyncpg would take bytes for a file path.
+        """
+        count = self.length
+        fixed = [c.kind in WIRE_DTYPES for c in self.columns]
+        payloads = [None if is_fixed else c.payload() for c, is_fixed in zip(self.columns, fixed)]
+        lengths = []
+        for column, is_fixed, payload in zip(self.columns, fixed, payloads):
+            if is_fixed:
+                lengths.append(np.where(column.nulls, -1, np.dtype(WIRE_DTYPES[column.kind]).itemsize))
+            else:
+                lengths.append(payload[2])
+        # each row is its field count, then the byte length (-1 for NULL) and bytes of every field
+        sizes = np.full(count, 2 + 4 * len(self.columns), dtype=np.int64)
+        for field_lengths in lengths:
+            sizes += np.maximum(field_lengths, 0)
+        offsets = len(COPY_HEADER) + _exclusive_cumsum(sizes)
+        buffer = np.empty(len(COPY_HEADER) + int(sizes.sum()) + len(COPY_TRAILER), dtype=np.uint8)
+        buffer[:len(COPY_HEADER)] = np.frombuffer(COPY_HEADER, dtype=np.uint8)
+        buffer[len(buffer) - len(COPY_TRAILER):] = np.frombuffer(COPY_TRAILER, dtype=np.uint8)
+        field_count = np.full(count, len(self.columns), dtype='>i2')
+        _scatter_fixed(buffer, offsets, field_count.view(np.uint8).reshape(count, 2))
+        offsets = offsets + 2
+        for column, is_fixed, payload, field_lengths in zip(self.columns, fixed, payloads, lengths):
+            _scatter_fixed(buffer, offsets, field_lengths.astype('>i4').view(np.uint8).reshape(count, 4))
+            offsets = offsets + 4
+            present = ~column.nulls
+            if is_fixed:
+                _scatter_fixed(buffer, offsets[present], column.wire()[present])
+            else:
+                source, starts, _ = payload
+                _scatter_ragged(buffer, offsets[present], np.frombuffer(source, dtype=np.uint8), starts[present], field_lengths[present])
+            offsets = offsets + np.maximum(field_lengths, 0)
+        return memoryview(buffer)
@@ -1,16 +1,99 @@
 from collections import defaultdict
-from datetime import datetime as dt
+from datetime import datetime as dt, timezone
+from decimal import Decimal
 from typing import Tuple
+import asyncio
+import os
+import re
+import time
 import asyncpg
-from yapic import json
+from runtime import json
 from cryptofeed.backends.backend import BackendBookCallback, BackendCallback, BackendQueue
 from cryptofeed.defines import CANDLES, FUNDING, OPEN_INTEREST, TICKER, TRADES, LIQUIDATIONS, INDEX
+from batching import MicroBatchQueue
+from spill_log import SegmentLog
+from columnar import ColumnBatch, column_kind
 import logging
 import sys
 logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)s:%(levelname)s:%(message)s')
 logger = logging.getLogger(__name__)
-class TimeScaleCallback(BackendQueue):
-    def __init__(self, host='127.0.0.1', user=None, pw=None, db=None, port=None, table=None, custom_columns: dict = None, none_to=None, numeric_type=float, **kwargs):
+
+WRITE_MODES = ('insert', 'copy', 'upsert', 'columnar')
+
+# errors meaning the database is unreachable, restarting or failed over, rather than something wrong with the batch
+UNAVAILABLE_ERRORS = (OSError, asyncio.TimeoutError, asyncpg.PostgresConnectionError, asyncpg.InterfaceError,
+                      asyncpg.OperatorInterventionError, asyncpg.ReadOnlySQLTransactionError)
+
+
+def _copy_timestamp(value):
+    # timestamptz: asyncpg treats naive datetimes as local time, so COPY records always carry UTC-aware values
+    if isinstance(value, (int, float)):
+        return dt.fromtimestamp(value, tz=timezone.utc)
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+def _copy_naive_timestamp(value):
+    # timestamp without time zone: asyncpg subtracts a naive epoch, so the values must be naive, in UTC
+    if isinstance(value, (int, float)):
+        return dt.fromtimestamp(value, tz=timezone.utc).replace(tzinfo=None)
+    return value.astimezone(timezone.utc).replace(tzinfo=None) if value.tzinfo else value
+
+
+def _copy_json(value):
+    return value if isinstance(value, str) else json.dumps(value)
+
+
+# Process-wide connection pools shared by every TimescaleDB backend, keyed on the connection parameters
+_pools = {}
+_pools_lock = None
+
+
+async def get_pool(host, port, user, pw, db, max_size=10):
+    """
+    Return the shared asyncpg pool for this database, creating it on first use.
+    The first backend to ask for a pool decides its size.
+    """
+    global _pools_lock
+    if _pools_lock is None:
+        _pools_lock = asyncio.Lock()
+    key = (host, port, user, db)
+    async with _pools_lock:
+        if key not in _pools:
+            _pools[key] = await asyncpg.create_pool(user=user, password=pw, database=db, host=host, port=port, min_size=1, max_size=max_size)
+            logging.info(f"Created TimescaleDB connection pool for {host}:{port}/{db} with up to {max_size} connections")
+    return _pools[key]
+
+
+# Python types expected by asyncpg's binary COPY, keyed on the postgres column type (without modifiers)
+COPY_CONVERTERS = {
+    'text': str,
+    'character varying': str,
+    'character': str,
+    'double precision': float,
+    'real': float,
+    'numeric': lambda v: Decimal(str(v)),
+    'bigint': int,
+    'integer': int,
+    'smallint': int,
+    'boolean': bool,
+    'json': _copy_json,
+    'jsonb': _copy_json,
+    'timestamp with time zone': _copy_timestamp,
+    'timestamp without time zone': _copy_naive_timestamp,
+}
+
+
+class TimeScaleCallback(MicroBatchQueue):
+    """
+    Base of the TimescaleDB backends. The backends do not create their tables: every table, hypertable and
+    compression policy is defined by scripts/set_tables_timescaledb.sh, which has to run before the feeds start.
+    """
+    # (field, column) pairs of the default cryptofeed schema, used by the COPY path when no custom_columns are given
+    default_columns = ()
+
+    def __init__(self, host='127.0.0.1', user=None, pw=None, db=None, port=None, table=None, custom_columns: dict = None, none_to=None, numeric_type=float, write_mode='insert', pool_size=10, writers=1, columnar_min_rows=256,
+                 batch_max_rows=None, batch_max_bytes=None, batch_linger=0.0, batch_metrics_interval=60.0,
+                 spill_dir=None, spill_after=None, spill_segment_bytes=64 << 20, spill_max_bytes=1 << 30, spill_retry=5.0, **kwargs):
         """
         host: str
             Database host address
@@ -26,8 +109,45 @@ class TimeScaleCallback(BackendQueue):
             A dictionary which maps Cryptofeed's data type fields to Postgres's table column names, e.g. {'symbol': 'instrument', 'price': 'price', 'amount': 'size'}
             Can be a subset of Cryptofeed's available fields (see the cdefs listed under each data type in types.pyx). Can be listed any order.
             Note: to store BOOK data in a JSONB column, include a 'data' field, e.g. {'symbol': 'symbol', 'data': 'json_data'}
+        write_mode: str
+            'insert' runs one INSERT ... SELECT FROM unnest(...) statement per batch with a typed array
+            parameter per column (see columns), so the statement is planned once per connection and cached
+            by asyncpg, and no value is ever interpolated into SQL. Numeric and array columns are not supported.
+            'copy' sends typed record tuples with asyncpg's binary copy_records_to_table (see record), which
+            skips both the string building in Python and the statement parsing on the server.
+            'upsert' copies the records into a session-local staging table and moves them into the table with
+            INSERT ... SELECT ... ON CONFLICT DO NOTHING, so rows re-published after a reconnect are skipped
+            without losing the rest of the batch.
+            'columnar' formats the whole batch at once into column arrays (see columnar.ColumnBatch) and sends
+            them as a single binary COPY, with no per-row Python objects in between. Numeric and array columns
+            are not supported.
+        columnar_min_rows: int
+            Batches smaller than this are written like in the 'copy' mode by the columnar write mode, as the
+            fixed cost of the column arrays outweighs the per-row savings on a handful of rows.
+            In every mode duplicate rows are skipped instead of failing the batch; 'copy' falls back to the
+            staging path for the batches that hit a duplicate.
+        pool_size: int
+            Maximum number of connections in the process-wide pool shared by all TimescaleDB backends
+            with the same connection parameters. The first backend to connect sets the size.
+        writers: int
+            Number of batches this backend keeps in flight at once. Updates are routed to a writer by
+            (exchange, symbol), so batches for one symbol are still committed in order.
+        batch_max_rows, batch_max_bytes, batch_linger, batch_metrics_interval:
+            Bounds on the batches read from the queue, see MicroBatchQueue.init_batching.
+        spill_dir: str
+            Enables the local spill log: batches that fail because the database is unreachable (or take longer than
+            spill_after seconds) are appended to a memory-mapped segment log in spill_dir/<table> instead of being lost,
+            and later batches queue behind them so every symbol stays in order. The log is replayed in bulk through
+            the staging table upsert once the database answers again, retrying every spill_retry seconds, and is
+            also replayed by the next run after a restart. Each process needs its own spill_dir.
+        spill_segment_bytes, spill_max_bytes: int
+            Size of each segment file and bound on the whole log; when full, the oldest segment is dropped.
         """
-        self.conn = None
+        if write_mode not in WRITE_MODES:
+            raise ValueError(f"write_mode must be one of {WRITE_MODES}, got {write_mode!r}")
+        self.pool = None
+        self.pool_size = pool_size
+        self.writers = max(1, writers)
         self.table = table if table else self.default_table
         self.custom_columns = custom_columns
         self.numeric_type = numeric_type
@@ -37,34 +157,50 @@ class TimeScaleCallback(BackendQueue):
         self.pw = pw
         self.host = host
         self.port = port
-        # Parse INSERT statement with user-specified column names
-        # Performed at init to avoid repeated list joins
-        self.insert_statement = f"INSERT INTO {self.table} ({','.join([v for v in self.custom_columns.values()])}) VALUES " if custom_columns else None
+        # built from the column types once they are loaded, see _insert_statement
+        self.insert_statement = None
+        self.write_mode = write_mode
+        # Fields pulled from each update and the columns they are copied into, in the same order
+        if custom_columns:
+            self.copy_fields = list(custom_columns.keys())
+            self.copy_columns = [v.strip() for v in custom_columns.values()]
+        else:
+            self.copy_fields = [field for field, _ in self.default_columns]
+            self.copy_columns = [column for _, column in self.default_columns]
+        self.copy_converters = None
+        self.copy_kinds = None
+        self.columnar_min_rows = columnar_min_rows
+        self.staging_table = f"{self.table}_staging"
+        self.upsert_statement = f"INSERT INTO {self.table} ({','.join(self.copy_columns)}) SELECT {','.join(self.copy_columns)} FROM {self.staging_table} ON CONFLICT DO NOTHING"
+        self.init_batching(batch_max_rows=batch_max_rows, batch_max_bytes=batch_max_bytes, batch_linger=batch_linger, batch_metrics_interval=batch_metrics_interval)
+        self.spill = SegmentLog(os.path.join(spill_dir, self.table), segment_bytes=spill_segment_bytes, max_bytes=spill_max_bytes) if spill_dir else None
+        self.spill_after = spill_after
+        self.spill_retry = spill_retry
         self.running = True
     
-    async def set_retention_policy(self):
+    async def set_retention_policy(self, conn):
         try:
             # Set retention policy for table
-            await self.conn.execute(f"""
+            await conn.execute(f"""
                 SELECT add_retention_policy('public.{self.table}', INTERVAL '7 days', if_not_exists => true);
             """)
             logging.info(f"Retention policy set for {self.table} table.")
         except Exception as e:
             logging.error(f"Error setting retention policies: {str(e)}")
             
-    async def ensure_compression(self, segmentby_column, orderby_column, compress_interval='10 minutes'):
+    async def ensure_compression(self, conn, segmentby_column, orderby_column, compress_interval='10 minutes'):
         try:
             # Check if compression is enabled
             segmentby_columns_formatted = ", ".join(segmentby_column)  # Format the column names properly
             orderby_column_formatted = ", ".join(orderby_column)
-            await self.conn.execute("""
+            await conn.execute("""
                 ALTER TABLE {} SET (
                     timescaledb.compress, 
                     timescaledb.compress_segmentby = '{}', 
                     timescaledb.compress_orderby = '{}'
                 );
             """.format(self.table, segmentby_columns_formatted, orderby_column_formatted))
-            await self.conn.execute(f"""
+            await conn.execute(f"""
                 SELECT add_compression_policy('public.{self.table}', INTERVAL '{compress_interval}', if_not_exists => true);
             """)
             logging.info(f"Compression enabled for table {self.table}")
@@ -72,13 +208,14 @@ class TimeScaleCallback(BackendQueue):
             logging.error(f"Error while ensuring compression on table {self.table}: {str(e)}")
 
 
-    async def ensure_tables_exist(self):
+    async def ensure_tables_exist(self, conn):
+        # Not called, see _connect and the class docstring
         try:
             # Check if 'trades' table exists
-            table_exists = await self.conn.fetchval(f"SELECT EXISTS (SELECT 1 FROM pg_tables WHERE schemaname = 'public' AND tablename  = '{self.table}');")
+            table_exists = await conn.fetchval(f"SELECT EXISTS (SELECT 1 FROM pg_tables WHERE schemaname = 'public' AND tablename  = '{self.table}');")
             #print(table_exists)
             if not table_exists and self.table == 'trades':
-                await self.conn.execute(f"""
+                await conn.execute(f"""
                     CREATE TABLE {self.table} (
                         exchange TEXT,
                         symbol TEXT,
@@ -99,7 +236,7 @@ class TimeScaleCallback(BackendQueue):
                 # type TEXT,
             
             elif not table_exists and self.table == 'book':
-                await self.conn.execute(f"""
+                await conn.execute(f"""
                     CREATE TABLE {self.table} (
                         exchange TEXT,
                         symbol TEXT,
@@ -111,135 +248,312 @@ class TimeScaleCallback(BackendQueue):
                     SELECT create_hypertable('{self.table}', 'receipt', chunk_time_interval => INTERVAL '10 minutes');
                 """)
                 logging.info(f"Created {self.table} hypertable")
+
             logging.info(f"Table {self.table} checked")
         except Exception as e:
             logging.error(f"Error while checking/creating tables: {str(e)}")
 
     async def _connect(self):
-        if self.conn is None:
+        if self.pool is None:
             logging.info('Connecting to TimescaleDB')
             try:
-                self.conn = await asyncpg.connect(user=self.user, password=self.pw, database=self.db, host=self.host, port=self.port)
-                # await self.ensure_tables_exist()
-                # await self.ensure_compression(['exchange','symbol'], ['receipt', 'update_type'] if self.table == 'book' else ['timestamp', 'id'], compress_interval='10 minutes')
-                # await self.set_retention_policy()  # Setting retention policy
+                self.pool = await get_pool(self.host, self.port, self.user, self.pw, self.db, max_size=self.pool_size)
+                # async with self.pool.acquire() as conn:
+                #     await self.ensure_tables_exist(conn)
+                #     await self.ensure_compression(conn, ['exchange','symbol'], ['receipt', 'update_type'] if self.table == 'book' else ['timestamp', 'id'], compress_interval='10 minutes')
+                #     await self.set_retention_policy(conn)  # Setting retention policy
                 
             except Exception as e:
                 logging.error(f"Error while connecting to TimescaleDB: {str(e)}")
+        if self.pool is not None and self.copy_converters is None:
+            async with self.pool.acquire() as conn:
+                await self._load_copy_converters(conn)
+
+    async def _load_copy_converters(self, conn):
+        # Binary COPY and the typed insert parameters need the exact type of every column, so look them up once
+        rows = await conn.fetch("""
+            SELECT attname, format_type(atttypid, atttypmod) AS coltype
+            FROM pg_attribute
+            WHERE attrelid = $1::regclass AND attnum > 0 AND NOT attisdropped;
+        """, self.table)
+        types = {row['attname']: re.sub(r'\(.*?\)', '', row['coltype']).strip() for row in rows}
+        converters = []
+        for column in self.copy_columns:
+            if column not in types:
+                raise ValueError(f"Column {column} does not exist in table {self.table}")
+            if types[column].endswith('[]'):
+                element = COPY_CONVERTERS.get(types[column][:-2], str)
+                converters.append(lambda v, element=element: [None if x is None else element(x) for x in v])
+            else:
+                converters.append(COPY_CONVERTERS.get(types[column], str))
+        self.copy_converters = converters
+        if self.write_mode in ('insert', 'columnar'):
+            self.copy_kinds = [column_kind(types[column]) for column in self.copy_columns]
+            self.insert_statement = self._insert_statement(types)
+        logging.info(f"Loaded COPY column types for {self.table}: {types}")
+
+    def _insert_statement(self, types: dict) -> str:
+        # One array parameter per column, unnested into rows. Timestamps are sent as integer microseconds
+        # since the unix epoch and converted exactly on the server, so no datetime is built in Python.
+        params, values = [], []
+        for i, (column, kind) in enumerate(zip(self.copy_columns, self.copy_kinds), 1):
+            if kind == 'timestamp':
+                params.append(f"${i}::bigint[]")
+                values.append(f"'epoch'::{types[column]} + c{i} * interval '1 microsecond'")
+            else:
+                params.append(f"${i}::{types[column]}[]")
+                values.append(f"c{i}")
+        names = ', '.join(f"c{i}" for i in range(1, len(params) + 1))
+        return (f"INSERT INTO {self.table} ({','.join(self.copy_columns)}) SELECT {', '.join(values)} "
+                f"FROM unnest({', '.join(params)}) AS u({names}) ON CONFLICT DO NOTHING")
 
+    def record(self, data: Tuple):
+        """
+        Build the typed tuple copied into copy_columns for one update. Missing values become NULL.
+        """
+        d = {
+            **data[4],
+            'exchange': data[0],
+            'symbol': data[1],
+            'timestamp': data[2],
+            'receipt': data[3],
+        }
+        return tuple(None if d.get(field) is None else convert(d[field]) for field, convert in zip(self.copy_fields, self.copy_converters))
 
-    def format(self, data: Tuple):
-        feed = data[0]
-        symbol = data[1]
-        timestamp = data[2]
-        receipt_timestamp = data[3]
-        data = data[4]
-
-        return f"(DEFAULT,'{timestamp}','{receipt_timestamp}','{feed}','{symbol}','{json.dumps(data)}')"
-    def _custom_format(self, data: Tuple):
-
-            d = {
-                **data[4],
-                **{
-                    'exchange': data[0],
-                    'symbol': data[1],
-                    'timestamp': data[2],
-                    'receipt': data[3],
-                }
-            }
-
-            # Cross-ref data dict with user column names from custom_columns dict, inserting NULL if requested data point not present
-            sequence_gen = (d[field] if d[field] else 'NULL' for field in self.custom_columns.keys())
-            # Iterate through the generator and surround everything except floats and NULL in single quotes
-            sql_string = ','.join(str(s) if isinstance(s, float) or s == 'NULL' else "'" + str(s) + "'" for s in sequence_gen)
-            return f"({sql_string})"
+    def records(self, data: Tuple) -> list:
+        """
+        All the rows one update turns into for the COPY path. One row per update unless a subclass splits it.
+        """
+        return [self.record(data)]
+
+    def columns(self, updates: list) -> ColumnBatch:
+        """
+        The whole batch as column arrays, for the insert and columnar write modes.
+        """
+        return ColumnBatch.from_rows(updates, self.copy_fields, self.copy_kinds)
 
     async def writer(self):
+        # One lane per in-flight writer; a symbol always maps to the same lane so its batches stay ordered
+        lanes = [asyncio.Queue(maxsize=2) for _ in range(self.writers)]
+        tasks = [asyncio.create_task(self._lane_writer(lane)) for lane in lanes]
+        replayer = asyncio.create_task(self._replay_spill()) if self.spill is not None else None
         while self.running:
             try:
                 async with self.read_queue() as updates:
                     if len(updates) > 0:
-                        batch = []
+                        batches = [[] for _ in lanes]
                         for data in updates:
-                            ts = dt.utcfromtimestamp(data['timestamp']) if data['timestamp'] else None
-                            rts = dt.utcfromtimestamp(data['receipt_timestamp'])
-                            batch.append((data['exchange'], data['symbol'], ts, rts, data))
-                        await self.write_batch(batch)
+                            # timestamps stay epoch seconds, converted by ColumnBatch or the COPY converters
+                            ts = data['timestamp'] or None
+                            batches[hash((data['exchange'], data['symbol'])) % self.writers].append((data['exchange'], data['symbol'], ts, data['receipt_timestamp'], data))
+                        for lane, batch in zip(lanes, batches):
+                            if batch:
+                                await lane.put(batch)
             except Exception as e:
                 logging.error(f"Error in writer method in TimeScaleCallback: {str(e)}")
-                self.conn = None # reset connection
-                await self._connect()  # Attempt to reconnect
+        for lane in lanes:
+            await lane.put(None)
+        await asyncio.gather(*tasks)
+        if replayer is not None:
+            # whatever is still in the log is replayed by the next run
+            replayer.cancel()
+            self.spill.close()
+
+    async def _lane_writer(self, lane: asyncio.Queue):
+        while True:
+            batch = await lane.get()
+            if batch is None:
+                return
+            if self.spill:
+                # earlier batches are still waiting in the spill log, queue behind them to keep the order
+                self.spill.append(batch)
+                continue
+            try:
+                if self.spill_after:
+                    await asyncio.wait_for(self.write_batch(batch), self.spill_after)
+                else:
+                    await self.write_batch(batch)
+            except Exception as e:
+                # the pool discards broken connections, so the next batch gets a fresh one
+                logging.error(f"Error writing batch to {self.table} in TimeScaleCallback: {str(e)}")
+                if self.spill is not None and isinstance(e, UNAVAILABLE_ERRORS):
+                    self.spill.append(batch)
+                    logging.error(f"Spilling writes to {self.table} to {self.spill.directory} until TimescaleDB is back")
 
+    async def _replay_spill(self):
+        report = time.time()
+        while self.running:
+            batch = self.spill.peek()
+            if batch is None:
+                await asyncio.sleep(self.spill_retry)
+                continue
+            rows = 0
+            try:
+                await self._connect()
+                if self.pool is None:
+                    raise ConnectionError("TimescaleDB is unreachable")
+                async with self.pool.acquire() as conn:
+                    if self.copy_converters is None:
+                        await self._load_copy_converters(conn)
+                    # staging table upsert: a batch replayed twice after a crash only yields duplicates that are skipped
+                    records = [r for u in batch for r in self.records(u)]
+                    await self.upsert_records(conn, records)
+                    rows = len(records)
+            except UNAVAILABLE_ERRORS as e:
+                logging.error(f"TimescaleDB still unavailable, {self.spill.pending} batches spilled for {self.table}: {str(e)}")
+                await asyncio.sleep(self.spill_retry)
+                continue
+            except Exception as e:
+                logging.error(f"Dropping spilled batch for {self.table} that cannot be written: {str(e)}")
+            self.spill.commit(rows)
+            if not self.spill:
+                logging.info(f"Spill log for {self.table} drained: {self.spill.stats.summary()}")
+            elif time.time() - report >= (self.batch_metrics_interval or 60):
+                logging.info(f"Spill log for {self.table}: {self.spill.pending} batches left ({self.spill.disk_bytes / 1e6:.0f} MB on disk), {self.spill.stats.summary()}")
+            else:
+                continue
+            report = time.time()
 
     async def write_batch(self, updates: list):
         await self._connect()
-        args_str = ','.join([self.format(u) for u in updates])
+        if self.pool is None:
+            raise ConnectionError("TimescaleDB is unreachable")
+        async with self.pool.acquire() as conn:
+            if self.write_mode == 'copy':
+                await self.copy_batch(conn, updates)
+            elif self.write_mode == 'upsert':
+                await self.upsert_records(conn, [r for u in updates for r in self.records(u)])
+            elif self.write_mode == 'columnar' and len(updates) >= self.columnar_min_rows:
+                await self.copy_columnar(conn, updates)
+            elif self.write_mode == 'columnar':
+                await self.copy_batch(conn, updates)
+            else:
+                await self.insert_batch(conn, updates)
 
-        async with self.conn.transaction():
-            try:
-                if self.custom_columns:
-                    await self.conn.execute(self.insert_statement + args_str)
-                else:
-                    await self.conn.execute(f"INSERT INTO {self.table} VALUES {args_str}")
+    async def insert_batch(self, conn, updates: list):
+        batch = self.columns(updates)
+        # asyncpg prepares the statement on first use and keeps it in the connection's statement cache;
+        # when restarting a subscription, some exchanges will re-publish a few messages
+        status = await conn.execute(self.insert_statement, *batch.to_arrays())
+        inserted = int(status.split()[-1])
+        if inserted < len(batch):
+            logging.info(f"Skipped {len(batch) - inserted} duplicate rows in {self.table}")
+
+    async def copy_batch(self, conn, updates: list):
+        records = [r for u in updates for r in self.records(u)]
+        try:
+            async with conn.transaction():
+                await conn.copy_records_to_table(self.table, records=records, columns=self.copy_columns)
+        except asyncpg.UniqueViolationError:
+            # when restarting a subscription, some exchanges will re-publish a few messages;
+            # COPY has no conflict handling, so redo the batch through the staging table
+            await self.upsert_records(conn, records)
+
+    async def copy_columnar(self, conn, updates: list):
+        batch = self.columns(updates)
+        try:
+            async with conn.transaction():
+                await conn.copy_to_table(self.table, source=batch.to_copy(), columns=self.copy_columns, format='binary')
+        except asyncpg.UniqueViolationError:
+            await self.upsert_records(conn, batch)
 
-            except asyncpg.UniqueViolationError:
-                # when restarting a subscription, some exchanges will re-publish a few messages
-                pass
+    async def upsert_records(self, conn, records):
+        """
+        records: list or ColumnBatch
+            Record tuples, or the column arrays of the columnar write mode.
+        """
+        async with conn.transaction():
+            # Temp tables are never WAL-logged and live as long as the pooled connection;
+            # ON COMMIT DELETE ROWS empties the staging table for the next batch
+            await conn.execute(f"CREATE TEMP TABLE IF NOT EXISTS {self.staging_table} (LIKE {self.table} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS")
+            if isinstance(records, ColumnBatch):
+                await conn.copy_to_table(self.staging_table, source=records.to_copy(), columns=self.copy_columns, format='binary')
+            else:
+                await conn.copy_records_to_table(self.staging_table, records=records, columns=self.copy_columns)
+            status = await conn.execute(self.upsert_statement)
+        inserted = int(status.split()[-1])
+        if inserted < len(records):
+            logging.info(f"Skipped {len(records) - inserted} duplicate rows in {self.table}")
 
 
 class TradesTimeScale(TimeScaleCallback, BackendCallback):
     default_table = TRADES
-    try:
-        def format(self, data: Tuple):
-            if self.custom_columns:
-                
-                return self._custom_format(data)
-            else:
-                exchange, symbol, timestamp, receipt, data = data
-                id = f"'{data['id']}'" if data['id'] else 'NULL'
-                otype = f"'{data['type']}'" if data['type'] else 'NULL'
-                return f"(DEFAULT,'{timestamp}','{receipt}','{exchange}','{symbol}','{data['side']}',{data['amount']},{data['price']},{id},{otype})"
-    except Exception as e:
-            logging.error(f"Error in format method of TradesTimeScale: {str(e)}")
-            # Optionally, you can raise the exception again to propagate it
-            #raise
-            
+    default_columns = (('timestamp', 'timestamp'), ('receipt', 'receipt_timestamp'), ('exchange', 'exchange'), ('symbol', 'symbol'),
+                       ('side', 'side'), ('amount', 'amount'), ('price', 'price'), ('id', 'trade_id'), ('type', 'order_type'))
+
+
 class FundingTimeScale(TimeScaleCallback, BackendCallback):
     default_table = FUNDING
+    default_columns = (('timestamp', 'timestamp'), ('receipt', 'receipt_timestamp'), ('exchange', 'exchange'), ('symbol', 'symbol'),
+                       ('mark_price', 'mark_price'), ('rate', 'rate'), ('next_funding_time', 'next_funding_time'), ('predicted_rate', 'predicted_rate'))
+
 
-    def format(self, data: Tuple):
-        if self.custom_columns:
-            if data[4]['next_funding_time']:
-                data[4]['next_funding_time'] = dt.utcfromtimestamp(data[4]['next_funding_time'])
-            return self._custom_format(data)
-        else:
-            exchange, symbol, timestamp, receipt, data = data
-            ts = dt.utcfromtimestamp(data['next_funding_time']) if data['next_funding_time'] else 'NULL'
-            return f"(DEFAULT,'{timestamp}','{receipt}','{exchange}','{symbol}',{data['mark_price'] if data['mark_price'] else 'NULL'},{data['rate']},'{ts}',{data['predicted_rate']})"
-        
 class OpenInterestTimeScale(TimeScaleCallback, BackendCallback):
     default_table = OPEN_INTEREST
+    default_columns = (('timestamp', 'timestamp'), ('receipt', 'receipt_timestamp'), ('exchange', 'exchange'), ('symbol', 'symbol'),
+                       ('open_interest', 'open_interest'))
+
 
-    def format(self, data: Tuple):
-        if self.custom_columns:
-            return self._custom_format(data)
-        else:
-            exchange, symbol, timestamp, receipt, data = data
-            return f"(DEFAULT,'{timestamp}','{receipt}','{exchange}','{symbol}',{data['open_interest']})"
-        
 class LiquidationsTimeScale(TimeScaleCallback, BackendCallback):
     default_table = LIQUIDATIONS
+    default_columns = (('timestamp', 'timestamp'), ('receipt', 'receipt_timestamp'), ('exchange', 'exchange'), ('symbol', 'symbol'),
+                       ('side', 'side'), ('quantity', 'quantity'), ('price', 'price'), ('id', 'trade_id'), ('status', 'status'))
+
+
+class SpreadTimeScale(TimeScaleCallback, BackendCallback):
+    """
+    Spread statistics written by spreads.SpreadEngine, one row per published observation, keyed by the pair name.
+    """
+    default_table = 'spreads'
+    default_columns = (('symbol', 'pair'), ('receipt', 'receipt'), ('spread', 'spread'), ('mean', 'mean'), ('std', 'std'), ('zscore', 'zscore'),
+                       ('window_mean', 'window_mean'), ('window_std', 'window_std'), ('window_zscore', 'window_zscore'))
+
+
+class HedgeTimeScale(TimeScaleCallback, BackendCallback):
+    """
+    Hedge ratios and rolling ADF statistics written by hedge.HedgeEngine, one row per published step, keyed by
+    the pair name.
+    """
+    default_table = 'hedge_ratios'
+    default_columns = (('symbol', 'pair'), ('receipt', 'receipt'), ('alpha', 'alpha'), ('beta', 'beta'), ('residual', 'residual'),
+                       ('innovation', 'innovation'), ('adf', 'adf'))
+
+
+class BasisTimeScale(TimeScaleCallback, BackendCallback):
+    """
+    Spot-perp basis and funding carry written by basis.BasisEngine, one row per published observation, keyed by
+    the spot symbol.
+    """
+    default_table = 'basis'
+    default_columns = (('symbol', 'symbol'), ('receipt', 'receipt'), ('spot', 'spot'), ('perp', 'perp'), ('basis', 'basis'),
+                       ('annualized_basis', 'annualized_basis'), ('funding_rate', 'funding_rate'), ('annualized_funding', 'annualized_funding'),
+                       ('next_funding_time', 'next_funding_time'), ('carry', 'carry'))
 
-    def format(self, data: Tuple):
-        if self.custom_columns:
-            return self._custom_format(data)
-        else:
-            exchange, symbol, timestamp, receipt, data = data
-            return f"(DEFAULT,'{timestamp}','{receipt}','{exchange}','{symbol}','{data['side']}',{data['quantity']},{data['price']},'{data['id']}','{data['status']}')"
+
+class BarsTimeScale(TimeScaleCallback, BackendCallback):
+    """
+    OHLCV bars built from trades by bars.BarBuilder, one row per closed bar, keyed by exchange, symbol, bar name
+    and start time.
+    """
+    default_table = 'bars'
+    default_columns = (('exchange', 'exchange'), ('symbol', 'symbol'), ('bar', 'bar'), ('timestamp', 'timestamp'), ('end', 'end_time'), ('receipt', 'receipt'),
+                       ('open', 'open'), ('high', 'high'), ('low', 'low'), ('close', 'close'), ('volume', 'volume'), ('notional', 'notional'),
+                       ('vwap', 'vwap'), ('buy_volume', 'buy_volume'), ('trades', 'trades'))
+
+
+class NBBOTimeScale(TimeScaleCallback, BackendCallback):
+    """
+    Consolidated top of book written by nbbo.NBBOEngine, one row per change. spreads holds the cross-venue
+    spreads as a JSONB object, see NBBOEngine.update.
+    """
+    default_table = 'nbbo'
+    default_columns = (('symbol', 'symbol'), ('timestamp', 'timestamp'), ('receipt', 'receipt'), ('bid', 'bid'), ('bid_size', 'bid_size'),
+                       ('bid_exchange', 'bid_exchange'), ('ask', 'ask'), ('ask_size', 'ask_size'), ('ask_exchange', 'ask_exchange'), ('spreads', 'spreads'))
 
         
 class BookTimeScale(TimeScaleCallback, BackendBookCallback):
     default_table = 'book'
+    default_columns = (('timestamp', 'timestamp'), ('receipt', 'receipt_timestamp'), ('exchange', 'exchange'), ('symbol', 'symbol'), ('data', 'data'))
 
     def __init__(self, *args, snapshots_only=False, snapshot_interval=10000, **kwargs):
         self.snapshots_only = snapshots_only
@@ -247,32 +561,98 @@ class BookTimeScale(TimeScaleCallback, BackendBookCallback):
         self.snapshot_count = defaultdict(int)
         super().__init__(*args, **kwargs)
 
-    def format(self, data: Tuple):
-        try:
-            if self.custom_columns:
-                if 'book' in data[4]:
-                    data[4]['data'] = json.dumps(data[4]['book'])
-                    data[4]['update_type'] = 'snapshot' 
-                else:
-                    data[4]['data'] = json.dumps(data[4]['delta'])
-                    data[4]['update_type'] = 'delta'
-                return self._custom_format(data)
-            else:
-                feed = data[0]
-                symbol = data[1]
-                timestamp = data[2]
-                receipt_timestamp = data[3]
-                data = data[4]
-                if 'book' in data:
-                    data = {'snapshot': data['book']}
-                else:
-                    data = {'delta': data['delta']}
+    def _set_data(self, update: dict):
+        if 'book' in update:
+            update['data'] = json.dumps(update['book'] if self.custom_columns else {'snapshot': update['book']})
+            update['update_type'] = 'snapshot'
+        else:
+            update['data'] = json.dumps(update['delta'] if self.custom_columns else {'delta': update['delta']})
+            update['update_type'] = 'delta'
 
-                return f"(DEFAULT,'{timestamp}','{receipt_timestamp}','{feed}','{symbol}','{json.dumps(data)}')"
+    def record(self, data: Tuple):
+        self._set_data(data[4])
+        return super().record(data)
 
-        except Exception as e:
-            logging.error(f"Error in format method of BookTimeScale: {str(e)}")
-            # Optionally, you can raise the exception again to propagate it
-            #raise
-            
-        
\ No newline at end of file
+    def columns(self, updates: list) -> ColumnBatch:
+        for data in updates:
+            self._set_data(data[4])
+        return super().columns(updates)
+
+
+class BookLevelsTimeScale(BookTimeScale):
+    """
+    Normalized book storage: instead of one JSONB blob per update, every update is stored as one row per side
+    with the price levels in typed arrays (price[], size[], and order_id[] for L3 books), best level first,
+    so the level index is the array position. Deltas keep the exchange order, a size of 0 removes the level.
+    The table is compressed segmented by exchange, symbol and side.
+    Only the COPY based write modes are supported, and the schema is fixed, so custom_columns cannot be used.
+    """
+    default_table = 'book_levels'
+    default_columns = (('exchange', 'exchange'), ('symbol', 'symbol'), ('timestamp', 'timestamp'), ('receipt', 'receipt'), ('update_type', 'update_type'),
+                       ('side', 'side'), ('price', 'price'), ('size', 'size'), ('order_id', 'order_id'))
+
+    def __init__(self, *args, write_mode='upsert', **kwargs):
+        if write_mode not in ('copy', 'upsert'):
+            raise ValueError("BookLevelsTimeScale only supports the 'copy' and 'upsert' write modes")
+        if kwargs.get('custom_columns'):
+            raise ValueError("BookLevelsTimeScale has a fixed schema and does not support custom_columns")
+        super().__init__(*args, write_mode=write_mode, **kwargs)
+
+    @staticmethod
+    def _snapshot_levels(side: str, levels: dict):
+        # Snapshots come as {price: size} for L2 books and {price: {order_id: size}} for L3 books
+        prices = sorted(levels, reverse=side == 'bid')
+        if prices and isinstance(levels[prices[0]], dict):
+            rows = [(price, size, str(order_id)) for price in prices for order_id, size in levels[price].items()]
+            return [r[0] for r in rows], [r[1] for r in rows], [r[2] for r in rows]
+        return prices, [levels[price] for price in prices], None
+
+    @staticmethod
+    def _delta_levels(entries: list):
+        # Deltas come as (price, size) for L2 books and (order_id, price, size) for L3 books
+        if entries and len(entries[0]) == 3:
+            return [e[1] for e in entries], [e[2] for e in entries], [str(e[0]) for e in entries]
+        return [e[0] for e in entries], [e[1] for e in entries], None
+
+    def records(self, data: Tuple) -> list:
+        exchange, symbol, timestamp, receipt, update = data
+        timestamp = _copy_timestamp(timestamp) if timestamp else None
+        receipt = _copy_timestamp(receipt)
+        rows = []
+        if 'book' in update:
+            for side, levels in update['book'].items():
+                price, size, order_id = self._snapshot_levels(side, levels)
+                rows.append((exchange, symbol, timestamp, receipt, 'snapshot', side, price, size, order_id))
+        else:
+            for side, entries in update['delta'].items():
+                if entries:
+                    price, size, order_id = self._delta_levels(entries)
+                    rows.append((exchange, symbol, timestamp, receipt, 'delta', side, price, size, order_id))
+        return rows
+
+
+def book_levels(config: dict, postgres_cfg: dict, snapshot_interval: int = 10000) -> list:
+    """
+    The BookLevelsTimeScale the feed modules add to their L2_BOOK callbacks next to BookTimeScale, or nothing unless
+    the timescaledb_book_levels config key is set. postgres_cfg are the TimescaleDB arguments of the feed's other
+    backends; a write mode other than 'copy' is written as 'upsert', as the levels cannot go through the insert arrays.
+    """
+    if not config.get('timescaledb_book_levels'):
+        return []
+    write_mode = 'copy' if postgres_cfg.get('write_mode') == 'copy' else 'upsert'
+    return [BookLevelsTimeScale(snapshots_only=False, snapshot_interval=snapshot_interval, **{**postgres_cfg, 'write_mode': write_mode})]
+
+
+class BookSnapshotTimeScale(BookTimeScale):
+    """
+    Book keyframes written by snapshots.SnapshotService: one row per snapshot with the whole book in a JSONB
+    column, the receipt time of the last update folded into it, and stream_id, the ID of that update in the
+    book-<exchange>-<symbol> Redis stream. A reader takes the newest snapshot before its start time and then
+    only the deltas of the book table received after it.
+    """
+    default_table = 'book_snapshots'
+    default_columns = (('exchange', 'exchange'), ('symbol', 'symbol'), ('timestamp', 'timestamp'), ('receipt', 'receipt'),
+                       ('stream_id', 'stream_id'), ('data', 'data'))
+
+    def _set_data(self, update: dict):
+        update['data'] = json.dumps(update['book'])
@@ -0,0 +1,215 @@
+import logging
+import math
+import sys
+import numpy as np
+from Custom_Redis import CustomHedgeStream
+from custom_timescaledb import HedgeTimeScale
+from service import redis_args, run_service, timescale_args
+from spreads import PairEngine, default_pairs
+logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)s:%(levelname)s:%(message)s')
+logger = logging.getLogger(__name__)
+
+METHODS = ('kalman', 'rls')
+
+
+class HedgeFilter:
+    """
+    Time-varying hedge ratios of many pairs, y = alpha + beta * x + noise, with the state (alpha, beta) of
+    every pair in one (pairs, 2) array and its covariance in a (pairs, 2, 2) array. update steps any subset
+    of the pairs at once with a handful of NumPy calls, whatever the size of the subset.
+
+    method: str
+        'kalman': the state is a random walk with variance delta / (1 - delta) per step, observed with
+        variance observation_var.
+        'rls': recursive least squares with exponential forgetting, each step down-weighting the past by
+        forgetting (e.g. 0.999, an effective memory of about 1 / (1 - forgetting) observations).
+    prior_var: float
+        Variance of the initial state (0, 0); large values let the first observations set it.
+    """
+    def __init__(self, pairs: int, method: str = 'kalman', delta: float = 1e-6, observation_var: float = 1e-6, forgetting: float = 0.999, prior_var: float = 1.0):
+        if method not in METHODS:
+            raise ValueError(f"method must be one of {METHODS}, got {method!r}")
+        self.method = method
+        self.process_var = delta / (1.0 - delta)
+        self.observation_var = observation_var
+        self.forgetting = forgetting
+        self.state = np.zeros((pairs, 2))
+        self.cov = np.tile(np.eye(2) * prior_var, (pairs, 1, 1))
+
+    @property
+    def alpha(self) -> np.ndarray:
+        return self.state[:, 0]
+
+    @property
+    def beta(self) -> np.ndarray:
+        return self.state[:, 1]
+
+    def update(self, indices: np.ndarray, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        """
+        Fold in one observation (x[i], y[i]) for each pair indices[i]; indices must not repeat.
+        Returns the innovations, y minus its prediction before the update.
+        """
+        state = self.state[indices]
+        if self.method == 'kalman':
+            cov = self.cov[indices]
+            cov[:, 0, 0] += self.process_var
+            cov[:, 1, 1] += self.process_var
+            noise = self.observation_var
+        else:
+            cov = self.cov[indices] / self.forgetting
+            noise = 1.0
+        h = np.stack((np.ones_like(x), x), axis=1)
+        ch = np.einsum('kij,kj->ki', cov, h)
+        gain = ch / (np.einsum('ki,ki->k', h, ch) + noise)[:, None]
+        innovation = y - np.einsum('ki,ki->k', h, state)
+        self.state[indices] = state + gain * innovation[:, None]
+        self.cov[indices] = cov - np.einsum('ki,kj->kij', gain, ch)
+        return innovation
+
+
+class RollingADF:
+    """
+    Rolling Dickey-Fuller t-statistics of many residual series, regressing the change of each series on its
+    previous value (with a constant) over its last window observations. The regression only needs five
+    running sums per series, kept in a (series, 5) array and updated in O(1) per observation from two ring
+    buffers of the window's regressors; the sums are recomputed exactly from the rings once per window.
+
+    Values below the critical value (about -2.86 at 5% with a constant) reject a unit root, i.e. the spread
+    mean-reverts over the window. No lagged differences are included (zero-lag ADF), which keeps the update
+    O(1); the statistic is NaN until min_observations are in the window.
+    """
+    # columns of the running sums: z is the previous value, d the change
+    SZ, SD, SZZ, SZD, SDD = range(5)
+
+    def __init__(self, series: int, window: int = 500, min_observations: int = 20):
+        self.window = window
+        self.min_observations = max(min_observations, 3)
+        self.previous = np.full(series, np.nan)
+        self.levels = np.zeros((series, window))
+        self.changes = np.zeros((series, window))
+        self.sums = np.zeros((series, 5))
+        self.count = np.zeros(series, dtype=np.int64)
+
+    def update(self, indices: np.ndarray, values: np.ndarray) -> np.ndarray:
+        """
+        Add one value to each series indices[i]; indices must not repeat. Returns the statistics of those series.
+        """
+        previous = self.previous[indices]
+        self.previous[indices] = values
+        known = ~np.isnan(previous)
+        rows = indices[known]
+        z = previous[known]
+        d = values[known] - z
+        slots = self.count[rows] % self.window
+        # slots not filled yet hold zeros, which take nothing away from the sums
+        old_z = self.levels[rows, slots]
+        old_d = self.changes[rows, slots]
+        self.sums[rows] += np.stack((z - old_z, d - old_d, z * z - old_z * old_z, z * d - old_z * old_d, d * d - old_d * old_d), axis=1)
+        self.levels[rows, slots] = z
+        self.changes[rows, slots] = d
+        self.count[rows] += 1
+        exact = rows[self.count[rows] % self.window == 0]
+        if len(exact):
+            levels, changes = self.levels[exact], self.changes[exact]
+            self.sums[exact] = np.stack((levels.sum(axis=1), changes.sum(axis=1), (levels * levels).sum(axis=1),
+                                         (levels * changes).sum(axis=1), (changes * changes).sum(axis=1)), axis=1)
+        return self.statistic(indices)
+
+    def statistic(self, indices: np.ndarray) -> np.ndarray:
+        n = np.minimum(self.count[indices], self.window).astype(np.float64)
+        sums = self.sums[indices]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sxx = sums[:, self.SZZ] - sums[:, self.SZ] ** 2 / n
+            sxy = sums[:, self.SZD] - sums[:, self.SZ] * sums[:, self.SD] / n
+            syy = sums[:, self.SDD] - sums[:, self.SD] ** 2 / n
+            slope = sxy / sxx
+            residual_var = (syy - slope * sxy) / (n - 2)
+            statistic = slope / np.sqrt(residual_var / sxx)
+        statistic[(n < self.min_observations) | ~(sxx > 0) | ~(residual_var > 0)] = np.nan
+        return statistic
+
+
+class HedgeEngine(PairEngine):
+    """
+    Streaming hedge ratios and cointegration tests: for every pair, log(mid a) is regressed on log(mid b) with a
+    HedgeFilter, and the residual log(mid a) - alpha - beta * log(mid b) is tested with a RollingADF.
+
+    Mid price changes are collected while an XREAD response is applied, then all the pairs they touched are
+    stepped together in one vectorized update, each with the latest mids of its legs, so hundreds of pairs
+    cost a few NumPy calls per read rather than per pair.
+
+    Each step is written to sinks at most once per publish_interval seconds per pair, as an update dict
+    {'exchange': 'HEDGE', 'symbol': pair name, 'timestamp', 'receipt_timestamp', 'alpha', 'beta', 'residual',
+    'innovation', 'adf'}, adf being None until the window has enough observations. In main() the sinks are
+    CustomHedgeStream and HedgeTimeScale. See PairEngine for the other arguments.
+
+    method, delta, observation_var, forgetting:
+        See HedgeFilter.
+    adf_window: int
+        Observations in the RollingADF window.
+    """
+    def __init__(self, pairs: list, sinks: list, reader, method: str = 'kalman', delta: float = 1e-6, observation_var: float = 1e-6, forgetting: float = 0.999,
+                 adf_window: int = 500, **kwargs):
+        super().__init__(pairs, sinks, reader, **kwargs)
+        self.filter = HedgeFilter(len(self.pairs), method=method, delta=delta, observation_var=observation_var, forgetting=forgetting)
+        self.adf = RollingADF(len(self.pairs), window=adf_window)
+        # pairs touched by the XREAD response being applied, with the receipt time of their last change
+        self.pending = {}
+
+    def update_pairs(self, indices: list, receipt_timestamp: float) -> list:
+        for index in indices:
+            self.pending[index] = receipt_timestamp
+        return []
+
+    def step(self, indices: np.ndarray, x: np.ndarray, y: np.ndarray):
+        """
+        One vectorized step of the pairs at indices with log mids x (leg b) and y (leg a).
+        Returns (innovations, residuals, ADF statistics), one value per pair.
+        """
+        innovation = self.filter.update(indices, x, y)
+        residual = y - self.filter.alpha[indices] - self.filter.beta[indices] * x
+        return innovation, residual, self.adf.update(indices, residual)
+
+    def flush(self) -> list:
+        if not self.pending:
+            return []
+        pending, self.pending = self.pending, {}
+        indices = np.fromiter(pending, dtype=np.int64, count=len(pending))
+        x = np.log([self.mids[self.legs[index][1]] for index in pending])
+        y = np.log([self.mids[self.legs[index][0]] for index in pending])
+        innovation, residual, adf = self.step(indices, x, y)
+        self.observations += len(pending)
+        alpha, beta = self.filter.alpha[indices].tolist(), self.filter.beta[indices].tolist()
+        updates = []
+        for i, (index, receipt) in enumerate(pending.items()):
+            if self.due(index, receipt):
+                updates.append({'exchange': 'HEDGE', 'symbol': self.names[index], 'timestamp': receipt, 'receipt_timestamp': receipt,
+                                'alpha': alpha[i], 'beta': beta[i], 'residual': float(residual[i]), 'innovation': float(innovation[i]),
+                                'adf': None if math.isnan(adf[i]) else float(adf[i])})
+        return updates
+
+
+def main():
+    """
+    Track the hedge ratios of the configured pairs into the hedge-<pair> Redis streams and the hedge_ratios hypertable.
+    Config keys: hedge_pairs (same format as spread_pairs, spreads.default_pairs by default), hedge_method
+    ('kalman' or 'rls'), hedge_delta, hedge_observation_var, hedge_forgetting, hedge_adf_window and
+    hedge_publish_interval (seconds, default 1).
+    """
+    def build(config: dict):
+        pairs = config.get('hedge_pairs') or config.get('spread_pairs') or default_pairs(config)
+        if not pairs:
+            logger.error('No hedge pairs configured, nothing to run')
+            return None
+        redis = CustomHedgeStream(**redis_args(config), decode_responses=True, ttl=3600, maxlen=config.get('redis_hedge_maxlen'))
+        timescale = HedgeTimeScale(**timescale_args(config))
+        engine = HedgeEngine(pairs, [redis, timescale], reader=redis, method=config.get('hedge_method', 'kalman'),
+                             delta=config.get('hedge_delta', 1e-6), observation_var=config.get('hedge_observation_var', 1e-6),
+                             forgetting=config.get('hedge_forgetting', 0.999), adf_window=config.get('hedge_adf_window', 500),
+                             publish_interval=config.get('hedge_publish_interval', 1.0))
+        return engine, [redis, timescale]
+    run_service('hedge ratio engine', build)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,164 @@
 from cryptofeed import FeedHandler
-from cryptofeed.exchanges import Coinbase, Binance, Bitfinex
-import sys
+from cryptofeed.defines import L2_BOOK
+from cryptofeed.exchanges import Binance, Bitfinex
+import asyncio
 import logging
+import sys
+import numpy as np
+import runtime
+from Custom_Redis import CustomNBBOStream
+from custom_timescaledb import NBBOTimeScale
+from service import fan_out, redis_args, timescale_args
 logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)s:%(levelname)s:%(message)s')
 logger = logging.getLogger(__name__)
-def nbbo_update(symbol, bid, bid_size, ask, ask_size, bid_feed, ask_feed):
-    print(f'Pair: {symbol} Bid Price: {bid:.2f} Bid Size: {bid_size:.6f} Bid Feed: {bid_feed} Ask Price: {ask:.2f} Ask Size: {ask_size:.6f} Ask Feed: {ask_feed}')
+
+PATH_TO_CONFIG = '/config_cf.yaml'
+
+# columns of the per-venue quote array
+BID, BID_SIZE, ASK, ASK_SIZE = range(4)
+
+
+class NBBOEngine:
+    """
+    Streaming NBBO across venues, used as the L2_BOOK callback of one feed per venue (like FeedHandler.add_nbbo).
+
+    The best bid and ask of every (symbol, venue) live in one float64 array of shape (symbols, venues, 4),
+    with -inf bids and +inf asks for venues without a quote yet, and the cross-venue spreads in a
+    (symbols, venues, venues) array, spreads[s, i, j] being the bid of venue i minus the ask of venue j,
+    so a positive spread is a crossed pair. A book update only rewrites its own venue's quote, the row and
+    column of that venue in the spread matrix, and the consolidated best bid and ask of its symbol.
+    Updates that leave the venue's top of book unchanged, the vast majority of L2 deltas, stop at the
+    comparison; a change is published only when the NBBO or a spread moved.
+
+    Each change is written to sinks as an update dict:
+    {'exchange': 'NBBO', 'symbol', 'timestamp', 'receipt_timestamp', 'bid', 'bid_size', 'bid_exchange',
+    'ask', 'ask_size', 'ask_exchange', 'spreads': {'<bid venue>:<ask venue>': bid - ask}}, spreads listing
+    every pair of distinct venues that both have a quote.
+
+    symbols: list
+        The symbols to consolidate; updates of other symbols are ignored.
+    venues: list
+        The exchange ids of the venues, e.g. ['BINANCE', 'BITFINEX'].
+    sinks: list
+        Backends the changes are written to, such as CustomNBBOStream and NBBOTimeScale. They are started
+        and stopped with the feeds.
+    """
+    def __init__(self, symbols: list, venues: list, sinks: list = ()):
+        self.symbols = {symbol: i for i, symbol in enumerate(symbols)}
+        self.venues = {venue: i for i, venue in enumerate(venues)}
+        self.venue_names = list(venues)
+        self.sinks = list(sinks)
+        self.quotes = np.empty((len(symbols), len(venues), 4), dtype=np.float64)
+        self.quotes[:, :, (BID, ASK)] = (-np.inf, np.inf)
+        self.quotes[:, :, (BID_SIZE, ASK_SIZE)] = 0.0
+        self.spreads = np.full((len(symbols), len(venues), len(venues)), np.nan)
+        # last published (bid, bid size, ask, ask size, bid venue, ask venue) per symbol
+        self.last = [None] * len(symbols)
+        self.published = 0
+        self.started = False
+
+    def start(self, loop: asyncio.AbstractEventLoop, multiprocess: bool = False):
+        # called by Feed.start of every feed the engine is a callback of, the sinks only start once
+        if not self.started:
+            for sink in self.sinks:
+                sink.start(loop, multiprocess=multiprocess)
+            self.started = True
+
+    async def stop(self):
+        if self.started:
+            self.started = False
+            for sink in self.sinks:
+                await sink.stop()
+            logger.info(f"NBBO engine published {self.published} changes")
+
+    def update(self, symbol: str, venue: str, bid: float, bid_size: float, ask: float, ask_size: float, timestamp: float, receipt_timestamp: float) -> dict:
+        """
+        Set the top of book of one venue. Returns the change to publish, or None when nothing moved.
+        A missing side is given as None.
+        """
+        s = self.symbols.get(symbol)
+        v = self.venues.get(venue)
+        if s is None or v is None:
+            return None
+        quote = self.quotes[s, v]
+        new = (-np.inf if bid is None else bid, bid_size or 0.0, np.inf if ask is None else ask, ask_size or 0.0)
+        if quote.tolist() == list(new):
+            return None
+        prices_moved = quote[BID] != new[BID] or quote[ASK] != new[ASK]
+        quote[:] = new
+        quotes = self.quotes[s]
+        if prices_moved:
+            spreads = self.spreads[s]
+            spreads[v, :] = new[BID] - quotes[:, ASK]
+            spreads[:, v] = quotes[:, BID] - new[ASK]
+        best_bid = int(quotes[:, BID].argmax())
+        best_ask = int(quotes[:, ASK].argmin())
+        nbbo = (quotes[best_bid, BID], quotes[best_bid, BID_SIZE], quotes[best_ask, ASK], quotes[best_ask, ASK_SIZE], best_bid, best_ask)
+        if nbbo == self.last[s] and not prices_moved:
+            return None
+        self.last[s] = nbbo
+        if not np.isfinite(nbbo[0]) or not np.isfinite(nbbo[2]):
+            return None
+        return {
+            'exchange': 'NBBO',
+            'symbol': symbol,
+            'timestamp': timestamp,
+            'receipt_timestamp': receipt_timestamp,
+            'bid': float(nbbo[0]),
+            'bid_size': float(nbbo[1]),
+            'bid_exchange': self.venue_names[best_bid],
+            'ask': float(nbbo[2]),
+            'ask_size': float(nbbo[3]),
+            'ask_exchange': self.venue_names[best_ask],
+            'spreads': self.spread_dict(s),
+        }
+
+    def spread_dict(self, s: int) -> dict:
+        spreads = self.spreads[s]
+        names = self.venue_names
+        rows, columns = np.nonzero(np.isfinite(spreads))
+        return {f"{names[i]}:{names[j]}": spread for i, j, spread in zip(rows.tolist(), columns.tolist(), spreads[rows, columns].tolist()) if i != j}
+
+    async def __call__(self, book, receipt_timestamp: float):
+        try:
+            bids, asks = book.book.bids, book.book.asks
+            bid, bid_size = bids.index(0) if len(bids) else (None, None)
+            ask, ask_size = asks.index(0) if len(asks) else (None, None)
+            update = self.update(book.symbol, book.exchange, None if bid is None else float(bid), None if bid_size is None else float(bid_size),
+                                 None if ask is None else float(ask), None if ask_size is None else float(ask_size),
+                                 book.timestamp or receipt_timestamp, receipt_timestamp)
+        except Exception as e:
+            logger.error(f"Error updating NBBO of {book.exchange} {book.symbol}: {e}")
+            return
+        if update is None:
+            return
+        self.published += 1
+        await fan_out(self.sinks, update)
 
 
 def main():
-    path_to_config = '/config_cf.yaml'
-    f = FeedHandler(config=path_to_config)  
-    #symbols = fh.config.config['bf_symbols']
-    symbols = ['BTC-USDT']
-    f.add_nbbo([Binance, Bitfinex], symbols, nbbo_update)
-    f.run()
-    
+    """
+    Publish the NBBO of Binance and Bitfinex to the nbbo-<symbol> Redis streams and the nbbo hypertable.
+    Config key: nbbo_symbols (default ['BTC-USDT']).
+    """
+    logger.info('Starting NBBO engine')
+    try:
+        fh = FeedHandler(config=PATH_TO_CONFIG)
+        runtime.setup()
+        config = fh.config.config
+        symbols = config.get('nbbo_symbols') or ['BTC-USDT']
+        feeds = [Binance, Bitfinex]
+        sinks = [
+            CustomNBBOStream(**redis_args(config), decode_responses=True, ttl=3600, maxlen=config.get('redis_nbbo_maxlen')),
+            NBBOTimeScale(**timescale_args(config)),
+        ]
+        engine = NBBOEngine(symbols, [feed.id for feed in feeds], sinks=sinks)
+        for feed in feeds:
+            fh.add_feed(feed(channels=[L2_BOOK], symbols=symbols, callbacks={L2_BOOK: engine}))
+        fh.run()
+    except Exception as e:
+        logger.error(f"An error occurred: {e}")
+
+
 if __name__ == '__main__':
     main()
-    
\ No newline at end of file
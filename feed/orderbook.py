@@ -0,0 +1,472 @@
+from array import array
+from bisect import bisect_left
+from cryptofeed.exceptions import BadChecksum
+from decimal import Decimal
+import logging
+import sys
+import zlib
+import numpy as np
+from redis_codecs import StructCodec, decode_stream_entry
+logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)s:%(levelname)s:%(message)s')
+logger = logging.getLogger(__name__)
+
+BID, ASK = 'bid', 'ask'
+
+
+class BookSide:
+    """
+    The price levels of one side of a book, as two parallel float64 arrays sorted best level first.
+
+    Levels are kept sorted by key, the price for asks and minus the price for bids, so the best level is
+    always at index 0. Each level change is a binary search (bisect) plus an in-place insert or delete in
+    the typed arrays, and the arrays are read as NumPy views for top-N extraction and snapshots.
+    A delta only touches a handful of levels, where a NumPy call per message would cost more than the
+    levels themselves, so changes are applied one level at a time.
+
+    side: str
+        'bid' or 'ask'.
+    max_depth: int
+        Keep at most this many levels, dropping the worst ones. 0 keeps every level.
+    """
+    __slots__ = ('side', 'sign', 'max_depth', 'keys', 'sizes')
+
+    def __init__(self, side: str, max_depth: int = 0):
+        if side not in (BID, ASK):
+            raise ValueError(f"side must be '{BID}' or '{ASK}', got {side!r}")
+        self.side = side
+        self.sign = -1.0 if side == BID else 1.0
+        self.max_depth = max_depth
+        self.keys = array('d')
+        self.sizes = array('d')
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _truncate(self):
+        if self.max_depth and len(self.keys) > self.max_depth:
+            del self.keys[self.max_depth:]
+            del self.sizes[self.max_depth:]
+
+    def load(self, prices, sizes):
+        """
+        Replace the side with a snapshot. Levels with a size of 0 are ignored.
+        """
+        keys = np.asarray(prices, dtype=np.float64) * self.sign
+        sizes = np.asarray(sizes, dtype=np.float64)
+        order = np.argsort(keys, kind='stable')
+        keep = sizes[order] > 0
+        self.keys = array('d', keys[order][keep].tobytes())
+        self.sizes = array('d', sizes[order][keep].tobytes())
+        self._truncate()
+
+    def update(self, prices, sizes):
+        """
+        Apply level changes in order: a size of 0 removes the level, any other size sets it.
+        """
+        keys, levels, sign = self.keys, self.sizes, self.sign
+        for price, size in zip(prices, sizes):
+            key = float(price) * sign
+            i = bisect_left(keys, key)
+            if i < len(keys) and keys[i] == key:
+                if size:
+                    levels[i] = float(size)
+                else:
+                    del keys[i]
+                    del levels[i]
+            elif size:
+                keys.insert(i, key)
+                levels.insert(i, float(size))
+        self._truncate()
+
+    def top(self, depth: int = None):
+        """
+        (prices, sizes) of the best depth levels, best first, as NumPy arrays.
+        """
+        # slices are copies: the typed arrays cannot be resized while a NumPy view of them is alive
+        keys, sizes = self.keys[:depth], self.sizes[:depth]
+        return np.frombuffer(keys, dtype=np.float64) * self.sign, np.frombuffer(sizes, dtype=np.float64)
+
+    @property
+    def prices(self) -> np.ndarray:
+        return self.top()[0]
+
+    def best(self):
+        """
+        (price, size) of the best level, or None when the side is empty.
+        """
+        if not self.keys:
+            return None
+        return self.keys[0] * self.sign, self.sizes[0]
+
+    def size_at(self, price: float) -> float:
+        key = price * self.sign
+        i = bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return self.sizes[i]
+        return 0.0
+
+
+def _js_number(value: float) -> str:
+    # Bitfinex computes checksums over the numbers as javascript prints them: the shortest round trip digits,
+    # positional from 1e-6 up to 1e21, integers without a fraction
+    text = repr(float(value))
+    if 'e' in text:
+        if 1e-6 <= abs(value) < 1e21:
+            return format(Decimal(text), 'f')
+        mantissa, exponent = text.split('e')
+        mantissa = mantissa[:-2] if mantissa.endswith('.0') else mantissa
+        return f"{mantissa}e{'+' if int(exponent) > 0 else '-'}{abs(int(exponent))}"
+    return text[:-2] if text.endswith('.0') else text
+
+
+class OrderBook:
+    """
+    Incremental order book of one (exchange, symbol), built from the snapshots and deltas cryptofeed hands to
+    the book backends, or read back from a book-<exchange>-<symbol> stream (see load_book and follow_book).
+
+    L2 books keep their levels in a BookSide per side. L3 books (cryptofeed's {price: {order_id: size}}
+    snapshots and (order_id, price, size) deltas) also keep every order, in arrival order within its level,
+    while the BookSide arrays hold the level totals.
+
+    max_depth: int
+        Keep at most this many levels per side, 0 keeps every level.
+    """
+    def __init__(self, exchange: str = None, symbol: str = None, max_depth: int = 0):
+        self.exchange = exchange
+        self.symbol = symbol
+        self.sides = {BID: BookSide(BID, max_depth), ASK: BookSide(ASK, max_depth)}
+        # L3 only: per side {price: {order_id: size}} and order_id -> (side, price)
+        self.levels = None
+        self.orders = None
+        self.updates = 0
+
+    @property
+    def bids(self) -> BookSide:
+        return self.sides[BID]
+
+    @property
+    def asks(self) -> BookSide:
+        return self.sides[ASK]
+
+    @property
+    def l3(self) -> bool:
+        return self.levels is not None
+
+    def load(self, book: dict):
+        """
+        Replace the book with a snapshot, {'bid': {price: size}, 'ask': ...} or {'bid': {price: {order_id: size}}, ...}.
+        Prices may be strings, as they come back from JSON.
+        """
+        first = next((next(iter(levels.values())) for levels in book.values() if levels), None)
+        if isinstance(first, dict):
+            self.levels = {side: {} for side in self.sides}
+            self.orders = {}
+            for side, levels in book.items():
+                for price, orders in levels.items():
+                    price = float(price)
+                    self.levels[side][price] = {order_id: float(size) for order_id, size in orders.items()}
+                    for order_id in orders:
+                        self.orders[order_id] = (side, price)
+            for side, book_side in self.sides.items():
+                totals = self.levels[side]
+                book_side.load(list(totals), [sum(orders.values()) for orders in totals.values()])
+        else:
+            self.levels = self.orders = None
+            for side, book_side in self.sides.items():
+                levels = book.get(side) or {}
+                book_side.load(np.array(list(levels), dtype=np.float64), np.fromiter(levels.values(), dtype=np.float64, count=len(levels)))
+        self.updates += 1
+
+    def load_arrays(self, bids: np.ndarray, asks: np.ndarray):
+        """
+        Replace the book with an L2 snapshot given as (n, 2) arrays of (price, size), see StructCodec.decode_book_arrays.
+        """
+        self.levels = self.orders = None
+        self.bids.load(bids[:, 0], bids[:, 1])
+        self.asks.load(asks[:, 0], asks[:, 1])
+        self.updates += 1
+
+    def apply(self, delta: dict):
+        """
+        Apply a delta, {'bid': [(price, size), ...], 'ask': ...} or [(order_id, price, size), ...] per side for L3 books.
+        """
+        for side, entries in delta.items():
+            if not entries:
+                continue
+            if len(entries[0]) == 3:
+                self._apply_orders(side, entries)
+            else:
+                self.sides[side].update(*zip(*entries))
+        self.updates += 1
+
+    def apply_arrays(self, bids: np.ndarray, asks: np.ndarray):
+        """
+        Apply an L2 delta given as (n, 2) arrays of (price, size).
+        """
+        self.bids.update(bids[:, 0].tolist(), bids[:, 1].tolist())
+        self.asks.update(asks[:, 0].tolist(), asks[:, 1].tolist())
+        self.updates += 1
+
+    def _apply_orders(self, side: str, entries: list):
+        if self.levels is None:
+            self.levels = {s: {} for s in self.sides}
+            self.orders = {}
+        touched = {s: set() for s in self.sides}
+        for order_id, price, size in entries:
+            price, size = float(price), float(size)
+            previous = self.orders.pop(order_id, None)
+            if previous is not None:
+                previous_side, previous_price = previous
+                level = self.levels[previous_side].get(previous_price)
+                if level is not None:
+                    level.pop(order_id, None)
+                    touched[previous_side].add(previous_price)
+            if size > 0:
+                self.levels[side].setdefault(price, {})[order_id] = size
+                self.orders[order_id] = (side, price)
+                touched[side].add(price)
+        for touched_side, prices in touched.items():
+            if not prices:
+                continue
+            levels = self.levels[touched_side]
+            totals = []
+            for price in prices:
+                orders = levels.get(price)
+                if not orders:
+                    levels.pop(price, None)
+                totals.append(sum(orders.values()) if orders else 0.0)
+            self.sides[touched_side].update(list(prices), totals)
+
+    def update(self, update: dict):
+        """
+        Apply one update dict as written by the book backends: a snapshot under 'book' or a delta under 'delta'.
+        """
+        if update.get('book') is not None:
+            self.load(update['book'])
+        elif update.get('delta') is not None:
+            self.apply(update['delta'])
+
+    def top(self, depth: int = 10) -> dict:
+        """
+        {'bid': (prices, sizes), 'ask': (prices, sizes)} of the best depth levels of each side.
+        """
+        return {side: book_side.top(depth) for side, book_side in self.sides.items()}
+
+    def best(self):
+        """
+        ((bid price, bid size), (ask price, ask size)), either None when that side is empty.
+        """
+        return self.bids.best(), self.asks.best()
+
+    def mid(self) -> float:
+        bid, ask = self.bids.best(), self.asks.best()
+        if bid is None or ask is None:
+            return None
+        return (bid[0] + ask[0]) / 2
+
+    def to_dict(self, depth: int = None) -> dict:
+        """
+        The book as a snapshot in cryptofeed's format, best levels first, e.g. for the book backends.
+        """
+        book = {}
+        for side, book_side in self.sides.items():
+            prices, sizes = book_side.top(depth)
+            if self.levels is not None:
+                book[side] = {price: dict(self.levels[side][price]) for price in prices.tolist()}
+            else:
+                book[side] = dict(zip(prices.tolist(), sizes.tolist()))
+        return book
+
+    def checksum(self, depth: int = 25) -> int:
+        """
+        Bitfinex's book checksum: the signed CRC32 of the best depth entries of each side interleaved,
+        bid then ask, as "price:amount" (order_id:amount for L3 books), with ask amounts negative.
+        """
+        entries = {}
+        for side, book_side in self.sides.items():
+            if self.levels is not None:
+                orders = []
+                for price in book_side.top(depth)[0].tolist():
+                    orders.extend(self.levels[side][price].items())
+                    if len(orders) >= depth:
+                        break
+                entries[side] = [(str(order_id), size) for order_id, size in orders[:depth]]
+            else:
+                prices, sizes = book_side.top(depth)
+                entries[side] = [(_js_number(price), size) for price, size in zip(prices.tolist(), sizes.tolist())]
+        parts = []
+        for i in range(depth):
+            if i < len(entries[BID]):
+                key, size = entries[BID][i]
+                parts += [key, _js_number(size)]
+            if i < len(entries[ASK]):
+                key, size = entries[ASK][i]
+                parts += [key, _js_number(-size)]
+        checksum = zlib.crc32(':'.join(parts).encode())
+        return checksum - (1 << 32) if checksum >= 1 << 31 else checksum
+
+    def validate(self, checksum: int, depth: int = 25):
+        """
+        Raise cryptofeed's BadChecksum when the book does not match a checksum sent by the exchange.
+        """
+        if self.checksum(depth) != checksum:
+            raise BadChecksum(f"Checksum validation on {self.exchange} {self.symbol} book failed")
+
+
+_struct_codec = None
+
+
+def apply_entry(book: OrderBook, fields: dict):
+    """
+    Apply one book stream entry (or book-snap hash) as read from Redis, see redis_codecs.decode_stream_entry.
+    """
+    # packed L2 books of the struct codec are applied straight from the buffer
+    global _struct_codec
+    codec = fields.get('codec', fields.get(b'codec'))
+    if codec in ('struct', b'struct'):
+        for name in ('book', 'delta'):
+            data = fields.get(name, fields.get(name.encode()))
+            if data is not None and data[0] != StructCodec.PACKED:
+                if _struct_codec is None:
+                    _struct_codec = StructCodec()
+                kind, bids, asks = _struct_codec.decode_book_arrays(data)
+                if kind == StructCodec.SNAPSHOT:
+                    book.load_arrays(bids, asks)
+                else:
+                    book.apply_arrays(bids, asks)
+                return
+    book.update(decode_stream_entry(fields))
+
+
+def _decode_id(stream_id) -> str:
+    return stream_id.decode() if isinstance(stream_id, bytes) else stream_id
+
+
+def _id_key(stream_id: str) -> tuple:
+    milliseconds, _, sequence = stream_id.partition('-')
+    return int(milliseconds), int(sequence or 0)
+
+
+def entry_field(fields: dict, name: str):
+    # one field of a stream entry, read with or without decode_responses
+    value = fields.get(name, fields.get(name.encode()))
+    return value.decode() if isinstance(value, bytes) else value
+
+
+async def _load_keyframe(conn, book: OrderBook, stream: str, snap_key: str, page: int):
+    # the snapshot only helps when the stream still holds every entry after it
+    fields = await conn.hgetall(snap_key)
+    snap_id = entry_field(fields, 'stream_id') if fields else None
+    if snap_id is None:
+        return None
+    first = await conn.xrange(stream, min='-', max='+', count=1)
+    if first and _id_key(_decode_id(first[0][0])) > _id_key(snap_id):
+        logger.info(f"Snapshot {snap_key} at {snap_id} is older than {stream}, replaying from the stream")
+        return None
+    apply_entry(book, fields)
+    last_id = snap_id
+    while True:
+        entries = await conn.xrange(stream, min=f"({last_id}", max='+', count=page)
+        for stream_id, entry in entries:
+            apply_entry(book, entry)
+        if entries:
+            last_id = _decode_id(entries[-1][0])
+        if len(entries) < page:
+            return last_id
+
+
+async def load_book(conn, exchange: str, symbol: str, key: str = 'book', page: int = 1000, max_depth: int = 0, snap_key: str = 'book-snap'):
+    """
+    Rebuild the current book from a book stream written by CustomBookStream. When snap_key is set and a
+    keyframe written by snapshots.SnapshotService is found at <snap_key>-<exchange>-<symbol>, the book starts
+    from it and only the stream entries after its stream_id are replayed. Otherwise walk back to the newest
+    snapshot entry of the stream, then replay the deltas after it.
+    Returns (book, stream ID of the last entry applied); the book is empty when no snapshot is found.
+
+    conn:
+        A redis.asyncio client. Use decode_responses=False when the stream is written with a binary codec.
+    """
+    stream = f"{key}-{exchange}-{symbol}"
+    book = OrderBook(exchange, symbol, max_depth=max_depth)
+    if snap_key:
+        last_id = await _load_keyframe(conn, book, stream, f"{snap_key}-{exchange}-{symbol}", page)
+        if last_id is not None:
+            return book, last_id
+        book = OrderBook(exchange, symbol, max_depth=max_depth)
+    tail = []
+    last_id = None
+    upper = '+'
+    snapshot = None
+    while snapshot is None:
+        entries = await conn.xrevrange(stream, max=upper, min='-', count=page)
+        if not entries:
+            break
+        for stream_id, fields in entries:
+            if last_id is None:
+                last_id = _decode_id(stream_id)
+            if 'book' in fields or b'book' in fields:
+                snapshot = (stream_id, fields)
+                break
+            tail.append((stream_id, fields))
+        if len(entries) < page:
+            break
+        upper = f"({_decode_id(entries[-1][0])}"
+    if snapshot is None:
+        if last_id is not None:
+            logger.error(f"No snapshot in {stream}, {len(tail)} deltas cannot be replayed")
+        return book, last_id
+    apply_entry(book, snapshot[1])
+    for _, fields in reversed(tail):
+        apply_entry(book, fields)
+    return book, last_id
+
+
+async def follow_book(conn, book: OrderBook, last_id: str, key: str = 'book', block: int = 1000, count: int = 1000):
+    """
+    Keep book up to date with the entries written after last_id, yielding (stream ID, book) after every entry.
+    Start it with the result of load_book.
+    """
+    stream = f"{key}-{book.exchange}-{book.symbol}"
+    last_id = last_id or '$'
+    while True:
+        response = await conn.xread({stream: last_id}, block=block, count=count)
+        for _, entries in response or ():
+            for stream_id, fields in entries:
+                last_id = _decode_id(stream_id)
+                apply_entry(book, fields)
+                yield last_id, book
+
+
+async def load_books(conn, streams: list, key: str = 'book', snap_key: str = 'book-snap', max_depth: int = 0):
+    """
+    load_book for every (exchange, symbol) of streams. Returns ({stream key: book}, {stream key: last ID}),
+    ready for read_books.
+    """
+    books, last_ids = {}, {}
+    for exchange, symbol in streams:
+        stream = f"{key}-{exchange}-{symbol}"
+        books[stream], last_id = await load_book(conn, exchange, symbol, key=key, max_depth=max_depth, snap_key=snap_key)
+        # entries written later are read from the start of the stream when it does not exist yet
+        last_ids[stream] = last_id or '0-0'
+        logger.info(f"Loaded {stream} at {last_id}: {len(books[stream].bids)} bids, {len(books[stream].asks)} asks")
+    return books, last_ids
+
+
+async def read_books(conn, books: dict, last_ids: dict, block: int = 1000, count: int = 1000):
+    """
+    One XREAD over the streams of books (stream key -> OrderBook) after last_ids, which is advanced in place.
+    Yields (stream key, stream ID, fields) right after each entry is applied to its book, so the caller sees the
+    book as of every entry. Yields nothing when nothing was written for block milliseconds.
+    """
+    response = await conn.xread(last_ids, block=block, count=count)
+    for stream, entries in response or ():
+        stream = _decode_id(stream)
+        book = books[stream]
+        for stream_id, fields in entries:
+            stream_id = _decode_id(stream_id)
+            try:
+                apply_entry(book, fields)
+            except Exception as e:
+                logger.error(f"Error applying {stream} entry {stream_id}: {e}")
+            last_ids[stream] = stream_id
+            yield stream, stream_id, fields
@@ -0,0 +1,154 @@
+import struct
+from runtime import json
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class JsonCodec:
+    """
+    Default codec: JSON text, the format the Redis backends have always written.
+    """
+    name = 'json'
+
+    def dumps(self, update: dict):
+        return json.dumps(update)
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def encode_book(self, book):
+        return json.dumps(book)
+
+    def decode_book(self, data):
+        return json.loads(data)
+
+
+class MsgpackCodec(JsonCodec):
+    """
+    msgpack encoding of the whole update. Book price keys stay floats, so decoding needs strict_map_key=False.
+    """
+    name = 'msgpack'
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError("The msgpack codec needs the msgpack package")
+
+    def dumps(self, update: dict):
+        return msgpack.packb(update, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+    def encode_book(self, book):
+        return msgpack.packb(book, use_bin_type=True)
+
+    def decode_book(self, data):
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+
+class StructCodec(MsgpackCodec):
+    """
+    Fixed-layout binary encoding of L2 price levels, 16 bytes per level:
+
+        header  '<BII'  kind, number of bid levels, number of ask levels
+        body    float64 (price, size) pairs, bids then asks
+
+    kind is 0 for a snapshot ({price: size} per side) and 1 for a delta ([(price, size), ...] per side).
+    L3 books (orders nested under each price) do not fit the layout and are sent as msgpack with kind 2.
+    Everything that is not a book, like zset members, is msgpack encoded with the book/delta field packed as above.
+    """
+    name = 'struct'
+    header = struct.Struct('<BII')
+    SNAPSHOT, DELTA, PACKED = 0, 1, 2
+
+    def __init__(self):
+        super().__init__()
+        if np is None:
+            raise ImportError("The struct codec needs the numpy package")
+
+    def dumps(self, update: dict):
+        for field in ('book', 'delta'):
+            if isinstance(update.get(field), dict):
+                update = {**update, field: self.encode_book(update[field])}
+        return super().dumps(update)
+
+    def loads(self, data):
+        update = super().loads(data)
+        for field in ('book', 'delta'):
+            if isinstance(update.get(field), bytes):
+                update[field] = self.decode_book(update[field])
+        return update
+
+    def encode_book(self, book):
+        bids, asks = book.get('bid', {}), book.get('ask', {})
+        if isinstance(bids, dict):
+            first = next(iter(bids.values()), None) if bids else next(iter(asks.values()), None)
+            if isinstance(first, dict):
+                return self.header.pack(self.PACKED, 0, 0) + super().encode_book(book)
+            kind, bids, asks = self.SNAPSHOT, list(bids.items()), list(asks.items())
+        else:
+            if (bids and len(bids[0]) != 2) or (asks and len(asks[0]) != 2):
+                return self.header.pack(self.PACKED, 0, 0) + super().encode_book(book)
+            kind = self.DELTA
+        levels = np.array(bids + asks, dtype='<f8').reshape(-1, 2)
+        return self.header.pack(kind, len(bids), len(asks)) + levels.tobytes()
+
+    def decode_book_arrays(self, data):
+        """
+        Decode a packed L2 book without building python objects: returns (kind, bids, asks)
+        with bids and asks as read-only (n, 2) float64 arrays of (price, size) viewing the buffer.
+        """
+        kind, nbids, nasks = self.header.unpack_from(data)
+        if kind == self.PACKED:
+            raise ValueError("L3 books are not stored as level arrays")
+        levels = np.frombuffer(data, dtype='<f8', offset=self.header.size).reshape(-1, 2)
+        return kind, levels[:nbids], levels[nbids:nbids + nasks]
+
+    def decode_book(self, data):
+        kind = data[0]
+        if kind == self.PACKED:
+            return super().decode_book(data[self.header.size:])
+        kind, bids, asks = self.decode_book_arrays(data)
+        if kind == self.SNAPSHOT:
+            return {'bid': dict(bids.tolist()), 'ask': dict(asks.tolist())}
+        return {'bid': [tuple(level) for level in bids.tolist()], 'ask': [tuple(level) for level in asks.tolist()]}
+
+
+CODECS = {codec.name: codec for codec in (JsonCodec, MsgpackCodec, StructCodec)}
+
+
+def get_codec(name: str):
+    if name not in CODECS:
+        raise ValueError(f"Unknown codec {name!r}, expected one of {list(CODECS)}")
+    return CODECS[name]()
+
+
+def decode_stream_entry(fields: dict) -> dict:
+    """
+    Decode one entry read from a book stream (XREAD/XRANGE) back to the dict the writer received.
+    Entries written with a binary codec carry a 'codec' field, so the consumer does not need to know
+    which codec the producer used. Read the stream with decode_responses=False for binary codecs.
+    """
+    fields = {k.decode() if isinstance(k, bytes) else k: v for k, v in fields.items()}
+    name = fields.pop('codec', b'json')
+    codec = get_codec(name.decode() if isinstance(name, bytes) else name)
+    for field in ('book', 'delta'):
+        if field in fields:
+            fields[field] = codec.decode_book(fields[field])
+    for field, value in fields.items():
+        if isinstance(value, bytes) and field not in ('book', 'delta'):
+            fields[field] = value.decode()
+    return fields
+
+
+def decode_zset_member(member, codec: str = 'json') -> dict:
+    """
+    Decode one member read from a zset backend (ZRANGE). The codec must match the producer's.
+    """
+    return get_codec(codec).loads(member)
@@ -0,0 +1,134 @@
+from collections import deque
+import logging
+import os
+import pickle
+import sys
+logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)s:%(levelname)s:%(message)s')
+
+OVERFLOW_POLICIES = ('drop-oldest', 'spill')
+
+
+class RetryBuffer:
+    """
+    Bounded FIFO of updates a writer could not deliver yet.
+
+    The writer appends every batch it reads from its queue, then takes the oldest rows with peek()
+    and removes them with commit() once they are written, so a failed write leaves the buffer untouched
+    and rows go out in the order they arrived. When more than max_rows are held in memory the oldest
+    rows are either dropped ('drop-oldest') or appended to a spill file ('spill'), which is read back
+    before the rows still in memory. A spill file left over by a previous run is replayed first.
+    """
+    def __init__(self, max_rows: int = 100000, overflow: str = 'drop-oldest', spill_path: str = None, spill_max_bytes: int = 1 << 30):
+        """
+        max_rows: int
+            Rows kept in memory.
+        overflow: str
+            'drop-oldest' or 'spill'.
+        spill_path: str
+            File holding the spilled rows, required for 'spill'. Must not be shared with another writer.
+        spill_max_bytes: int
+            Once the spill file reaches this size further overflow is dropped.
+        """
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {overflow!r}, expected one of {OVERFLOW_POLICIES}")
+        if overflow == 'spill' and not spill_path:
+            raise ValueError("The spill overflow policy needs a spill_path")
+        self.max_rows = max_rows
+        self.overflow = overflow
+        self.spill_path = spill_path
+        self.spill_max_bytes = spill_max_bytes
+        self.rows = deque()
+        self.dropped = 0
+        self.spilled = 0
+        # rows still in the spill file, and the file offset of the first of them
+        self.spill_rows = 0
+        self._spill_offset = 0
+        self._peeked = None
+        if spill_path and os.path.exists(spill_path):
+            self.spill_rows = self._count_spilled()
+            if self.spill_rows:
+                logging.info(f"Replaying {self.spill_rows} rows spilled to {spill_path} by a previous run")
+
+    def __len__(self):
+        return len(self.rows) + self.spill_rows
+
+    def _count_spilled(self) -> int:
+        count = good = 0
+        size = os.path.getsize(self.spill_path)
+        with open(self.spill_path, 'rb') as f:
+            while good < size:
+                try:
+                    pickle.load(f)
+                except Exception as e:
+                    # a row cut short by a crash mid-write, drop it and anything after it
+                    logging.error(f"Truncating spill file {self.spill_path} after {count} rows: {e}")
+                    break
+                count += 1
+                good = f.tell()
+        if good < size:
+            os.truncate(self.spill_path, good)
+        return count
+
+    def append(self, updates: list):
+        self.rows.extend(updates)
+        excess = len(self.rows) - self.max_rows
+        if excess <= 0:
+            return
+        if self.overflow == 'spill':
+            excess -= self._spill(excess)
+        for _ in range(excess):
+            self.rows.popleft()
+        self.dropped += excess
+
+    def _spill(self, count: int) -> int:
+        if self.spill_rows:
+            size = os.path.getsize(self.spill_path)
+        else:
+            # every spilled row was replayed, start the file over
+            size = self._spill_offset = 0
+        written = 0
+        with open(self.spill_path, 'ab' if self.spill_rows else 'wb') as f:
+            while written < count and size < self.spill_max_bytes:
+                size += f.write(pickle.dumps(self.rows.popleft(), protocol=pickle.HIGHEST_PROTOCOL))
+                written += 1
+        self.spill_rows += written
+        self.spilled += written
+        return written
+
+    def spill_pending(self) -> int:
+        """
+        Move every row held in memory to the spill file, for a writer shutting down with undelivered rows.
+        """
+        return self._spill(len(self.rows))
+
+    def peek(self, max_rows: int) -> list:
+        """
+        Oldest rows, at most max_rows. They stay in the buffer until commit().
+        """
+        if self.spill_rows:
+            batch = []
+            with open(self.spill_path, 'rb') as f:
+                f.seek(self._spill_offset)
+                while len(batch) < min(max_rows, self.spill_rows):
+                    batch.append(pickle.load(f))
+                self._peeked = f.tell()
+            return batch
+        self._peeked = None
+        return [self.rows[i] for i in range(min(max_rows, len(self.rows)))]
+
+    def commit(self, count: int):
+        """
+        Remove the count rows returned by the last peek().
+        """
+        if self.spill_rows:
+            self.spill_rows -= count
+            self._spill_offset = self._peeked
+            if not self.spill_rows:
+                os.remove(self.spill_path)
+                self._spill_offset = 0
+            return
+        for _ in range(count):
+            self.rows.popleft()
+
+    def stats(self) -> str:
+        return f"{len(self.rows)} rows in memory, {self.spill_rows} spilled, {self.spilled} spilled and {self.dropped} dropped in total"
@@ -0,0 +1,242 @@
+from collections import defaultdict
+from multiprocessing import shared_memory
+import asyncio
+import multiprocessing
+import logging
+import pickle
+import struct
+import sys
+import time
+from cryptofeed.backends.backend import BackendBookCallback, BackendCallback
+from service import fan_out
+logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)s:%(levelname)s:%(message)s')
+
+# Header: producer fields and the consumer field on separate cache lines, data after it.
+# '@Q' packs with a plain aligned 8 byte memcpy, so a counter is never seen half written.
+COUNTER = struct.Struct('@Q')
+# seconds either side waits for the counter lock before giving up, see SharedRing.put
+LOCK_TIMEOUT = 0.1
+HEAD, DROPPED, TAIL = 0, 8, 64
+HEADER_SIZE = 128
+LENGTH = struct.Struct('@I')
+# length of the filler record written when a record does not fit before the end of the buffer
+WRAP = 0xFFFFFFFF
+
+
+def _aligned(size: int) -> int:
+    return (size + 7) & ~7
+
+
+class SharedRing:
+    """
+    Single producer, single consumer ring buffer of pickled updates in a shared memory block.
+
+    head and tail are byte counters that only grow: the producer writes a record and then publishes it by
+    moving head, the consumer reads records up to head and then frees them by moving tail. Each counter has
+    a single writer, but plain stores to shared memory are not ordered across cores on weakly ordered CPUs
+    such as ARM: the consumer could see a new head before the record bytes behind it. So both counters are
+    only read and written while holding lock, a process-shared semaphore whose acquire and release are full
+    memory barriers, which orders every record write before the head that publishes it and every record read
+    before the tail that frees its space. The lock is held for the counter access only, never while a record
+    is copied or unpickled.
+
+    A full ring never blocks the producer, which is a feed's event loop: the update is dropped and counted
+    instead. The same goes for a lock that cannot be taken within LOCK_TIMEOUT, which only happens when the
+    other side was killed inside its few instructions under the lock.
+
+    The ring is created by the parent process and inherited by forked children, which keeps it alive across
+    restarts of the feed and writer processes: updates still in the ring when the writer restarts are read by
+    the new writer from tail. Updates the old writer had already moved into its backends' queues are lost with
+    it, which drain() bounds by not reading the ring while those queues are full.
+    """
+    def __init__(self, name: str, capacity: int = 64 << 20, create: bool = True, lock=None):
+        """
+        name: str
+            Name of the shared memory block.
+        capacity: int
+            Bytes of record data the ring holds, rounded up to a multiple of 8.
+        create: bool
+            Create the block (zeroed) rather than attach to an existing one.
+        lock: multiprocessing.Lock
+            Orders the counter updates between the two processes. Defaults to a new lock, which is what the
+            creating handle wants; a handle attached with create=False must be given the creator's lock to
+            read or write records, and may leave it out to only close and unlink the block.
+        """
+        capacity = _aligned(capacity)
+        self.name = name
+        self.shm = shared_memory.SharedMemory(name=name, create=create, size=HEADER_SIZE + capacity if create else 0)
+        self.buf = self.shm.buf
+        self.capacity = capacity if create else _aligned(self.shm.size - HEADER_SIZE - 7)
+        self.lock = lock if lock is not None else multiprocessing.Lock()
+        self._dropped_reported = 0
+        # tail after the records returned by the last peek()
+        self._next = None
+
+    def _get(self, offset: int) -> int:
+        return COUNTER.unpack_from(self.buf, offset)[0]
+
+    def _set(self, offset: int, value: int):
+        COUNTER.pack_into(self.buf, offset, value)
+
+    def _drop(self) -> bool:
+        # only the producer writes the drop counter, the consumer just reports it
+        self._set(DROPPED, self._get(DROPPED) + 1)
+        return False
+
+    @property
+    def dropped(self) -> int:
+        return self._get(DROPPED)
+
+    def __len__(self):
+        """
+        Bytes waiting to be read.
+        """
+        with self.lock:
+            return self._get(HEAD) - self._get(TAIL)
+
+    def put(self, update) -> bool:
+        """
+        Producer side: append one update. Returns False when the ring is full and the update was dropped.
+        """
+        payload = pickle.dumps(update, protocol=pickle.HIGHEST_PROTOCOL)
+        size = _aligned(LENGTH.size + len(payload))
+        # head is only written by this side, tail is read under the lock so the space it frees is really free
+        if not self.lock.acquire(timeout=LOCK_TIMEOUT):
+            return self._drop()
+        try:
+            head, tail = self._get(HEAD), self._get(TAIL)
+        finally:
+            self.lock.release()
+        index = head % self.capacity
+        # a record never wraps around: skip the rest of the buffer when it does not fit there
+        skip = self.capacity - index if self.capacity - index < size else 0
+        if size + skip > self.capacity - (head - tail):
+            return self._drop()
+        if skip:
+            LENGTH.pack_into(self.buf, HEADER_SIZE + index, WRAP)
+            head += skip
+            index = 0
+        start = HEADER_SIZE + index
+        LENGTH.pack_into(self.buf, start, len(payload))
+        self.buf[start + LENGTH.size:start + LENGTH.size + len(payload)] = payload
+        # publish: the release makes the record visible to the consumer before the new head
+        if not self.lock.acquire(timeout=LOCK_TIMEOUT):
+            return self._drop()
+        try:
+            self._set(HEAD, head + size)
+        finally:
+            self.lock.release()
+        return True
+
+    def peek(self, max_updates: int = 1000) -> list:
+        """
+        Consumer side: up to max_updates updates, oldest first. They stay in the ring until commit().
+        """
+        if not self.lock.acquire(timeout=LOCK_TIMEOUT):
+            logging.error(f"Ring buffer {self.name}: counter lock not available, retrying")
+            return []
+        try:
+            head, tail = self._get(HEAD), self._get(TAIL)
+        finally:
+            self.lock.release()
+        updates = []
+        while tail < head and len(updates) < max_updates:
+            index = tail % self.capacity
+            start = HEADER_SIZE + index
+            length = LENGTH.unpack_from(self.buf, start)[0]
+            if length == WRAP:
+                tail += self.capacity - index
+                continue
+            updates.append(pickle.loads(self.buf[start + LENGTH.size:start + LENGTH.size + length]))
+            tail += _aligned(LENGTH.size + length)
+        self._next = tail
+        return updates
+
+    def commit(self):
+        """
+        Consumer side: free the space of the updates returned by the last peek().
+        """
+        if self._next is None:
+            return
+        # the acquire orders the record reads of peek() before the producer can see their space freed
+        with self.lock:
+            self._set(TAIL, self._next)
+        self._next = None
+
+    def get_many(self, max_updates: int = 1000) -> list:
+        """
+        Consumer side: remove and return up to max_updates updates, oldest first.
+        """
+        updates = self.peek(max_updates)
+        self.commit()
+        return updates
+
+    def report_drops(self):
+        dropped = self.dropped
+        if dropped > self._dropped_reported:
+            logging.error(f"Ring buffer {self.name} full, dropped {dropped - self._dropped_reported} updates")
+            self._dropped_reported = dropped
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+class RingBufferCallback(BackendCallback):
+    """
+    Feed side of a ring: takes the place of the storage backends of a channel and publishes the update
+    dicts they would have received, without a queue or writer task. drain() feeds them to the real backends
+    in a writer process.
+    """
+    def __init__(self, ring: SharedRing, numeric_type=float, none_to=None):
+        self.ring = ring
+        self.numeric_type = numeric_type
+        self.none_to = none_to
+
+    async def write(self, data: dict):
+        self.ring.put(data)
+
+
+class RingBufferBookCallback(RingBufferCallback, BackendBookCallback):
+    def __init__(self, ring: SharedRing, snapshots_only=False, snapshot_interval=10000, **kwargs):
+        self.snapshots_only = snapshots_only
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_count = defaultdict(int)
+        super().__init__(ring, **kwargs)
+
+
+def pending(sinks: list) -> int:
+    """
+    Most updates waiting in the queue of any of sinks, started BackendQueue backends.
+    """
+    return max((sink.queue.qsize() for sink in sinks if isinstance(getattr(sink, 'queue', None), asyncio.Queue)), default=0)
+
+
+async def drain(ring: SharedRing, sinks: list, max_batch: int = 1000, idle: float = 0.001, report_interval: float = 60.0, max_pending: int = 10000):
+    """
+    Writer side: move updates from ring into the queues of sinks, started storage backends such as
+    CustomBookStream and BookTimeScale, polling every idle seconds while the ring is empty.
+    Every sink gets its own copy of the update dict, as a feed would have built one per callback.
+
+    The backend queues are unbounded, so while any of them holds max_pending updates or more the ring is
+    left alone: a slow database fills the ring, which drops on the feed side, instead of growing the writer's
+    memory, and at most about max_pending updates per sink are lost if the writer dies. The space of a batch
+    is only freed once the batch is in the queues.
+    """
+    report = time.time()
+    while True:
+        if pending(sinks) >= max_pending:
+            await asyncio.sleep(idle)
+            continue
+        updates = ring.peek(max_batch)
+        for update in updates:
+            await fan_out(sinks, update)
+        ring.commit()
+        # writing to the backend queues does not yield, so give their writer tasks a turn
+        await asyncio.sleep(0 if updates else idle)
+        if time.time() - report >= report_interval:
+            ring.report_drops()
+            report = time.time()
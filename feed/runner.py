@@ -0,0 +1,256 @@
+from cryptofeed import FeedHandler
+from cryptofeed.config import Config
+from cryptofeed.defines import L2_BOOK, L3_BOOK, TRADES, FUNDING, OPEN_INTEREST, LIQUIDATIONS
+import asyncio
+import importlib
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import time
+import runtime
+from ring_buffer import SharedRing, RingBufferCallback, RingBufferBookCallback, drain
+logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)s:%(levelname)s:%(message)s')
+logger = logging.getLogger(__name__)
+
+PATH_TO_CONFIG = '/config_cf.yaml'
+
+# Feed modules run by the launcher: each exposes add_feeds(fh, symbols, channels, shard). Every entry gives
+# the config key of the module's symbols and its channel groups; a group opens its own connections, so
+# the book and the trades of the same symbols can run on different cores.
+EXCHANGES = {
+    'binance': ('bn_symbols', ((L2_BOOK,), (TRADES,))),
+    'bitfinex': ('bf_symbols', ((L3_BOOK,), (TRADES,))),
+    'binancefutures': ('bnf_symbols', ((L2_BOOK,), (TRADES,), (FUNDING, OPEN_INTEREST, LIQUIDATIONS))),
+}
+# Relative cost per symbol of a channel group, keyed on its first channel, used to balance the workers
+WEIGHTS = {L2_BOOK: 4, L3_BOOK: 6}
+BOOK_CHANNELS = (L2_BOOK, L3_BOOK)
+
+
+def plan_shards(config: dict, group_size: int = 20, exchanges: list = None) -> list:
+    """
+    Split every (exchange, channel group) into shards of at most group_size symbols.
+    A shard is a (name, module, channels, symbols) tuple; the name is stable as long as the symbol
+    lists do not change, and also names the shard's spill log directory.
+    """
+    shards = []
+    for exchange, (key, groups) in EXCHANGES.items():
+        if exchanges and exchange not in exchanges:
+            continue
+        symbols = config.get(key) or []
+        for channels in groups:
+            for start in range(0, len(symbols), group_size):
+                shards.append((f"{exchange}-{channels[0]}-{start // group_size}", exchange, channels, symbols[start:start + group_size]))
+    return shards
+
+
+def assign_shards(shards: list, processes: int) -> list:
+    # heaviest shard first onto the least loaded worker
+    workers = [[] for _ in range(processes)]
+    load = [0] * processes
+    for shard in sorted(shards, key=lambda s: -WEIGHTS.get(s[2][0], 1) * len(s[3])):
+        index = load.index(min(load))
+        workers[index].append(shard)
+        load[index] += WEIGHTS.get(shard[2][0], 1) * len(shard[3])
+    return workers
+
+
+async def beat(heartbeat, interval: float = 1.0):
+    # a blocked event loop stops the heartbeat, which the supervisor treats like a crash
+    while True:
+        heartbeat.value = time.time()
+        await asyncio.sleep(interval)
+
+
+def ring_sinks(rings: dict, name: str):
+    def sinks(channel):
+        ring = rings[(name, channel)]
+        return [RingBufferBookCallback(ring) if channel in BOOK_CHANNELS else RingBufferCallback(ring)]
+    return sinks
+
+
+def _init_process(role: str, index: int, core: int):
+    # the supervisor's handlers are inherited over fork, the FeedHandler installs its own
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    if core is not None and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, {core})
+    logger.info(f"{role} {index} (pid {os.getpid()}) on core {core}")
+
+
+def run_worker(index: int, shards: list, rings: dict, core: int, heartbeat):
+    """
+    Feed process: one FeedHandler event loop running the feeds of its shards, pinned to core.
+    With rings, the storage backends are replaced by ring buffer producers drained by run_writer.
+    """
+    _init_process('Worker', index, core)
+    fh = FeedHandler(config=PATH_TO_CONFIG)
+    runtime.setup()
+    fh.run(start_loop=False)
+    for name, exchange, channels, symbols in shards:
+        importlib.import_module(exchange).add_feeds(fh, symbols, channels=channels, shard=name, sinks=ring_sinks(rings, name) if rings else None)
+    loop = asyncio.get_event_loop()
+    loop.create_task(beat(heartbeat))
+    try:
+        loop.run_forever()
+    except SystemExit:
+        logger.info(f"Worker {index} shutting down")
+    finally:
+        # flush the backend queues like FeedHandler.run does
+        fh.stop(loop=loop)
+        fh.close(loop=loop)
+
+
+def run_writer(index: int, shards: list, rings: dict, core: int, heartbeat):
+    """
+    Writer process of feed worker index: drains the rings of its shards into the Redis and TimescaleDB
+    backends the feeds would otherwise run inline, so slow storage does not delay the feed loop.
+    """
+    _init_process('Writer', index, core)
+    # only used for its config, it runs no feed
+    fh = FeedHandler(config=PATH_TO_CONFIG)
+    runtime.setup()
+    loop = asyncio.get_event_loop()
+    sinks = []
+    for name, exchange, channels, symbols in shards:
+        module = importlib.import_module(exchange)
+        for channel in channels:
+            backends = module.backends(fh, channel, name)
+            if not backends:
+                continue
+            for backend in backends:
+                backend.start(loop)
+            sinks.extend(backends)
+            loop.create_task(drain(rings[(name, channel)], backends))
+    loop.create_task(beat(heartbeat))
+
+    def handle_stop_signals(*args):
+        raise SystemExit
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, handle_stop_signals)
+    try:
+        loop.run_forever()
+    except SystemExit:
+        logger.info(f"Writer {index} shutting down")
+    finally:
+        loop.run_until_complete(asyncio.gather(*(sink.stop() for sink in sinks), return_exceptions=True))
+        fh.close(loop=loop)
+
+
+class Supervisor:
+    """
+    Starts one process per job, a (target, args) pair called as target(*args, core, heartbeat), and
+    restarts processes that exit or whose event loop stops beating for stall_timeout seconds. Restarts
+    back off exponentially up to restart_backoff_max seconds while a process keeps dying within a
+    minute of starting. Job i is pinned to cores[i % len(cores)].
+    """
+    def __init__(self, jobs: list, cores: list, stall_timeout: float = 30.0, restart_backoff_max: float = 60.0):
+        self.jobs = jobs
+        self.cores = cores
+        self.stall_timeout = stall_timeout
+        self.restart_backoff_max = restart_backoff_max
+        self.processes = [None] * len(jobs)
+        self.heartbeats = [multiprocessing.Value('d', 0.0, lock=False) for _ in jobs]
+        self.started = [0.0] * len(jobs)
+        self.backoff = [1.0] * len(jobs)
+        self.restart_at = [0.0] * len(jobs)
+        self.restarts = [0] * len(jobs)
+        self.running = True
+
+    def start(self, index: int):
+        core = self.cores[index % len(self.cores)] if self.cores else None
+        target, args = self.jobs[index]
+        self.heartbeats[index].value = time.time()
+        process = multiprocessing.Process(target=target, args=(*args, core, self.heartbeats[index]), name=f"{target.__name__}-{index}", daemon=False)
+        process.start()
+        self.processes[index] = process
+        self.started[index] = time.time()
+
+    def check(self, index: int):
+        process = self.processes[index]
+        now = time.time()
+        if process is None:
+            if now >= self.restart_at[index]:
+                self.restarts[index] += 1
+                logger.info(f"Restarting process {index} (restart {self.restarts[index]})")
+                self.start(index)
+            return
+        if process.is_alive():
+            if now - self.heartbeats[index].value < self.stall_timeout:
+                return
+            logger.error(f"Process {index} (pid {process.pid}) has not beaten for {now - self.heartbeats[index].value:.0f}s, killing it")
+            process.kill()
+        process.join()
+        logger.error(f"Process {index} (pid {process.pid}) exited with code {process.exitcode}")
+        # a worker that ran for a while gets restarted quickly, one that keeps crashing backs off
+        self.backoff[index] = 1.0 if now - self.started[index] > 60 else min(self.backoff[index] * 2, self.restart_backoff_max)
+        self.restart_at[index] = now + self.backoff[index]
+        self.processes[index] = None
+
+    def stop(self, *args):
+        self.running = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for index in range(len(self.jobs)):
+            self.start(index)
+        while self.running:
+            for index in range(len(self.jobs)):
+                self.check(index)
+            time.sleep(1)
+        logger.info('Stopping feed processes')
+        for process in self.processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            if process is not None:
+                process.join(timeout=30)
+                if process.is_alive():
+                    process.kill()
+
+
+def main():
+    logger.info('Starting sharded feed runner')
+    config = Config(config=PATH_TO_CONFIG).config
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else []
+    shards = plan_shards(config, group_size=config.get('runner_group_size', 20), exchanges=config.get('runner_exchanges'))
+    if not shards:
+        logger.error('No symbols configured, nothing to run')
+        return
+    processes = min(config.get('runner_processes') or len(cores) or 1, len(shards))
+    assignments = assign_shards(shards, processes)
+    for index, assigned in enumerate(assignments):
+        logger.info(f"Worker {index}: {', '.join(f'{name} ({len(symbols)} symbols)' for name, _, _, symbols in assigned)}")
+    # runner_ring_buffer_bytes moves storage into one writer process per feed worker, fed through
+    # one shared memory ring per (shard, channel); the rings outlive restarts of either side
+    ring_bytes = config.get('runner_ring_buffer_bytes')
+    rings = {}
+    if ring_bytes:
+        for name, exchange, channels, symbols in shards:
+            for channel in channels:
+                ring_name = f"statarb-{name}-{channel}"
+                try:
+                    # left behind by a runner that did not shut down cleanly
+                    stale = SharedRing(ring_name, create=False)
+                    stale.close()
+                    stale.unlink()
+                    logger.info(f"Removed stale ring buffer {ring_name}")
+                except FileNotFoundError:
+                    pass
+                rings[(name, channel)] = SharedRing(ring_name, capacity=ring_bytes)
+    jobs = [(run_worker, (index, assigned, rings)) for index, assigned in enumerate(assignments)]
+    if rings:
+        jobs += [(run_writer, (index, assigned, rings)) for index, assigned in enumerate(assignments)]
+    try:
+        Supervisor(jobs, cores, stall_timeout=config.get('runner_stall_timeout', 30.0)).run()
+    finally:
+        for ring in rings.values():
+            ring.close()
+            ring.unlink()
+
+
+if __name__ == '__main__':
+    main()
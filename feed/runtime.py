@@ -0,0 +1,116 @@
+from decimal import Decimal
+import asyncio
+import logging
+import os
+import sys
+logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)s:%(levelname)s:%(message)s')
+
+# STATARB_RUNTIME=fast selects the fast profile: uvloop event loop and the fastest JSON codec available
+# (orjson, then yapic, then the standard library). The default profile keeps yapic and leaves the event loop
+# to the FeedHandler's `uvloop` config key.
+# The codec is picked when this module is first imported, so the variable must be set before the feed starts.
+PROFILES = ('default', 'fast')
+PROFILE = os.environ.get('STATARB_RUNTIME', 'default')
+if PROFILE not in PROFILES:
+    raise ValueError(f"STATARB_RUNTIME must be one of {PROFILES}, got {PROFILE!r}")
+
+
+class OrjsonCodec:
+    """
+    orjson behind the json.dumps/json.loads interface of yapic and the standard library.
+    Book snapshots are keyed by float prices, hence OPT_NON_STR_KEYS; Decimals are written as the same
+    JSON numbers yapic writes.
+    """
+    name = 'orjson'
+
+    def __init__(self, orjson):
+        self.orjson = orjson
+        self.option = orjson.OPT_NON_STR_KEYS
+
+    def _default(self, value):
+        if isinstance(value, Decimal):
+            return self.orjson.Fragment(str(value))
+        raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+    def dumps(self, value) -> str:
+        return self.orjson.dumps(value, default=self._default, option=self.option).decode()
+
+    def loads(self, data):
+        return self.orjson.loads(data)
+
+
+class ModuleCodec:
+    """
+    A json module (yapic.json or the standard library json) with a name for the startup report.
+    """
+    def __init__(self, name: str, module):
+        self.name = name
+        self.dumps = module.dumps
+        self.loads = module.loads
+
+
+def _select_json(profile: str):
+    if profile == 'fast':
+        try:
+            import orjson
+            if hasattr(orjson, 'Fragment'):
+                return OrjsonCodec(orjson)
+        except ImportError:
+            pass
+    try:
+        from yapic import json as yapic_json
+        return ModuleCodec('yapic', yapic_json)
+    except ImportError:
+        import json as std_json
+        return ModuleCodec('json', std_json)
+
+
+# the single JSON codec of the process, imported by the backends as `from runtime import json`
+json = _select_json(PROFILE)
+
+
+def _uvloop_version():
+    try:
+        import uvloop
+        return uvloop.__version__
+    except ImportError:
+        return None
+
+
+def setup(profile: str = None) -> dict:
+    """
+    Apply the runtime profile to the current process and log which accelerations are active.
+    Call it once the FeedHandler exists, as the FeedHandler installs uvloop on its own when the
+    `uvloop` key of its config is set, and before the event loop is created.
+    Returns the report that was logged.
+    """
+    profile = profile or PROFILE
+    if profile == 'fast':
+        try:
+            import uvloop
+            if not isinstance(asyncio.get_event_loop_policy(), uvloop.EventLoopPolicy):
+                asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        except ImportError:
+            logging.error("Fast runtime requested but uvloop is not installed, using the asyncio event loop")
+    active = report(profile)
+    logging.info(f"Runtime profile {profile}: " + ', '.join(f"{k} {v}" for k, v in active.items()))
+    return active
+
+
+def report(profile: str = None) -> dict:
+    """
+    The accelerations in use: event loop, JSON codec, and whether cryptofeed's data types are compiled.
+    """
+    try:
+        import cryptofeed.types
+        types = 'compiled' if cryptofeed.types.__file__.endswith(('.so', '.pyd')) else 'pure python'
+    except ImportError:
+        types = 'missing'
+    policy = asyncio.get_event_loop_policy()
+    return {
+        'profile': profile or PROFILE,
+        'python': sys.version.split()[0],
+        'event loop': f"uvloop {_uvloop_version()}" if type(policy).__module__.startswith('uvloop') else 'asyncio',
+        'json': json.name,
+        'cryptofeed types': types,
+    }
@@ -0,0 +1,64 @@
+from cryptofeed.config import Config
+import asyncio
+import logging
+import sys
+import runtime
+logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)s:%(levelname)s:%(message)s')
+logger = logging.getLogger(__name__)
+
+PATH_TO_CONFIG = '/config_cf.yaml'
+
+
+async def fan_out(sinks: list, update: dict):
+    """
+    Write update to every sink. The backends add fields to the dict they are handed, so every sink but the last
+    gets its own copy. Nothing is written when sinks is empty.
+    """
+    for sink in sinks[:-1]:
+        await sink.write(dict(update))
+    if sinks:
+        await sinks[-1].write(update)
+
+
+def redis_args(config: dict) -> dict:
+    # connection arguments of the Redis backends of the services
+    return {'host': config['redis_host'], 'port': config['redis_port'], 'password': config['redis_password'], 'ssl': True}
+
+
+def timescale_args(config: dict) -> dict:
+    # connection arguments and write mode of the TimescaleDB backends of the services
+    return {'host': config['pg_host'], 'user': 'postgres', 'db': 'db0', 'pw': config['timescaledb_password'], 'port': '5432',
+            'write_mode': config.get('timescaledb_write_mode', 'insert')}
+
+
+def run_service(name: str, build, path: str = PATH_TO_CONFIG):
+    """
+    The main() of the services following the book streams (snapshots, spreads, hedge, basis): load the config,
+    apply the runtime profile, build the service, start its backends and run it until interrupted, then stop it.
+
+    build:
+        Called with the config dict, returns (service, backends to start), or None when there is nothing to run.
+        The service has an async run(), a running flag and an async stop() that stops its backends.
+    """
+    logger.info(f"Starting {name}")
+    try:
+        config = Config(config=path).config
+        runtime.setup()
+        built = build(config)
+        if built is None:
+            return
+        service, backends = built
+        # after runtime.setup, so the loop comes from the uvloop policy of the fast profile
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        for backend in backends:
+            backend.start(loop)
+        try:
+            loop.run_until_complete(service.run())
+        except KeyboardInterrupt:
+            logger.info(f"Stopping {name}")
+        finally:
+            service.running = False
+            loop.run_until_complete(service.stop())
+    except Exception as e:
+        logger.error(f"An error occurred: {e}")
@@ -0,0 +1,157 @@
+from cryptofeed.defines import BINANCE, BINANCE_FUTURES, BITFINEX
+import asyncio
+import logging
+import sys
+import time
+from Custom_Redis import CustomBookSnapshotRedis, RETRYABLE_ERRORS
+from custom_timescaledb import BookSnapshotTimeScale
+from orderbook import entry_field, load_books, read_books
+from service import fan_out, redis_args, run_service, timescale_args
+logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)s:%(levelname)s:%(message)s')
+logger = logging.getLogger(__name__)
+
+# exchange id in the stream keys of the feed modules that write books, see runner.EXCHANGES
+FEEDS = {'binance': BINANCE, 'bitfinex': BITFINEX, 'binancefutures': BINANCE_FUTURES}
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class SnapshotService:
+    """
+    Book keyframes: follows the book-<exchange>-<symbol> streams written by CustomBookStream, keeps every book
+    up to date with an orderbook.OrderBook, and hands a full snapshot to sinks every interval seconds or every count
+    updates, whichever comes first, as long as the book changed. A snapshot is an update dict like the book
+    backends receive, {'exchange', 'symbol', 'book', 'timestamp', 'receipt_timestamp'}, plus stream_id, the ID
+    of the last stream entry folded into it. With CustomBookSnapshotRedis and BookSnapshotTimeScale as sinks a
+    reader starts from one snapshot and replays at most count deltas, instead of up to the feed's
+    snapshot_interval (see orderbook.load_book).
+
+    streams: list
+        (exchange, symbol) pairs to follow.
+    redis: CustomBookSnapshotRedis
+        Writes the snapshots to Redis; its connection is also used to read the streams, so give it
+        decode_responses=False when the streams are written with a binary codec.
+    sinks: list
+        Other started backends the snapshots are written to, such as BookSnapshotTimeScale.
+    depth: int
+        Levels per side kept in the snapshots, 0 for the whole book.
+    """
+    def __init__(self, streams: list, redis: CustomBookSnapshotRedis, sinks: list = (), key: str = 'book', interval: float = 60.0, count: int = 1000,
+                 depth: int = 0, block: int = 1000, read_count: int = 1000, retry_backoff: float = 1.0, retry_backoff_max: float = 30.0):
+        self.streams = streams
+        self.redis = redis
+        self.sinks = [redis, *sinks]
+        self.key = key
+        self.interval = interval
+        self.count = count
+        self.depth = depth
+        self.block = block
+        self.read_count = read_count
+        self.retry_backoff = retry_backoff
+        self.retry_backoff_max = retry_backoff_max
+        # per stream key: the book, the ID and receipt time of its last entry, and updates since the last snapshot
+        self.books = {}
+        self.last_ids = {}
+        self.receipts = {}
+        self.pending = {}
+        self.written = {}
+        self.snapshots = 0
+        self.running = True
+
+    async def load(self, conn):
+        """
+        Rebuild every book, from its previous snapshot when there is one.
+        """
+        self.books, self.last_ids = await load_books(conn, self.streams, key=self.key, snap_key=self.redis.key)
+        for stream in self.books:
+            self.pending[stream] = 0
+            self.written[stream] = time.time()
+
+    def snapshot(self, stream: str) -> dict:
+        book = self.books[stream]
+        receipt = self.receipts.get(stream) or time.time()
+        return {
+            'exchange': book.exchange,
+            'symbol': book.symbol,
+            'book': book.to_dict(self.depth or None),
+            'timestamp': receipt,
+            'receipt_timestamp': receipt,
+            'stream_id': self.last_ids[stream],
+        }
+
+    async def write_due(self, now: float):
+        for stream, pending in self.pending.items():
+            if not pending or (pending < self.count and now - self.written[stream] < self.interval):
+                continue
+            if not self.books[stream].bids and not self.books[stream].asks:
+                # nothing to start from yet, the stream has no snapshot entry
+                continue
+            await fan_out(self.sinks, self.snapshot(stream))
+            self.pending[stream] = 0
+            self.written[stream] = now
+            self.snapshots += 1
+
+    async def follow(self, conn):
+        while self.running:
+            async for stream, _, fields in read_books(conn, self.books, self.last_ids, block=self.block, count=self.read_count):
+                self.receipts[stream] = _float(entry_field(fields, 'receipt_timestamp'))
+                self.pending[stream] += 1
+            await self.write_due(time.time())
+
+    async def run(self):
+        """
+        Load the books and keep writing snapshots until stopped, reconnecting with backoff when Redis fails.
+        """
+        delay = self.retry_backoff
+        loaded = False
+        while self.running:
+            try:
+                conn = await self.redis.get_connection()
+                if not loaded:
+                    await self.load(conn)
+                    loaded = True
+                    logger.info(f"Writing book snapshots of {len(self.books)} streams every {self.interval}s or {self.count} updates")
+                delay = self.retry_backoff
+                await self.follow(conn)
+            except RETRYABLE_ERRORS as e:
+                # the streams keep the entries written meanwhile, reading resumes from the last IDs
+                logger.error(f"Error reading book streams: {e!r}, retrying in {delay:.1f}s")
+                await self.redis.reset_connection()
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.retry_backoff_max)
+
+    async def stop(self):
+        self.running = False
+        await asyncio.gather(*(sink.stop() for sink in self.sinks), return_exceptions=True)
+        logger.info(f"Wrote {self.snapshots} book snapshots")
+
+
+def main():
+    """
+    Write keyframes of the books of the feeds runner.py runs.
+    Config keys: snapshot_interval (seconds, default 60), snapshot_count (updates, default 1000),
+    snapshot_depth (levels per side, default 0 for the whole book) and snapshot_exchanges (default all).
+    """
+    from runner import EXCHANGES, BOOK_CHANNELS
+
+    def build(config: dict):
+        streams = []
+        for exchange in config.get('snapshot_exchanges') or list(FEEDS):
+            key, groups = EXCHANGES[exchange]
+            if any(channels[0] in BOOK_CHANNELS for channels in groups):
+                streams.extend((FEEDS[exchange], symbol) for symbol in config.get(key) or [])
+        redis = CustomBookSnapshotRedis(**redis_args(config), decode_responses=True, ttl=config.get('snapshot_ttl', 86400))
+        timescale = BookSnapshotTimeScale(**timescale_args(config))
+        service = SnapshotService(streams, redis, sinks=[timescale], interval=config.get('snapshot_interval', 60.0),
+                                  count=config.get('snapshot_count', 1000), depth=config.get('snapshot_depth', 0))
+        return service, [redis, timescale]
+    run_service('book snapshot service', build)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+from abc import ABC, abstractmethod
+from array import array
+import asyncio
+import logging
+import math
+import sys
+import time
+import numpy as np
+from Custom_Redis import CustomSpreadStream, RETRYABLE_ERRORS
+from custom_timescaledb import SpreadTimeScale
+from orderbook import entry_field, load_books, read_books
+from service import fan_out, redis_args, run_service, timescale_args
+logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)s:%(levelname)s:%(message)s')
+logger = logging.getLogger(__name__)
+
+LN2 = math.log(2)
+
+
+class SpreadStats:
+    """
+    O(1) running statistics of one spread series:
+
+    - an exponentially weighted mean and variance with a half-life in seconds, so irregularly spaced
+      observations are weighted by the time between them rather than by their count;
+    - the mean and variance of the last window observations, updated with Welford's algorithm extended to
+      a sliding window (the oldest value is removed as the new one is added), and recomputed exactly from
+      the ring of values once per window to stop rounding errors from accumulating.
+
+    z-scores are taken against the statistics before the new observation is folded in, so a value is not
+    measured against a mean it has already pulled towards itself.
+
+    halflife: float
+        Half-life of the EWMA weights, in seconds.
+    window: int
+        Number of observations of the sliding window.
+    """
+    __slots__ = ('halflife', 'window', 'mean', 'var', 'last_time', 'values', 'count', 'window_mean', 'window_m2')
+
+    def __init__(self, halflife: float = 300.0, window: int = 1000):
+        self.halflife = halflife
+        self.window = window
+        self.mean = None
+        self.var = 0.0
+        self.last_time = None
+        self.values = array('d', bytes(8 * window))
+        self.count = 0
+        self.window_mean = 0.0
+        self.window_m2 = 0.0
+
+    @staticmethod
+    def _zscore(value: float, mean: float, var: float):
+        return (value - mean) / math.sqrt(var) if var > 0 else None
+
+    def update(self, value: float, timestamp: float) -> dict:
+        """
+        Fold in one observation. Returns the z-scores and statistics after it.
+        """
+        if self.mean is None:
+            zscore = None
+            self.mean = value
+        else:
+            zscore = self._zscore(value, self.mean, self.var)
+            alpha = 1.0 - math.exp(-LN2 * max(timestamp - self.last_time, 0.0) / self.halflife)
+            diff = value - self.mean
+            increment = alpha * diff
+            self.mean += increment
+            self.var = (1.0 - alpha) * (self.var + diff * increment)
+        self.last_time = timestamp
+
+        full = self.count >= self.window
+        window_zscore = self._zscore(value, self.window_mean, self.window_m2 / (self.window - 1)) if full and self.window > 1 else None
+        slot = self.count % self.window
+        if full:
+            old = self.values[slot]
+            mean = self.window_mean + (value - old) / self.window
+            self.window_m2 += (value - old) * (value - mean + old - self.window_mean)
+            self.window_mean = mean
+        else:
+            n = self.count + 1
+            delta = value - self.window_mean
+            self.window_mean += delta / n
+            self.window_m2 += delta * (value - self.window_mean)
+        self.values[slot] = value
+        self.count += 1
+        if full and slot == self.window - 1:
+            values = np.frombuffer(self.values, dtype=np.float64)
+            self.window_mean = float(values.mean())
+            self.window_m2 = float(((values - self.window_mean) ** 2).sum())
+        n = min(self.count, self.window)
+        return {
+            'mean': self.mean,
+            'std': math.sqrt(self.var),
+            'zscore': zscore,
+            'window_mean': self.window_mean,
+            'window_std': math.sqrt(max(self.window_m2, 0.0) / (n - 1)) if n > 1 else None,
+            'window_zscore': window_zscore,
+        }
+
+
+class PairEngine(ABC):
+    """
+    Base of the streaming pair analytics: follows the book-<exchange>-<symbol> streams of both legs of every
+    pair, written by CustomBookStream (starting from the keyframes of snapshots.SnapshotService when there are
+    any), keeps the mid price of every book, and hands every mid price change to the pairs it is a leg of
+    through update_pairs. Subclasses that work on whole batches collect the pairs there and process them in
+    flush, called after every XREAD.
+
+    pairs: list
+        (exchange a, symbol a, exchange b, symbol b) tuples, e.g. ('BINANCE', 'BTC-USDT', 'BITFINEX', 'BTC-USDT').
+        The pair name is '<exchange a>:<symbol a>/<exchange b>:<symbol b>'.
+    sinks: list
+        Started backends the update dicts returned by update_pairs and flush are written to.
+    reader:
+        The backend whose Redis connection is used to read the book streams.
+        Use decode_responses=False when the book streams are written with a binary codec.
+    publish_interval: float
+        Write each pair at most once per publish_interval seconds, see due.
+    """
+    def __init__(self, pairs: list, sinks: list, reader, key: str = 'book', publish_interval: float = 1.0,
+                 block: int = 1000, read_count: int = 1000, retry_backoff: float = 1.0, retry_backoff_max: float = 30.0):
+        self.pairs = [tuple(pair) for pair in pairs]
+        self.names = [f"{a}:{sa}/{b}:{sb}" for a, sa, b, sb in self.pairs]
+        self.legs = [(f"{key}-{a}-{sa}", f"{key}-{b}-{sb}") for a, sa, b, sb in self.pairs]
+        # pairs of each stream, so an update only touches the pairs it is a leg of
+        self.by_stream = {}
+        for index, legs in enumerate(self.legs):
+            for stream in legs:
+                self.by_stream.setdefault(stream, []).append(index)
+        self.sinks = list(sinks)
+        self.reader = reader
+        self.key = key
+        self.publish_interval = publish_interval
+        self.block = block
+        self.read_count = read_count
+        self.retry_backoff = retry_backoff
+        self.retry_backoff_max = retry_backoff_max
+        self.mids = {}
+        self.published = [0.0] * len(self.pairs)
+        self.books = {}
+        self.last_ids = {}
+        self.observations = 0
+        self.running = True
+
+    def observe(self, stream: str, mid: float, receipt_timestamp: float) -> list:
+        """
+        Record a new mid price of stream. Returns the update dicts of the pairs due for publishing.
+        """
+        if mid is None or mid <= 0 or self.mids.get(stream) == mid:
+            return []
+        self.mids[stream] = mid
+        indices = [index for index in self.by_stream.get(stream, ()) if self.legs[index][0] in self.mids and self.legs[index][1] in self.mids]
+        return self.update_pairs(indices, receipt_timestamp) if indices else []
+
+    @abstractmethod
+    def update_pairs(self, indices: list, receipt_timestamp: float) -> list:
+        """
+        Both legs of the pairs at indices have a mid price and one of them just changed.
+        """
+
+    def flush(self) -> list:
+        return []
+
+    def due(self, index: int, receipt_timestamp: float) -> bool:
+        if receipt_timestamp - self.published[index] < self.publish_interval:
+            return False
+        self.published[index] = receipt_timestamp
+        return True
+
+    async def publish(self, updates: list):
+        for update in updates:
+            await fan_out(self.sinks, update)
+
+    async def read(self, conn):
+        """
+        One XREAD of the book streams: observe the mid price after every entry, then flush and publish.
+        """
+        updates = []
+        async for stream, _, fields in read_books(conn, self.books, self.last_ids, block=self.block, count=self.read_count):
+            receipt = entry_field(fields, 'receipt_timestamp')
+            updates += self.observe(stream, self.books[stream].mid(), float(receipt) if receipt else time.time())
+        updates += self.flush()
+        await self.publish(updates)
+
+    async def follow(self, conn):
+        while self.running:
+            await self.read(conn)
+
+    async def run(self):
+        """
+        Load the books and keep following them until stopped, reconnecting with backoff when Redis fails.
+        """
+        streams = list(dict.fromkeys(leg for a, sa, b, sb in self.pairs for leg in ((a, sa), (b, sb))))
+        delay = self.retry_backoff
+        loaded = False
+        while self.running:
+            try:
+                conn = await self.reader.get_connection()
+                if not loaded:
+                    self.books, self.last_ids = await load_books(conn, streams, key=self.key)
+                    # the loaded books only seed the mid prices, the statistics start with the first update read
+                    self.mids = {stream: book.mid() for stream, book in self.books.items() if book.mid()}
+                    loaded = True
+                    logger.info(f"{self.__class__.__name__}: following {len(self.pairs)} pairs over {len(self.books)} book streams")
+                delay = self.retry_backoff
+                await self.follow(conn)
+            except RETRYABLE_ERRORS as e:
+                # the streams keep the entries written meanwhile, reading resumes from the last IDs
+                logger.error(f"Error reading book streams: {e!r}, retrying in {delay:.1f}s")
+                await self.reader.reset_connection()
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.retry_backoff_max)
+
+    async def stop(self):
+        self.running = False
+        await asyncio.gather(*(sink.stop() for sink in self.sinks), return_exceptions=True)
+        logger.info(f"{self.__class__.__name__}: folded in {self.observations} observations")
+
+
+class SpreadEngine(PairEngine):
+    """
+    Streaming log spreads: on every mid price change of a leg, the SpreadStats of the pairs it belongs to are
+    updated with log(mid a) - log(mid b).
+
+    Each observation is written to sinks at most once per publish_interval seconds per pair, as an update dict
+    {'exchange': 'SPREAD', 'symbol': pair name, 'timestamp', 'receipt_timestamp', 'spread', 'mean', 'std',
+    'zscore', 'window_mean', 'window_std', 'window_zscore'}; the statistics still see every observation.
+    In main() the sinks are CustomSpreadStream and SpreadTimeScale. See PairEngine for the other arguments.
+
+    halflife, window:
+        See SpreadStats.
+    """
+    def __init__(self, pairs: list, sinks: list, reader, halflife: float = 300.0, window: int = 1000, **kwargs):
+        super().__init__(pairs, sinks, reader, **kwargs)
+        self.stats = [SpreadStats(halflife, window) for _ in self.pairs]
+
+    def update_pairs(self, indices: list, receipt_timestamp: float) -> list:
+        updates = []
+        for index in indices:
+            a, b = self.legs[index]
+            spread = math.log(self.mids[a]) - math.log(self.mids[b])
+            stats = self.stats[index].update(spread, receipt_timestamp)
+            self.observations += 1
+            if self.due(index, receipt_timestamp):
+                updates.append({'exchange': 'SPREAD', 'symbol': self.names[index], 'timestamp': receipt_timestamp,
+                                'receipt_timestamp': receipt_timestamp, 'spread': spread, **stats})
+        return updates
+
+
+def default_pairs(config: dict) -> list:
+    """
+    The same symbol on Binance and Bitfinex, and Binance spot against its Binance Futures perpetual.
+    """
+    bn = config.get('bn_symbols') or []
+    bf = set(config.get('bf_symbols') or [])
+    bnf = set(config.get('bnf_symbols') or [])
+    pairs = [('BINANCE', symbol, 'BITFINEX', symbol) for symbol in bn if symbol in bf]
+    pairs += [('BINANCE', symbol, 'BINANCE_FUTURES', f"{symbol}-PERP") for symbol in bn if f"{symbol}-PERP" in bnf]
+    return pairs
+
+
+def main():
+    """
+    Compute the spreads of the configured pairs into the spread-<pair> Redis streams and the spreads hypertable.
+    Config keys: spread_pairs (list of [exchange a, symbol a, exchange b, symbol b], default_pairs by default),
+    spread_halflife (seconds, default 300), spread_window (observations, default 1000) and
+    spread_publish_interval (seconds, default 1).
+    """
+    def build(config: dict):
+        pairs = config.get('spread_pairs') or default_pairs(config)
+        if not pairs:
+            logger.error('No spread pairs configured, nothing to run')
+            return None
+        redis = CustomSpreadStream(**redis_args(config), decode_responses=True, ttl=3600, maxlen=config.get('redis_spread_maxlen'))
+        timescale = SpreadTimeScale(**timescale_args(config))
+        engine = SpreadEngine(pairs, [redis, timescale], reader=redis, halflife=config.get('spread_halflife', 300.0),
+                              window=config.get('spread_window', 1000), publish_interval=config.get('spread_publish_interval', 1.0))
+        return engine, [redis, timescale]
+    run_service('spread engine', build)
+
+
+if __name__ == '__main__':
+    main()
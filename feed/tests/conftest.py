@@ -0,0 +1,40 @@
+"""
+Stubs shared by the tests: a backend that keeps what it is written, and a feed that starts its callbacks.
+"""
+from cryptofeed.feed import Feed
+
+
+class Sink:
+    """
+    A started backend that keeps the updates written to it. started is None until start is called, then the
+    multiprocess flag it was started with.
+    """
+    def __init__(self):
+        self.updates = []
+        self.started = None
+
+    def start(self, loop, multiprocess=False):
+        self.started = multiprocess
+
+    async def stop(self):
+        pass
+
+    async def write(self, update: dict):
+        self.updates.append(update)
+
+
+class StubFeed:
+    """
+    Just what Feed.start needs, so the callbacks are started exactly like a running feed starts them.
+    """
+    id = 'STUB'
+    start = Feed.start
+    backend_name = Feed.backend_name
+
+    def __init__(self, callbacks: dict, multiprocess: bool = False):
+        self.callbacks = callbacks
+        self.config = type('Config', (), {'backend_multiprocessing': multiprocess})()
+        self.connection_handlers = []
+
+    def connect(self):
+        return []
@@ -0,0 +1,457 @@
+"""
+Offline throughput benchmark: replays raw messages recorded by capture.py through the exchange feeds and the
+real storage callbacks of binance.py, bitfinex.py and binancefutures.py (CustomBookStream, CustomTradeRedis,
+BookTimeScale, TradesTimeScale, ...), against local stand-ins for Redis and TimescaleDB.
+
+    python tests/replay_harness.py captures/capture-*.jsonl.gz             # as fast as possible
+    python tests/replay_harness.py captures/*.jsonl.gz --speed 1           # at the recorded pace
+    python tests/replay_harness.py captures/*.jsonl.gz --speed 10 --redis-latency 0.0005 --pg-latency 0.002
+    python tests/replay_harness.py captures/*.jsonl.gz --redis-url redis://127.0.0.1:6379 --pg-dsn postgresql://postgres:pw@127.0.0.1/db0
+
+The stand-ins accept every command the backends send and answer after a fixed round trip latency, so the
+numbers measure the feed and backend code rather than a particular server. With --redis-url or --pg-dsn the
+backends write to a real local server instead; the TimescaleDB tables must already exist.
+REST reads (symbol lists, book snapshots) are answered from the capture, so no exchange is contacted.
+
+Reports messages/sec, end-to-end latency from the message being handed to the feed to its row being written
+(p50/p99, per backend), and the queue depth of every backend.
+"""
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager
+from decimal import Decimal
+import argparse
+import asyncio
+import glob
+import importlib
+import json as json_parser
+import logging
+import os
+import struct
+import sys
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from cryptofeed import FeedHandler
+from cryptofeed.exchange import Exchange
+import runtime
+from capture import feed_key, read_capture
+logger = logging.getLogger(__name__)
+
+
+class LocalRedis:
+    """
+    Stand-in for the redis.asyncio client the Redis backends use: pipelines, XADD, ZADD, EXPIRE, PUBLISH and
+    the trims are accepted and counted, and every round trip takes latency seconds.
+    """
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.commands = defaultdict(int)
+        self.round_trips = 0
+        self.sequence = 0
+
+    def pipeline(self, transaction=False):
+        return LocalPipeline(self)
+
+    async def publish(self, channel, message):
+        await self.execute([('publish', (channel, message))])
+        return 0
+
+    async def execute(self, commands: list) -> list:
+        self.round_trips += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        results = []
+        for name, _ in commands:
+            self.commands[name] += 1
+            if name == 'xadd':
+                self.sequence += 1
+                results.append(f"{int(time.time() * 1000)}-{self.sequence}")
+            else:
+                results.append(1)
+        return results
+
+    async def aclose(self):
+        pass
+
+
+class LocalPipeline:
+    def __init__(self, server: LocalRedis):
+        self.server = server
+        self.commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.commands = []
+
+    def __len__(self):
+        return len(self.commands)
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            self.commands.append((name, args))
+            return self
+        return command
+
+    async def execute(self):
+        commands, self.commands = self.commands, []
+        return await self.server.execute(commands)
+
+
+class LocalPostgres:
+    """
+    Stand-in for TimescaleDB: unnest INSERT statements, COPY records and binary COPY data are accepted and counted, and every
+    statement takes latency seconds. Column types for the COPY path are guessed from the column names
+    of the custom_columns mappings.
+    """
+    COLUMN_TYPES = {'timestamp': 'timestamp with time zone', 'receipt': 'timestamp with time zone', 'data': 'jsonb',
+                    'price': 'double precision', 'amount': 'double precision', 'rate': 'double precision',
+                    'mark_price': 'double precision', 'open_interest': 'double precision', 'quantity': 'double precision'}
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.statements = 0
+        self.rows = 0
+
+
+class LocalPool:
+    """
+    Stand-in for the asyncpg pool of one backend, so the column type lookup answers with its columns.
+    """
+    def __init__(self, server: LocalPostgres, columns: list):
+        self.server = server
+        self.columns = columns
+
+    @asynccontextmanager
+    async def acquire(self):
+        yield LocalPostgresConnection(self.server, self.columns)
+
+
+class LocalPostgresConnection:
+    def __init__(self, server: LocalPostgres, columns: list):
+        self.server = server
+        self.columns = columns
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+    async def execute(self, statement: str, *args):
+        self.server.statements += 1
+        if self.server.latency:
+            await asyncio.sleep(self.server.latency)
+        # the unnest INSERT of the insert write mode takes one array per column
+        rows = len(args[0]) if args else 0
+        self.server.rows += rows
+        return f"INSERT 0 {rows}"
+
+    async def copy_records_to_table(self, table, records, columns=None, **kwargs):
+        records = list(records)
+        self.server.statements += 1
+        self.server.rows += len(records)
+        if self.server.latency:
+            await asyncio.sleep(self.server.latency)
+        return f"COPY {len(records)}"
+
+    async def copy_to_table(self, table, source, columns=None, format=None, **kwargs):
+        # binary COPY of the columnar write mode: walk the rows to count them
+        data = bytes(source)
+        rows, offset = 0, 19
+        while (fields := struct.unpack_from('!h', data, offset)[0]) != -1:
+            offset += 2
+            for _ in range(fields):
+                offset += 4 + max(struct.unpack_from('!i', data, offset)[0], 0)
+            rows += 1
+        self.server.statements += 1
+        self.server.rows += rows
+        if self.server.latency:
+            await asyncio.sleep(self.server.latency)
+        return f"COPY {rows}"
+
+    async def fetch(self, query: str, *args):
+        # the column type lookup of TimeScaleCallback._load_copy_converters
+        return [{'attname': column, 'coltype': self.server.COLUMN_TYPES.get(column, 'text')} for column in self.columns]
+
+
+class ReplayHTTPSync:
+    """
+    Answers the blocking REST reads of the exchange classes (symbol lists) from the capture.
+    """
+    def __init__(self, responses: dict):
+        self.responses = responses
+
+    def read(self, address: str, params=None, headers=None, json=False, text=True, uuid=None):
+        data = _response(self.responses, address)[0]
+        return json_parser.loads(data, parse_float=Decimal) if json else data
+
+
+class ReplayHTTP:
+    """
+    Takes the place of a feed's http_conn and answers its REST reads (book snapshots) from the capture,
+    in the order they were recorded for each address.
+    """
+    def __init__(self, responses: dict):
+        self.responses = responses
+
+    async def read(self, address: str, header=None, params=None, return_headers=False, retry_count=0, retry_delay=60):
+        data, headers = _response(self.responses, address)
+        return (data, headers) if return_headers else data
+
+    async def close(self):
+        pass
+
+
+def _response(responses: dict, address: str):
+    queue = responses.get(address)
+    if not queue:
+        raise KeyError(f"No recorded response for {address}")
+    # the last response is kept for reads the capture did not see, such as a resync during replay
+    return queue.popleft() if len(queue) > 1 else queue[0]
+
+
+class ReplayConnection:
+    """
+    Stands for a recorded websocket or REST polling connection when its messages are handed to the feed.
+    """
+    def __init__(self, conn_id: str, subscription: dict = None):
+        self.id = conn_id
+        self.subscription = subscription or {}
+        self.received = 0
+        self.sent = 0
+        self.last_message = None
+
+    @property
+    def uuid(self):
+        return self.id
+
+    async def write(self, data):
+        self.sent += 1
+
+    async def close(self):
+        pass
+
+
+def percentile(values: list, fraction: float) -> float:
+    return values[min(int(len(values) * fraction), len(values) - 1)] if values else float('nan')
+
+
+class Replay:
+    """
+    FeedHandler-compatible source of recorded messages: builds the feeds of the capture with the exchange
+    modules' add_feeds, then hands every recorded message to its feed's message_handler, as a live
+    connection would, paced at speed times the recorded rate (0 for as fast as possible).
+    """
+    def __init__(self, records: list, fh: FeedHandler, speed: float = 0.0):
+        self.fh = fh
+        self.speed = speed
+        self.responses = defaultdict(deque)
+        self.feed_records = []
+        self.connections = {}
+        self.messages = []
+        for record in records:
+            if record['kind'] == 'feed':
+                self.feed_records.append(record)
+            elif record['kind'] == 'conn':
+                self.connections[record['conn']] = record
+        for record in records:
+            if record['kind'] == 'recv' or (record['kind'] == 'http' and record['conn'] in self.connections):
+                self.messages.append(record)
+            elif record['kind'] == 'http':
+                self.responses[record['addr']].append((record['data'], record.get('header')))
+        self.feeds = {}
+        self.backends = []
+        self.builders = []
+        self.handed = 0
+
+    def add_feeds(self):
+        """
+        Rebuild the recorded feeds with their storage callbacks. Returns the callbacks, not started yet. Callbacks
+        writing to backends of their own (BarBuilder) are kept in builders, and their backends are returned instead.
+        """
+        # symbol lists are fetched when the feeds are built
+        Exchange.http_sync = ReplayHTTPSync(self.responses)
+        for record in self.feed_records:
+            module = importlib.import_module(record['module'])
+            added = len(self.fh.feeds)
+            module.add_feeds(self.fh, record['symbols'], channels=tuple(record['channels']), shard=f"replay-{record['module']}")
+            for feed in self.fh.feeds[added:]:
+                self.feeds[feed_key(feed)] = feed
+                feed.http_conn = ReplayHTTP(self.responses)
+                for callbacks in feed.callbacks.values():
+                    for cb in callbacks:
+                        if hasattr(cb, 'sinks') and cb not in self.builders:
+                            self.builders.append(cb)
+                            self.backends.extend(sink for sink in cb.sinks if sink not in self.backends)
+                        elif hasattr(cb, 'start') and not hasattr(cb, 'sinks') and cb not in self.backends:
+                            self.backends.append(cb)
+        missing = {record['key'] for record in self.connections.values()} - set(self.feeds)
+        if missing:
+            logger.error(f"Recorded feeds not rebuilt, their messages are skipped: {missing}")
+        return self.backends
+
+    async def run(self):
+        connections = {}
+        first = self.messages[0]['t'] if self.messages else 0.0
+        start = time.perf_counter()
+        for record in self.messages:
+            meta = self.connections.get(record['conn'])
+            feed = self.feeds.get(meta['key']) if meta else None
+            if feed is None:
+                continue
+            if self.speed:
+                delay = (record['t'] - first) / self.speed - (time.perf_counter() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            conn = connections.get(record['conn'])
+            if conn is None:
+                conn = connections[record['conn']] = ReplayConnection(record['conn'], meta.get('subscription'))
+                await feed.subscribe(conn)
+            conn.received += 1
+            conn.last_message = time.time()
+            await feed.message_handler(record['data'], conn, conn.last_message)
+            self.handed += 1
+            # a connection yields to the event loop between messages
+            await asyncio.sleep(0)
+
+
+class Metrics:
+    """
+    End-to-end latency of every row a backend writes, and the depth of the backend queues.
+    """
+    def __init__(self, backends: list, sample_interval: float = 0.01):
+        self.backends = backends
+        self.sample_interval = sample_interval
+        self.latencies = defaultdict(list)
+        self.depth_max = defaultdict(int)
+        self.depth_sum = defaultdict(int)
+        self.samples = 0
+        for backend in backends:
+            self.instrument(backend)
+
+    @staticmethod
+    def name(backend) -> str:
+        return f"{backend.__class__.__name__} {getattr(backend, 'key', None) or getattr(backend, 'table', '')}".strip()
+
+    def instrument(self, backend):
+        write_batch = backend.write_batch
+        latencies = self.latencies[self.name(backend)]
+
+        async def timed(*args):
+            await write_batch(*args)
+            now = time.time()
+            # TimescaleDB batches hold (exchange, symbol, timestamp, receipt, update) tuples
+            latencies.extend(now - (u[4] if isinstance(u, tuple) else u)['receipt_timestamp'] for u in args[-1])
+        backend.write_batch = timed
+
+    async def sample(self):
+        while True:
+            self.samples += 1
+            for backend in self.backends:
+                depth = backend.queue.qsize()
+                self.depth_max[self.name(backend)] = max(self.depth_max[self.name(backend)], depth)
+                self.depth_sum[self.name(backend)] += depth
+            await asyncio.sleep(self.sample_interval)
+
+    def every(self) -> list:
+        return sorted(latency for latencies in self.latencies.values() for latency in latencies)
+
+    def report(self) -> list:
+        lines = []
+        every = self.every()
+        lines.append(f"{'all backends':32} {len(every):9} rows  p50 {percentile(every, 0.5) * 1e3:8.2f}ms  p99 {percentile(every, 0.99) * 1e3:8.2f}ms")
+        for name in sorted(self.latencies):
+            latencies = sorted(self.latencies[name])
+            lines.append(f"{name:32} {len(latencies):9} rows  p50 {percentile(latencies, 0.5) * 1e3:8.2f}ms  p99 {percentile(latencies, 0.99) * 1e3:8.2f}ms  "
+                         f"queue max {self.depth_max[name]} mean {self.depth_sum[name] / max(self.samples, 1):.1f}")
+        return lines
+
+
+def use_redis(backend, redis):
+    if isinstance(redis, str):
+        from redis import asyncio as aioredis
+        url = redis
+
+        async def get_connection():
+            if backend.conn is None:
+                backend.conn = aioredis.from_url(url, decode_responses=backend.decode_responses)
+            return backend.conn
+    else:
+        async def get_connection():
+            backend.conn = redis
+            return redis
+    backend.get_connection = get_connection
+
+
+async def run(args) -> dict:
+    paths = sorted(path for pattern in args.captures for path in glob.glob(pattern))
+    if not paths:
+        raise SystemExit(f"No capture files match {args.captures}")
+    records = list(read_capture(paths))
+    config = {'log': {'disabled': True}, 'uvloop': False, 'redis_host': '127.0.0.1', 'redis_port': 6379, 'redis_password': None,
+              'pg_host': '127.0.0.1', 'timescaledb_password': None, 'timescaledb_write_mode': args.write_mode}
+    fh = FeedHandler(config=config)
+    replay = Replay(records, fh, speed=args.speed)
+    backends = replay.add_feeds()
+
+    redis = args.redis_url or LocalRedis(args.redis_latency)
+    pg = LocalPostgres(args.pg_latency)
+    if args.pg_dsn:
+        import asyncpg
+        pg = await asyncpg.create_pool(dsn=args.pg_dsn, min_size=1, max_size=10)
+    for backend in backends:
+        if hasattr(backend, 'redis'):
+            use_redis(backend, redis)
+        elif hasattr(backend, 'pool'):
+            backend.pool = pg if args.pg_dsn else LocalPool(pg, backend.copy_columns)
+    metrics = Metrics(backends)
+    loop = asyncio.get_running_loop()
+    for backend in backends + replay.builders:
+        backend.start(loop)
+    sampler = asyncio.create_task(metrics.sample())
+
+    start = time.perf_counter()
+    await replay.run()
+    handed = time.perf_counter() - start
+    # the builders write their closed bars and stop their backends
+    await asyncio.gather(*(builder.stop() for builder in replay.builders))
+    owned = [sink for builder in replay.builders for sink in builder.sinks]
+    # wait for the backends to write everything queued, then stop them like FeedHandler.stop does
+    await asyncio.gather(*(backend.queue.join() for backend in backends))
+    drained = time.perf_counter() - start
+    await asyncio.gather(*(backend.stop() for backend in backends if backend not in owned))
+    await asyncio.gather(*(backend.worker for backend in backends))
+    await asyncio.gather(*(backend.reset_connection() for backend in backends if hasattr(backend, 'reset_connection')))
+    sampler.cancel()
+
+    print(f"replayed {replay.handed} messages from {len(paths)} files at {'max speed' if not args.speed else f'{args.speed:g}x'}")
+    print(f"feed handlers: {replay.handed / handed:10.0f} msgs/s   end to end: {replay.handed / drained:10.0f} msgs/s   ({drained:.2f}s)")
+    for line in metrics.report():
+        print(line)
+    if isinstance(redis, LocalRedis):
+        print(f"redis stand-in: {redis.round_trips} round trips, {dict(redis.commands)}")
+    if not args.pg_dsn:
+        print(f"postgres stand-in: {pg.statements} statements, {pg.rows} rows")
+    every = metrics.every()
+    return {'messages': replay.handed, 'msgs_per_sec': replay.handed / drained, 'handler_msgs_per_sec': replay.handed / handed,
+            'p50_ms': percentile(every, 0.5) * 1e3, 'p99_ms': percentile(every, 0.99) * 1e3,
+            'max_queue_depth': max(metrics.depth_max.values(), default=0)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('captures', nargs='+', help='capture files or glob patterns, replayed in name order')
+    parser.add_argument('--speed', type=float, default=0.0, help='multiple of the recorded pace, 0 for as fast as possible')
+    parser.add_argument('--redis-latency', type=float, default=0.0, help='round trip seconds of the Redis stand-in')
+    parser.add_argument('--pg-latency', type=float, default=0.0, help='seconds per statement of the TimescaleDB stand-in')
+    parser.add_argument('--redis-url', help='write to this Redis server instead of the stand-in')
+    parser.add_argument('--pg-dsn', help='write to this TimescaleDB instead of the stand-in')
+    parser.add_argument('--write-mode', default='insert', help="TimescaleDB write mode: 'insert', 'copy', 'upsert' or 'columnar'")
+    args = parser.parse_args()
+    runtime.setup()
+    # the backends log every connection and batch
+    logging.getLogger().setLevel(logging.WARNING)
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
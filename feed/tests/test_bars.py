@@ -0,0 +1,88 @@
+"""
+Tests of bars.BarBuilder: started like a cryptofeed callback, and the bars it builds checked against a reference
+computed from the same trades.
+
+    cd feed && python -m pytest tests/test_bars.py
+"""
+import asyncio
+import pytest
+np = pytest.importorskip('numpy')
+from bars import BarBuilder
+from tests.conftest import Sink, StubFeed
+
+
+def trades(count: int = 5000, seed: int = 1):
+    rng = np.random.default_rng(seed)
+    timestamps = 1_700_000_000 + np.cumsum(rng.exponential(0.05, count))
+    prices = 100 + np.cumsum(rng.normal(0, 0.01, count))
+    amounts = rng.exponential(0.5, count)
+    buys = rng.random(count) < 0.5
+    return timestamps, prices, amounts, buys
+
+
+def test_feed_start():
+    async def run():
+        sink = Sink()
+        builder = BarBuilder([sink])
+        StubFeed({'trades': [builder]}).start(asyncio.get_running_loop())
+        assert builder.started and sink.started is False
+        await builder.write({'exchange': 'BINANCE', 'symbol': 'BTC-USDT', 'price': 100.0, 'amount': 1.0, 'side': 'buy',
+                             'timestamp': 1_700_000_000.5, 'receipt_timestamp': 1_700_000_000.6})
+        await builder.write({'exchange': 'BINANCE', 'symbol': 'BTC-USDT', 'price': 101.0, 'amount': 1.0, 'side': 'sell',
+                             'timestamp': 1_700_000_001.5, 'receipt_timestamp': 1_700_000_001.6})
+        await builder.stop()
+        assert [(update['bar'], update['timestamp'], update['close']) for update in sink.updates] == [('1s', 1_700_000_000.0, 100.0)]
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize('frame, name', [(1, '1s'), (60, '1m')])
+def test_time_bars(frame, name):
+    timestamps, prices, amounts, buys = trades()
+    builder = BarBuilder(time_frames=(frame,), batch=10000)
+    for args in zip(prices.tolist(), amounts.tolist(), buys.tolist(), timestamps.tolist()):
+        builder.update('BINANCE', 'BTC-USDT', *args, args[-1])
+    bars = builder.drain()
+    buckets = np.floor(timestamps / frame) * frame
+    # the last interval is still open
+    starts = np.unique(buckets)[:-1]
+    assert [bar['timestamp'] for bar in bars] == starts.tolist()
+    for bar in bars:
+        assert bar['bar'] == name
+        trade = buckets == bar['timestamp']
+        assert bar['trades'] == trade.sum()
+        assert (bar['open'], bar['close']) == (prices[trade][0], prices[trade][-1])
+        assert (bar['high'], bar['low']) == (prices[trade].max(), prices[trade].min())
+        assert bar['vwap'] == pytest.approx((prices[trade] * amounts[trade]).sum() / amounts[trade].sum())
+        assert bar['buy_volume'] == pytest.approx(amounts[trade & buys].sum())
+
+
+def test_volume_and_dollar_bars():
+    timestamps, prices, amounts, buys = trades()
+    builder = BarBuilder(time_frames=(), volume={'*': 50.0}, dollar={'BTC-USDT': 10000.0}, batch=10000)
+    for args in zip(prices.tolist(), amounts.tolist(), buys.tolist(), timestamps.tolist()):
+        builder.update('BINANCE', 'BTC-USDT', *args, args[-1])
+    bars = builder.drain()
+    for name, measure, threshold in (('v50', amounts, 50.0), ('d10000', prices * amounts, 10000.0)):
+        closed = [bar for bar in bars if bar['bar'] == name]
+        # a bar closes on the trade that reaches the threshold, the next one starts on the following trade
+        ends, total = [], 0.0
+        for i, value in enumerate(measure.tolist()):
+            total += value
+            if total >= threshold:
+                ends.append(i)
+                total = 0.0
+        assert [bar['end'] for bar in closed] == timestamps[ends].tolist()
+        assert sum(bar['trades'] for bar in closed) == ends[-1] + 1
+        assert len({bar['timestamp'] for bar in closed}) == len(closed)
+
+
+def test_elapsed_bars_close_on_the_clock():
+    builder = BarBuilder(time_frames=(1,), lateness=0.5)
+    builder.update('BINANCE', 'BTC-USDT', 1.0, 1.0, True, 100.2, 100.2)
+    builder.close_elapsed(101.0)
+    assert builder.pending == 0
+    builder.close_elapsed(101.5)
+    # a trade of the interval already written goes into the next bar
+    builder.update('BINANCE', 'BTC-USDT', 2.0, 1.0, True, 100.7, 101.6)
+    builder.close_elapsed(102.5)
+    assert [(bar['timestamp'], bar['close']) for bar in builder.drain()] == [(100.0, 1.0), (101.0, 2.0)]
@@ -0,0 +1,62 @@
+"""
+Tests of basis.BasisEngine: the carry is the annualized funding alone, the basis is only annualized over an explicit
+horizon, and the funding zsets are read with the codec they are written with (fakeredis).
+
+    cd feed && python -m pytest tests/test_basis.py
+"""
+import asyncio
+import pytest
+from basis import FUNDING_INTERVAL, YEAR, BasisEngine
+from Custom_Redis import CustomFundingRedis
+
+PAIR = ('BINANCE', 'BTC-USDT', 'BINANCE_FUTURES', 'BTC-USDT-PERP')
+
+
+def observe(engine: BasisEngine, spot: float, perp: float) -> dict:
+    engine.observe('book-BINANCE-BTC-USDT', spot, 100.0)
+    updates = engine.observe('book-BINANCE_FUTURES-BTC-USDT-PERP', perp, 100.0)
+    assert len(updates) == 1
+    return updates[0]
+
+
+def test_carry_is_the_annualized_funding():
+    engine = BasisEngine([PAIR], [], reader=None, publish_interval=0.0)
+    update = observe(engine, 10000.0, 10005.0)
+    assert update['basis'] == pytest.approx(0.0005)
+    assert update['annualized_basis'] is None
+    assert update['funding_rate'] is None and update['carry'] is None
+
+    engine.funding[0].update({'rate': 0.0001, 'next_funding_time': 1000.0, 'timestamp': 1.0})
+    update = observe(engine, 10000.0, 10006.0)
+    assert update['annualized_funding'] == pytest.approx(0.0001 * YEAR / FUNDING_INTERVAL)
+    assert update['carry'] == update['annualized_funding']
+
+
+def test_basis_horizon():
+    engine = BasisEngine([PAIR], [], reader=None, publish_interval=0.0, basis_horizon=30 * 24 * 3600)
+    update = observe(engine, 10000.0, 10005.0)
+    assert update['annualized_basis'] == pytest.approx(0.0005 * 365 / 30)
+
+
+@pytest.mark.parametrize('codec', ['json', 'msgpack'])
+def test_funding_codec(codec):
+    fakeredis = pytest.importorskip('fakeredis')
+    if codec == 'msgpack':
+        pytest.importorskip('msgpack')
+
+    async def run():
+        conn = fakeredis.aioredis.FakeRedis(decode_responses=codec == 'json')
+        writer = CustomFundingRedis(ssl=False, codec=codec)
+        for i, next_funding_time in enumerate((1000.0, 1000.0 + 4 * 3600)):
+            await writer.write_batch(conn, [{'exchange': 'BINANCE_FUTURES', 'symbol': 'BTC-USDT-PERP', 'rate': 0.0001 * (i + 1),
+                                             'next_funding_time': next_funding_time, 'mark_price': 10000.0, 'predicted_rate': None,
+                                             'timestamp': 1.0 + i, 'receipt_timestamp': 1.0 + i}])
+            await engine.refresh_funding(conn)
+        await conn.aclose()
+
+    engine = BasisEngine([PAIR], [], reader=None, funding_codec=codec)
+    asyncio.run(run())
+    funding = engine.funding[0]
+    assert funding.rate == pytest.approx(0.0002)
+    # a 4 hour funding period, taken from how far next_funding_time moved
+    assert funding.interval == 4 * 3600
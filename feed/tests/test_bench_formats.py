@@ -0,0 +1,292 @@
+"""
+Benchmarks of the per-message write paths of the storage backends (the COPY records and the insert arrays) and of
+their stream encoders, of the order book, of the pair analytics and of the bar builder, on synthetic trade, 50 level L2
+and L3 book updates shaped like the ones cryptofeed hands to the backends.
+
+    poetry install --with test
+    cd feed && python -m pytest tests/test_bench_formats.py --benchmark-columns=median,mean,stddev,ops --benchmark-sort=name
+
+Every benchmark also records the peak memory one call allocates (tracemalloc) in extra_info, and fails when the median
+time per call or the allocation goes over its threshold in THRESHOLDS. The median is not moved by the odd call stalled
+by the garbage collector or the scheduler, and the thresholds are about 3x the figures of a development run;
+STATARB_BENCH_SLACK scales them for slower machines, and STATARB_BENCH_TIMING=0 only checks the allocations, e.g. on
+shared CI runners. --benchmark-disable skips the timing.
+Save a baseline with --benchmark-autosave and compare later runs with --benchmark-compare to see smaller changes.
+"""
+import os
+import random
+import sys
+import tracemalloc
+import pytest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+pytest.importorskip('pytest_benchmark')
+from binance import custom_columns, custom_columns_trades
+from columnar import column_kind
+from orderbook import OrderBook
+from hedge import HedgeEngine
+from bars import BarBuilder
+from custom_timescaledb import COPY_CONVERTERS, BookLevelsTimeScale, BookTimeScale, TradesTimeScale
+from Custom_Redis import CustomBookStream, CustomTradeRedis
+
+# benchmark name -> (median microseconds per call, peak bytes allocated by one call)
+THRESHOLDS = {
+    'trades_record': (12, 3000),
+    'trades_insert_arrays': (150, 20000),
+    'book_record_l2_snapshot': (90, 9000),
+    'book_record_l2_delta': (25, 4500),
+    'book_record_l3_snapshot': (190, 27000),
+    'book_record_l3_delta': (25, 4500),
+    'book_insert_arrays_l2_snapshot': (250, 22000),
+    'book_insert_arrays_l2_delta': (180, 17000),
+    'book_insert_arrays_l3_snapshot': (360, 40000),
+    'book_insert_arrays_l3_delta': (180, 17000),
+    'book_levels_records_l2_snapshot': (35, 6000),
+    'book_levels_records_l3_snapshot': (200, 31000),
+    'stream_encode_l2_snapshot_json': (80, 6500),
+    'stream_encode_l2_delta_json': (12, 1700),
+    'stream_encode_l3_snapshot_json': (150, 24000),
+    # msgpack's packer allocates its 256 KiB buffer on every call
+    'stream_encode_l2_snapshot_msgpack': (27, 800000),
+    'stream_encode_l2_snapshot_struct': (120, 20000),
+    'zset_encode_trade_json': (5, 700),
+    'trades_records_batch': (14000, 800000),
+    'trades_columnar_batch': (8000, 1500000),
+    'trades_insert_arrays_batch': (5000, 900000),
+    'orderbook_apply_l2_delta': (25, 2500),
+    'orderbook_apply_l3_delta': (45, 3000),
+    'orderbook_top_10': (15, 5500),
+    'orderbook_checksum_l2': (240, 27000),
+    'hedge_step_300_pairs': (800, 180000),
+    'bars_update_trade': (50, 6000),
+}
+SLACK = float(os.environ.get('STATARB_BENCH_SLACK', '1.0'))
+TIMING = os.environ.get('STATARB_BENCH_TIMING', '1') != '0'
+LEVELS = 50
+BATCH = 1000
+RECEIPT = 1700000000.123456
+
+# column types of the production tables, for the COPY converters
+COLUMN_TYPES = {'timestamp': 'timestamp with time zone', 'receipt': 'timestamp with time zone', 'data': 'jsonb',
+                'price': 'double precision', 'amount': 'double precision', 'id': 'bigint'}
+
+
+def peak_allocation(fn, *args) -> int:
+    """
+    Peak bytes allocated while fn(*args) runs, after a warm-up call.
+    """
+    fn(*args)
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        fn(*args)
+        return tracemalloc.get_traced_memory()[1] - base
+    finally:
+        tracemalloc.stop()
+
+
+def check(benchmark, name: str, fn, *args):
+    benchmark.name = name
+    benchmark(fn, *args)
+    median_us, max_bytes = THRESHOLDS[name]
+    allocated = peak_allocation(fn, *args)
+    benchmark.extra_info['peak_alloc_bytes'] = allocated
+    assert allocated <= max_bytes * SLACK, f"{name} allocates {allocated} bytes per call, threshold {max_bytes * SLACK:.0f}"
+    if TIMING and benchmark.stats is not None:
+        median = benchmark.stats.stats.median * 1e6
+        assert median <= median_us * SLACK, f"{name} takes {median:.1f}us per call, threshold {median_us * SLACK:.1f}us"
+
+
+def with_converters(backend):
+    backend.copy_converters = [COPY_CONVERTERS[COLUMN_TYPES.get(column, 'text')] for column in backend.copy_columns]
+    backend.copy_kinds = [column_kind(COLUMN_TYPES.get(column, 'text')) for column in backend.copy_columns]
+    return backend
+
+
+def row(update: dict) -> tuple:
+    # what TimeScaleCallback.writer hands to write_batch: timestamps stay epoch seconds
+    return (update['exchange'], update['symbol'], update['timestamp'], update['receipt_timestamp'], update)
+
+
+@pytest.fixture
+def trade():
+    return {'exchange': 'BINANCE', 'symbol': 'BTC-USDT', 'side': 'buy', 'amount': 0.01234, 'price': 37012.55, 'id': '3312846750',
+            'type': None, 'timestamp': RECEIPT - 0.05, 'receipt_timestamp': RECEIPT}
+
+
+@pytest.fixture
+def l2_snapshot():
+    rng = random.Random(1)
+    book = {'bid': {round(37000 - i * 0.01, 2): round(rng.uniform(0.001, 5), 5) for i in range(LEVELS)},
+            'ask': {round(37000.01 + i * 0.01, 2): round(rng.uniform(0.001, 5), 5) for i in range(LEVELS)}}
+    return {'exchange': 'BINANCE', 'symbol': 'BTC-USDT', 'book': book, 'timestamp': RECEIPT - 0.05, 'receipt_timestamp': RECEIPT}
+
+
+@pytest.fixture
+def l2_delta():
+    rng = random.Random(2)
+    delta = {'bid': [(round(37000 - rng.randint(0, LEVELS) * 0.01, 2), round(rng.uniform(0, 5), 5)) for _ in range(8)],
+             'ask': [(round(37000.01 + rng.randint(0, LEVELS) * 0.01, 2), round(rng.uniform(0, 5), 5)) for _ in range(8)]}
+    return {'exchange': 'BINANCE', 'symbol': 'BTC-USDT', 'delta': delta, 'timestamp': RECEIPT - 0.05, 'receipt_timestamp': RECEIPT}
+
+
+@pytest.fixture
+def l3_snapshot():
+    rng = random.Random(3)
+    book = {'bid': {round(37000 - i * 0.1, 1): {str(rng.randint(10 ** 10, 10 ** 11)): round(rng.uniform(0.001, 2), 5) for _ in range(3)} for i in range(LEVELS)},
+            'ask': {round(37000.1 + i * 0.1, 1): {str(rng.randint(10 ** 10, 10 ** 11)): round(rng.uniform(0.001, 2), 5) for _ in range(3)} for i in range(LEVELS)}}
+    return {'exchange': 'BITFINEX', 'symbol': 'BTC-USD', 'book': book, 'timestamp': RECEIPT - 0.05, 'receipt_timestamp': RECEIPT}
+
+
+@pytest.fixture
+def l3_delta():
+    rng = random.Random(4)
+    delta = {'bid': [(str(rng.randint(10 ** 10, 10 ** 11)), round(37000 - rng.randint(0, LEVELS) * 0.1, 1), round(rng.uniform(0, 2), 5)) for _ in range(4)],
+             'ask': [(str(rng.randint(10 ** 10, 10 ** 11)), round(37000.1 + rng.randint(0, LEVELS) * 0.1, 1), round(rng.uniform(0, 2), 5)) for _ in range(4)]}
+    return {'exchange': 'BITFINEX', 'symbol': 'BTC-USD', 'delta': delta, 'timestamp': RECEIPT - 0.05, 'receipt_timestamp': RECEIPT}
+
+
+@pytest.fixture
+def trades():
+    rng = random.Random(5)
+    return [{'exchange': 'BINANCE', 'symbol': rng.choice(['BTC-USDT', 'ETH-USDT', 'SOL-USDT']), 'side': rng.choice(['buy', 'sell']),
+             'amount': round(rng.uniform(0.001, 2), 5), 'price': round(rng.uniform(30000, 40000), 2), 'id': str(3312846750 + i),
+             'type': None, 'timestamp': RECEIPT + i * 0.001, 'receipt_timestamp': RECEIPT + i * 0.001 + 0.05} for i in range(BATCH)]
+
+
+@pytest.fixture
+def trades_timescale():
+    return with_converters(TradesTimeScale(custom_columns=custom_columns_trades, write_mode='copy'))
+
+
+@pytest.fixture
+def book_timescale():
+    return with_converters(BookTimeScale(custom_columns=custom_columns, write_mode='copy'))
+
+
+@pytest.fixture
+def book_levels():
+    return BookLevelsTimeScale()
+
+
+def insert_arrays(backend, update: dict) -> list:
+    # the insert write mode on a batch of one message
+    return backend.columns([row(update)]).to_arrays()
+
+
+def test_trades_record(benchmark, trades_timescale, trade):
+    check(benchmark, 'trades_record', trades_timescale.record, row(trade))
+
+
+def test_trades_insert_arrays(benchmark, trades_timescale, trade):
+    check(benchmark, 'trades_insert_arrays', insert_arrays, trades_timescale, trade)
+
+
+def writer_rows(updates: list) -> list:
+    return [row(u) for u in updates]
+
+
+def test_trades_records_batch(benchmark, trades_timescale, trades):
+    # the copy and upsert write modes: typed records
+    def records():
+        return [r for u in writer_rows(trades) for r in trades_timescale.records(u)]
+    check(benchmark, 'trades_records_batch', records)
+
+
+def test_trades_columnar_batch(benchmark, trades, trades_timescale):
+    # the columnar write mode: one binary COPY buffer
+    def columnar():
+        return trades_timescale.columns(writer_rows(trades)).to_copy()
+    check(benchmark, 'trades_columnar_batch', columnar)
+
+
+def test_trades_insert_arrays_batch(benchmark, trades, trades_timescale):
+    # the insert write mode: the typed array parameters of the unnest INSERT
+    def arrays():
+        return trades_timescale.columns(writer_rows(trades)).to_arrays()
+    check(benchmark, 'trades_insert_arrays_batch', arrays)
+
+
+@pytest.mark.parametrize('fixture', ['l2_snapshot', 'l2_delta', 'l3_snapshot', 'l3_delta'])
+def test_book_record(benchmark, request, book_timescale, fixture):
+    # the copy and upsert write modes
+    update = request.getfixturevalue(fixture)
+    check(benchmark, f"book_record_{fixture}", book_timescale.record, row(update))
+
+
+@pytest.mark.parametrize('fixture', ['l2_snapshot', 'l2_delta', 'l3_snapshot', 'l3_delta'])
+def test_book_insert_arrays(benchmark, request, book_timescale, fixture):
+    update = request.getfixturevalue(fixture)
+    check(benchmark, f"book_insert_arrays_{fixture}", insert_arrays, book_timescale, update)
+
+
+def test_book_levels_records_l2_snapshot(benchmark, book_levels, l2_snapshot):
+    check(benchmark, 'book_levels_records_l2_snapshot', book_levels.records, row(l2_snapshot))
+
+
+def test_book_levels_records_l3_snapshot(benchmark, book_levels, l3_snapshot):
+    check(benchmark, 'book_levels_records_l3_snapshot', book_levels.records, row(l3_snapshot))
+
+
+@pytest.mark.parametrize('fixture', ['l2_snapshot', 'l2_delta', 'l3_snapshot'])
+def test_stream_encode_json(benchmark, request, fixture):
+    update = request.getfixturevalue(fixture)
+    check(benchmark, f"stream_encode_{fixture}_json", CustomBookStream().encode, update)
+
+
+@pytest.mark.parametrize('codec', ['msgpack', 'struct'])
+def test_stream_encode_binary(benchmark, l2_snapshot, codec):
+    if codec == 'msgpack':
+        pytest.importorskip('msgpack')
+    else:
+        pytest.importorskip('numpy')
+    check(benchmark, f"stream_encode_l2_snapshot_{codec}", CustomBookStream(codec=codec).encode, l2_snapshot)
+
+
+def test_orderbook_apply_l2_delta(benchmark, l2_snapshot, l2_delta):
+    book = OrderBook()
+    book.load(l2_snapshot['book'])
+    check(benchmark, 'orderbook_apply_l2_delta', book.apply, l2_delta['delta'])
+
+
+def test_orderbook_apply_l3_delta(benchmark, l3_snapshot, l3_delta):
+    book = OrderBook()
+    book.load(l3_snapshot['book'])
+    check(benchmark, 'orderbook_apply_l3_delta', book.apply, l3_delta['delta'])
+
+
+def test_orderbook_top(benchmark, l2_snapshot):
+    book = OrderBook()
+    book.load(l2_snapshot['book'])
+    check(benchmark, 'orderbook_top_10', book.top, 10)
+
+
+def test_orderbook_checksum(benchmark, l2_snapshot):
+    book = OrderBook()
+    book.load(l2_snapshot['book'])
+    check(benchmark, 'orderbook_checksum_l2', book.checksum)
+
+
+def test_hedge_step(benchmark):
+    np = pytest.importorskip('numpy')
+    pairs = [('BINANCE', f"S{i}-USDT", 'BITFINEX', f"S{i}-USDT") for i in range(300)]
+    engine = HedgeEngine(pairs, [], reader=None)
+    rng = np.random.default_rng(0)
+    indices = np.arange(len(pairs))
+    x = np.log(rng.uniform(10, 100, len(pairs)))
+    for _ in range(50):
+        engine.step(indices, x, x + rng.normal(0, 1e-3, len(pairs)))
+    check(benchmark, 'hedge_step_300_pairs', engine.step, indices, x, x + 1e-3)
+
+
+def test_zset_encode_trade(benchmark, trade):
+    check(benchmark, 'zset_encode_trade_json', CustomTradeRedis().codec.dumps, trade)
+
+
+def test_bars_update(benchmark, trade):
+    pytest.importorskip('numpy')
+    # thresholds out of reach, so every call takes the common path of a trade inside all four open bars
+    builder = BarBuilder(time_frames=(1, 60), volume={'*': 1e12}, dollar={'*': 1e15})
+    args = (trade['exchange'], trade['symbol'], trade['price'], trade['amount'], True, trade['timestamp'], trade['receipt_timestamp'])
+    builder.update(*args)
+    check(benchmark, 'bars_update_trade', builder.update, *args)
@@ -0,0 +1,61 @@
+"""
+Tests of custom_timescaledb.BookLevelsTimeScale.records: one row per side with the levels best first for L2 and L3
+snapshots, the exchange order for deltas, and book_levels adding the backend only when configured.
+
+    cd feed && python -m pytest tests/test_book_levels.py
+"""
+from datetime import datetime as dt, timezone
+import pytest
+from custom_timescaledb import BookLevelsTimeScale, book_levels
+
+RECEIPT = 1700000000.5
+TIMESTAMP = dt.fromtimestamp(RECEIPT - 0.25, tz=timezone.utc)
+
+
+def records(exchange: str, symbol: str, update: dict) -> list:
+    return BookLevelsTimeScale().records((exchange, symbol, RECEIPT - 0.25, RECEIPT, update))
+
+
+def test_l2_snapshot():
+    rows = records('BINANCE', 'BTC-USDT', {'book': {'bid': {99.0: 2.0, 100.0: 1.0, 98.5: 3.0}, 'ask': {101.5: 0.5, 101.0: 0.25}}})
+    receipt = dt.fromtimestamp(RECEIPT, tz=timezone.utc)
+    assert rows == [
+        ('BINANCE', 'BTC-USDT', TIMESTAMP, receipt, 'snapshot', 'bid', [100.0, 99.0, 98.5], [1.0, 2.0, 3.0], None),
+        ('BINANCE', 'BTC-USDT', TIMESTAMP, receipt, 'snapshot', 'ask', [101.0, 101.5], [0.25, 0.5], None),
+    ]
+
+
+def test_l3_snapshot():
+    book = {'bid': {99.0: {'c': 1.0}, 100.0: {'a': 0.5, 'b': 2.0}}, 'ask': {101.0: {11: 4.0}}}
+    bid, ask = records('BITFINEX', 'BTC-USD', {'book': book})
+    # the orders of a level keep their queue order, order ids are text
+    assert bid[4:] == ('snapshot', 'bid', [100.0, 100.0, 99.0], [0.5, 2.0, 1.0], ['a', 'b', 'c'])
+    assert ask[4:] == ('snapshot', 'ask', [101.0], [4.0], ['11'])
+
+
+def test_l2_delta():
+    rows = records('BINANCE', 'BTC-USDT', {'delta': {'bid': [(99.0, 0.0), (100.0, 1.5)], 'ask': []}})
+    # deltas keep the exchange order, a side without changes has no row
+    assert [row[4:] for row in rows] == [('delta', 'bid', [99.0, 100.0], [0.0, 1.5], None)]
+
+
+def test_l3_delta():
+    rows = records('BITFINEX', 'BTC-USD', {'delta': {'bid': [('a', 100.0, 0.0)], 'ask': [(12, 101.0, 1.0), ('13', 101.5, 2.0)]}})
+    assert [row[4:] for row in rows] == [('delta', 'bid', [100.0], [0.0], ['a']),
+                                         ('delta', 'ask', [101.0, 101.5], [1.0, 2.0], ['12', '13'])]
+
+
+def test_timestamp_may_be_missing():
+    row, = BookLevelsTimeScale().records(('BINANCE', 'BTC-USDT', None, RECEIPT, {'delta': {'bid': [(1.0, 1.0)]}}))
+    assert row[2] is None and row[3] == dt.fromtimestamp(RECEIPT, tz=timezone.utc)
+
+
+def test_book_levels_config():
+    postgres_cfg = {'host': 'localhost', 'write_mode': 'columnar'}
+    assert book_levels({}, postgres_cfg) == []
+    backend, = book_levels({'timescaledb_book_levels': True}, postgres_cfg, snapshot_interval=500)
+    assert isinstance(backend, BookLevelsTimeScale)
+    assert backend.write_mode == 'upsert' and backend.snapshot_interval == 500
+    assert book_levels({'timescaledb_book_levels': True}, {**postgres_cfg, 'write_mode': 'copy'})[0].write_mode == 'copy'
+    with pytest.raises(ValueError):
+        BookLevelsTimeScale(write_mode='insert')
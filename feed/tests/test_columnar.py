@@ -0,0 +1,120 @@
+"""
+Tests of columnar.ColumnBatch: the binary COPY buffer parsed back field by field (field counts, lengths, -1 for NULL,
+big-endian values, the jsonb version byte, microseconds since 2000), and the insert arrays against the COPY records
+of the same rows.
+
+    cd feed && python -m pytest tests/test_columnar.py
+"""
+from datetime import datetime as dt, timedelta, timezone
+import json
+import struct
+import warnings
+import pytest
+np = pytest.importorskip('numpy')
+from columnar import COPY_HEADER, ColumnBatch, column_kind
+from custom_timescaledb import COPY_CONVERTERS, TradesTimeScale
+
+EPOCH = 1700000000.123456
+PG_EPOCH = dt(2000, 1, 1, tzinfo=timezone.utc)
+COLUMNS = {'exchange': 'exchange', 'symbol': 'symbol', 'timestamp': 'timestamp', 'receipt': 'receipt', 'side': 'side',
+           'amount': 'amount', 'id': 'id', 'maker': 'maker', 'info': 'info'}
+TYPES = {'exchange': 'text', 'symbol': 'text', 'timestamp': 'timestamp with time zone', 'receipt': 'timestamp without time zone',
+         'side': 'text', 'amount': 'double precision', 'id': 'bigint', 'maker': 'boolean', 'info': 'jsonb'}
+# big-endian wire format of the fixed width types
+WIRE = {'double precision': '!d', 'bigint': '!q', 'boolean': '?', 'timestamp with time zone': '!q', 'timestamp without time zone': '!q'}
+
+
+def rows() -> list:
+    # NULLs in every column kind, repeated and NULL categories, and datetimes aware, naive and in another zone
+    timestamps = [EPOCH, dt.fromtimestamp(EPOCH + 1, tz=timezone.utc), None, dt.fromtimestamp(EPOCH + 2.5, tz=timezone(timedelta(hours=-5))),
+                  dt.fromtimestamp(EPOCH + 3, tz=timezone.utc).replace(tzinfo=None), EPOCH + 4.000001]
+    sides = ['buy', 'sell', None, 'buy', 'buy', None]
+    updates = [{'side': side, 'amount': None if i == 3 else 0.5 * i, 'id': str(10 ** 12 + i) if i != 1 else None,
+                'maker': None if i == 4 else i % 2 == 0, 'info': None if i == 2 else {'n': i, 'tag': 'é'}}
+               for i, side in enumerate(sides)]
+    return [('BINANCE' if i % 3 else 'BITFINEX', None if i == 5 else 'BTC-USDT', ts, EPOCH + 10 + i, u)
+            for i, (ts, u) in enumerate(zip(timestamps, updates))]
+
+
+@pytest.fixture
+def backend():
+    backend = TradesTimeScale(custom_columns=COLUMNS, write_mode='columnar')
+    backend.copy_converters = [COPY_CONVERTERS[TYPES[column]] for column in backend.copy_columns]
+    backend.copy_kinds = [column_kind(TYPES[column]) for column in backend.copy_columns]
+    return backend
+
+
+def parse_copy(buffer: bytes, types: list) -> list:
+    """
+    The rows of a binary COPY buffer as python values, None for NULL.
+    """
+    assert buffer[:len(COPY_HEADER)] == COPY_HEADER
+    position = len(COPY_HEADER)
+    parsed = []
+    while True:
+        count, = struct.unpack_from('!h', buffer, position)
+        position += 2
+        if count == -1:
+            assert position == len(buffer)
+            return parsed
+        assert count == len(types)
+        row = []
+        for pg_type in types:
+            length, = struct.unpack_from('!i', buffer, position)
+            position += 4
+            if length == -1:
+                row.append(None)
+                continue
+            data = buffer[position:position + length]
+            position += length
+            if pg_type in WIRE:
+                assert length == struct.calcsize(WIRE[pg_type])
+                value, = struct.unpack(WIRE[pg_type], data)
+                if pg_type.startswith('timestamp'):
+                    value = PG_EPOCH + timedelta(microseconds=value)
+                row.append(value)
+            elif pg_type == 'jsonb':
+                # jsonb binary format version 1, then the json text
+                assert data[:1] == b'\x01'
+                row.append(json.loads(data[1:].decode()))
+            else:
+                row.append(data.decode())
+        parsed.append(row)
+
+
+def test_copy_parses_back(backend):
+    batch = backend.columns(rows())
+    parsed = parse_copy(bytes(batch.to_copy()), [TYPES[column] for column in backend.copy_columns])
+    expected = []
+    for record in map(backend.record, rows()):
+        values = list(record)
+        for i, column in enumerate(backend.copy_columns):
+            if values[i] is None:
+                continue
+            if column == 'receipt':
+                values[i] = values[i].replace(tzinfo=timezone.utc)
+            elif column == 'info':
+                values[i] = json.loads(values[i])
+        expected.append(values)
+    assert parsed == expected
+    assert [row[backend.copy_columns.index('side')] for row in parsed] == ['buy', 'sell', None, 'buy', 'buy', None]
+    assert parsed[3][backend.copy_columns.index('timestamp')] == dt.fromtimestamp(EPOCH + 2.5, tz=timezone.utc)
+
+
+def test_null_timestamps_do_not_warn(backend):
+    # assigning a unitless NaT to the microsecond array warned on every batch with NULL timestamps
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        batch = ColumnBatch.from_rows([('BINANCE', 'BTC-USDT', None, EPOCH, {})] * 3, ['timestamp', 'receipt'], ['timestamp', 'timestamp'])
+        assert batch.to_arrays()[0] == [None, None, None]
+        assert parse_copy(bytes(batch.to_copy()), ['timestamp with time zone'] * 2)[0][0] is None
+
+
+def test_arrays_match_records(backend):
+    arrays = backend.columns(rows()).to_arrays()
+    for i, record in enumerate(map(backend.record, rows())):
+        for column, values, value in zip(backend.copy_columns, arrays, record):
+            if value is not None and column in ('timestamp', 'receipt'):
+                # microseconds since the unix epoch
+                value = round((value if value.tzinfo else value.replace(tzinfo=timezone.utc)).timestamp() * 1e6)
+            assert values[i] == value, column
@@ -0,0 +1,26 @@
+"""
+Tests of the COPY converters of custom_timescaledb: the values must be what asyncpg's binary encoders accept for
+each column type.
+
+    cd feed && python -m pytest tests/test_copy_converters.py
+"""
+from datetime import datetime as dt, timedelta, timezone
+import pytest
+from custom_timescaledb import COPY_CONVERTERS
+
+EPOCH = 1700000000.123456
+# asyncpg encodes timestamps as the difference to the postgres epoch, naive for timestamp and aware for timestamptz
+PG_EPOCH = dt(2000, 1, 1)
+PG_EPOCH_UTC = dt(2000, 1, 1, tzinfo=timezone.utc)
+
+
+@pytest.mark.parametrize('value', [EPOCH, dt.fromtimestamp(EPOCH, tz=timezone.utc),
+                                   dt.fromtimestamp(EPOCH, tz=timezone(timedelta(hours=2))),
+                                   dt.fromtimestamp(EPOCH, tz=timezone.utc).replace(tzinfo=None)])
+def test_timestamp_converters(value):
+    expected = timedelta(seconds=EPOCH - PG_EPOCH_UTC.timestamp())
+    aware = COPY_CONVERTERS['timestamp with time zone'](value)
+    naive = COPY_CONVERTERS['timestamp without time zone'](value)
+    assert aware.tzinfo is not None and naive.tzinfo is None
+    assert abs(aware - PG_EPOCH_UTC - expected) < timedelta(microseconds=1)
+    assert abs(naive - PG_EPOCH - expected) < timedelta(microseconds=1)
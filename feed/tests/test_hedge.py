@@ -0,0 +1,103 @@
+"""
+Tests of hedge: RLS without forgetting against an ordinary least squares fit, RollingADF against the t-statistic
+of the same regression on the window, and vectorized steps over a subset of the pairs against pairs run alone.
+
+    cd feed && python -m pytest tests/test_hedge.py
+"""
+import math
+import pytest
+np = pytest.importorskip('numpy')
+from hedge import HedgeEngine, HedgeFilter, RollingADF
+
+
+def cointegrated(rng, count: int, alpha: float = 0.3, beta: float = 1.2):
+    x = np.cumsum(rng.normal(0, 0.01, count)) + 4.0
+    return x, alpha + beta * x + rng.normal(0, 0.002, count)
+
+
+def test_rls_without_forgetting_is_least_squares():
+    rng = np.random.default_rng(0)
+    x, y = cointegrated(rng, 2000)
+    hedge = HedgeFilter(1, method='rls', forgetting=1.0, prior_var=1e10)
+    index = np.array([0])
+    for i in range(len(x)):
+        hedge.update(index, x[i:i + 1], y[i:i + 1])
+        if i in (50, 500, 1999):
+            beta, alpha = np.polyfit(x[:i + 1], y[:i + 1], 1)
+            assert hedge.alpha[0] == pytest.approx(alpha, rel=1e-5, abs=1e-7)
+            assert hedge.beta[0] == pytest.approx(beta, rel=1e-5)
+
+
+def adf_reference(series: np.ndarray, window: int) -> float:
+    # d_t = a + b * z_{t-1} over the last window changes, t-statistic of b
+    z, d = series[:-1][-window:], np.diff(series)[-window:]
+    design = np.stack((np.ones_like(z), z), axis=1)
+    coef, residuals, _, _ = np.linalg.lstsq(design, d, rcond=None)
+    sigma2 = residuals[0] / (len(d) - 2)
+    return coef[1] / math.sqrt(sigma2 * np.linalg.inv(design.T @ design)[1, 1])
+
+
+@pytest.mark.parametrize('kind', ['mean_reverting', 'random_walk'])
+def test_rolling_adf_matches_ols(kind):
+    rng = np.random.default_rng(1)
+    window = 100
+    shocks = rng.normal(0, 1, 1000)
+    series = np.empty(len(shocks))
+    series[0] = 0.0
+    for t in range(1, len(series)):
+        series[t] = (0.8 if kind == 'mean_reverting' else 1.0) * series[t - 1] + shocks[t]
+    adf = RollingADF(1, window=window)
+    index = np.array([0])
+    for t in range(len(series)):
+        statistic = adf.update(index, series[t:t + 1])[0]
+        if t < adf.min_observations:
+            assert math.isnan(statistic)
+        elif t in (30, window, window + 1, 3 * window + 7, len(series) - 1):
+            # before the window fills, then across several wraps and exact recomputes of the sums
+            assert statistic == pytest.approx(adf_reference(series[:t + 1], window), rel=1e-6)
+    if kind == 'mean_reverting':
+        assert statistic < -2.86
+
+
+def test_subset_steps_match_pairs_run_alone():
+    rng = np.random.default_rng(2)
+    pairs = 5
+    steps = 400
+    x, y = zip(*(cointegrated(rng, steps, alpha=0.1 * p, beta=1.0 + 0.1 * p) for p in range(pairs)))
+    x, y = np.array(x), np.array(y)
+    together = HedgeEngine([('A', f"S{p}", 'B', f"S{p}") for p in range(pairs)], [], reader=None, adf_window=50)
+    alone = [HedgeEngine([('A', f"S{p}", 'B', f"S{p}")], [], reader=None, adf_window=50) for p in range(pairs)]
+    seen = [0] * pairs
+    for _ in range(steps):
+        # a random subset of the pairs has a new observation, in random order
+        indices = rng.permutation(pairs)[:rng.integers(1, pairs + 1)]
+        obs_x = np.array([x[p, seen[p]] for p in indices])
+        obs_y = np.array([y[p, seen[p]] for p in indices])
+        innovation, residual, adf = together.step(indices, obs_x, obs_y)
+        for i, p in enumerate(indices):
+            expected = alone[p].step(np.array([0]), obs_x[i:i + 1], obs_y[i:i + 1])
+            assert innovation[i] == pytest.approx(expected[0][0], rel=1e-9, abs=1e-12)
+            assert residual[i] == pytest.approx(expected[1][0], rel=1e-9, abs=1e-12)
+            assert np.isnan(adf[i]) == np.isnan(expected[2][0])
+            if not np.isnan(adf[i]):
+                assert adf[i] == pytest.approx(expected[2][0], rel=1e-6)
+            seen[p] += 1
+    for p in range(pairs):
+        assert together.filter.state[p] == pytest.approx(alone[p].filter.state[0], rel=1e-9)
+
+
+def test_flush_publishes_the_touched_pairs():
+    pairs = [('BINANCE', 'BTC-USDT', 'BITFINEX', 'BTC-USDT'), ('BINANCE', 'ETH-USDT', 'BITFINEX', 'ETH-USDT')]
+    engine = HedgeEngine(pairs, [], reader=None, publish_interval=0.0)
+    for stream, mid in (('book-BINANCE-BTC-USDT', 30000.0), ('book-BITFINEX-BTC-USDT', 30010.0),
+                        ('book-BINANCE-ETH-USDT', 2000.0), ('book-BITFINEX-ETH-USDT', 2001.0)):
+        engine.observe(stream, mid, 1.0)
+    engine.flush()
+    state = engine.filter.state.copy()
+    engine.observe('book-BITFINEX-ETH-USDT', 2002.0, 2.0)
+    updates = engine.flush()
+    assert [u['symbol'] for u in updates] == ['BINANCE:ETH-USDT/BITFINEX:ETH-USDT']
+    assert updates[0]['timestamp'] == 2.0
+    assert engine.filter.state[0] == pytest.approx(state[0])
+    assert engine.filter.state[1] != pytest.approx(state[1])
+    assert engine.flush() == []
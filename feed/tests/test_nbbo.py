@@ -0,0 +1,49 @@
+"""
+Tests of nbbo.NBBOEngine: started like a cryptofeed callback, and its NBBO and cross-venue spreads checked against a
+brute-force reference over random top of book updates.
+
+    cd feed && python -m pytest tests/test_nbbo.py
+"""
+import asyncio
+import random
+import pytest
+pytest.importorskip('numpy')
+from nbbo import NBBOEngine
+from tests.conftest import Sink, StubFeed
+
+VENUES = ['BINANCE', 'BITFINEX', 'COINBASE']
+
+
+def test_feed_start():
+    async def run():
+        sink = Sink()
+        engine = NBBOEngine(['BTC-USDT'], VENUES, sinks=[sink])
+        # one engine is the callback of several feeds, its sinks start once
+        for _ in VENUES:
+            StubFeed({'l2_book': [engine]}).start(asyncio.get_running_loop())
+        assert engine.started and sink.started is False
+        await engine.stop()
+        assert not engine.started
+    asyncio.run(run())
+
+
+def test_update_matches_reference():
+    rng = random.Random(3)
+    engine = NBBOEngine(['BTC-USDT', 'ETH-USDT'], VENUES)
+    quotes = {}
+    for i in range(5000):
+        symbol, venue = rng.choice(['BTC-USDT', 'ETH-USDT']), rng.choice(VENUES)
+        bid = rng.choice([None, 99.0, 99.5, 100.0])
+        ask = rng.choice([None, 100.0, 100.5, 101.0])
+        size = rng.choice([1.0, 2.0])
+        update = engine.update(symbol, venue, bid, size, ask, size, i, i)
+        quotes[(symbol, venue)] = (bid, size, ask, size)
+        bids = [(q[0], v) for (s, v), q in quotes.items() if s == symbol and q[0] is not None]
+        asks = [(q[2], v) for (s, v), q in quotes.items() if s == symbol and q[2] is not None]
+        if update is None:
+            continue
+        assert update['bid'] == max(bids)[0] and update['ask'] == min(asks)[0]
+        assert quotes[(symbol, update['bid_exchange'])][0] == update['bid']
+        assert quotes[(symbol, update['ask_exchange'])][2] == update['ask']
+        expected = {f"{b}:{a}": quotes[(symbol, b)][0] - quotes[(symbol, a)][2] for _, b in bids for _, a in asks if a != b}
+        assert update['spreads'] == expected
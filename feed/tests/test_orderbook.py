@@ -0,0 +1,185 @@
+"""
+Tests of orderbook: OrderBook against a plain dict reference, L3 orders moving between levels and sides, Bitfinex
+checksums, and load_book rebuilding a book from a Redis stream with and without a keyframe, falling back to the
+snapshot entry of the stream when it was trimmed past the keyframe (fakeredis).
+
+    cd feed && python -m pytest tests/test_orderbook.py
+"""
+import asyncio
+import random
+import zlib
+import pytest
+pytest.importorskip('numpy')
+from cryptofeed.exceptions import BadChecksum
+from orderbook import OrderBook, load_book
+from Custom_Redis import CustomBookSnapshotRedis, CustomBookStream
+
+
+def expected(reference: dict) -> dict:
+    return {'bid': dict(sorted(reference['bid'].items(), reverse=True)), 'ask': dict(sorted(reference['ask'].items()))}
+
+
+def random_deltas(rng: random.Random, reference: dict, count: int):
+    """
+    Yield count random L2 deltas, each applied to reference as it is drawn.
+    """
+    for _ in range(count):
+        delta = {'bid': [], 'ask': []}
+        for side, low in (('bid', 50), ('ask', 101)):
+            for _ in range(rng.randint(0, 3)):
+                price = float(rng.randint(low, low + 50)) + rng.choice([0.0, 0.25, 0.5])
+                size = rng.choice([0.0, 0.0, 0.1, 1.5, 2.0])
+                delta[side].append((price, size))
+                if size:
+                    reference[side][price] = size
+                else:
+                    reference[side].pop(price, None)
+        yield delta
+
+
+def test_apply_matches_dict_reference():
+    rng = random.Random(7)
+    reference = {'bid': {100.0 - i: 1.0 for i in range(50)}, 'ask': {101.0 + i: 1.0 for i in range(50)}}
+    book = OrderBook('BINANCE', 'BTC-USDT')
+    book.load({side: dict(levels) for side, levels in reference.items()})
+    for i, delta in enumerate(random_deltas(rng, reference, 20000)):
+        book.apply(delta)
+        if i % 1000 == 0:
+            assert book.to_dict() == expected(reference)
+    assert book.to_dict() == expected(reference)
+    bid, ask = max(reference['bid']), min(reference['ask'])
+    assert book.best() == ((bid, reference['bid'][bid]), (ask, reference['ask'][ask]))
+    assert book.mid() == (bid + ask) / 2
+
+
+def test_max_depth_keeps_the_best_levels():
+    book = OrderBook(max_depth=3)
+    book.load({'bid': {float(p): 1.0 for p in range(90, 100)}, 'ask': {float(p): 1.0 for p in range(101, 111)}})
+    book.apply({'bid': [(99.5, 2.0)], 'ask': [(100.5, 2.0)]})
+    assert list(book.to_dict()['bid']) == [99.5, 99.0, 98.0]
+    assert list(book.to_dict()['ask']) == [100.5, 101.0, 102.0]
+
+
+def test_l3_orders_move_between_levels_and_sides():
+    book = OrderBook('BITFINEX', 'BTC-USD')
+    book.load({'bid': {'100': {'a': 1.0, 'b': 2.0}, '99': {'c': 1.0}}, 'ask': {'101': {'d': 1.0}}})
+    assert book.to_dict() == {'bid': {100.0: {'a': 1.0, 'b': 2.0}, 99.0: {'c': 1.0}}, 'ask': {101.0: {'d': 1.0}}}
+    # a moves down a level, c's level empties out, d crosses to the bid side
+    book.apply({'bid': [('a', 99.0, 0.5), ('c', 99.0, 0.0), ('d', 98.0, 3.0)]})
+    assert book.to_dict() == {'bid': {100.0: {'b': 2.0}, 99.0: {'a': 0.5}, 98.0: {'d': 3.0}}, 'ask': {}}
+    assert book.top(2)['bid'][1].tolist() == [2.0, 0.5]
+    # b moves to the ask side, a new order joins the back of its level
+    book.apply({'ask': [('b', 102.0, 2.0), ('e', 102.0, 1.0)]})
+    assert book.to_dict() == {'bid': {99.0: {'a': 0.5}, 98.0: {'d': 3.0}}, 'ask': {102.0: {'b': 2.0, 'e': 1.0}}}
+    assert book.asks.best() == (102.0, 3.0)
+    assert set(book.orders) == {'a', 'd', 'b', 'e'}
+
+
+def signed_crc32(text: str) -> int:
+    checksum = zlib.crc32(text.encode())
+    return checksum - (1 << 32) if checksum >= 1 << 31 else checksum
+
+
+def test_checksum_bitfinex_l2():
+    book = OrderBook('BITFINEX', 'BTC-USD')
+    book.load({'bid': {6000.0: 1.0, 5999.5: 0.25, 5999.0: 2.0}, 'ask': {6001.0: 0.5, 6002.0: 0.0000001}})
+    # bids and asks interleaved best first, ask amounts negative, numbers printed like javascript does
+    assert book.checksum() == signed_crc32('6000:1:6001:-0.5:5999.5:0.25:6002:-1e-7:5999:2')
+    book.validate(signed_crc32('6000:1:6001:-0.5:5999.5:0.25:6002:-1e-7:5999:2'))
+
+
+def test_checksum_bitfinex_l3():
+    book = OrderBook('BITFINEX', 'BTC-USD')
+    book.load({'bid': {6000.0: {'11': 1.0, '12': 0.5}}, 'ask': {6001.0: {'21': 2.0}}})
+    # raw books list the order ids instead of the prices
+    assert book.checksum() == signed_crc32('11:1:21:-2:12:0.5')
+
+
+def test_checksum_depth_and_mismatch():
+    book = OrderBook('BITFINEX', 'BTC-USD')
+    book.load({'bid': {float(6000 - i): 1.0 for i in range(30)}, 'ask': {float(6001 + i): 1.0 for i in range(30)}})
+    parts = []
+    for i in range(25):
+        parts += [str(6000 - i), '1', str(6001 + i), '-1']
+    assert book.checksum() == signed_crc32(':'.join(parts))
+    with pytest.raises(BadChecksum):
+        book.validate(book.checksum() + 1)
+
+
+async def write(backend, conn, updates: list):
+    # the batches the backend's writer task would hand over
+    for update in updates:
+        await backend.write_batch(conn, [update])
+
+
+@pytest.mark.parametrize('codec', ['json', 'struct'])
+def test_load_book_keyframe_and_tail(codec):
+    fakeredis = pytest.importorskip('fakeredis')
+
+    async def run():
+        decode = codec == 'json'
+        conn = fakeredis.aioredis.FakeRedis(decode_responses=decode)
+        rng = random.Random(11)
+        reference = {'bid': {100.0 - i: 1.0 for i in range(50)}, 'ask': {101.0 + i: 1.0 for i in range(50)}}
+        update = {'exchange': 'BINANCE', 'symbol': 'BTC-USDT', 'timestamp': 1.0, 'receipt_timestamp': 1.0}
+        stream = CustomBookStream(ssl=False, codec=codec)
+        await write(stream, conn, [{**update, 'book': {side: dict(levels) for side, levels in reference.items()}}])
+        await write(stream, conn, [{**update, 'delta': delta} for delta in random_deltas(rng, reference, 300)])
+
+        # a keyframe of the book as of the last entry written so far
+        book, snap_id = await load_book(conn, 'BINANCE', 'BTC-USDT', snap_key=None)
+        assert book.to_dict() == expected(reference)
+        snapshots = CustomBookSnapshotRedis(ssl=False, codec=codec)
+        await snapshots.write_batch(conn, [{**update, 'book': book.to_dict(), 'stream_id': snap_id}])
+        await write(stream, conn, [{**update, 'delta': delta} for delta in random_deltas(rng, reference, 200)])
+
+        keyframed, last_id = await load_book(conn, 'BINANCE', 'BTC-USDT')
+        replayed, replayed_id = await load_book(conn, 'BINANCE', 'BTC-USDT', snap_key=None)
+        assert keyframed.to_dict() == replayed.to_dict() == expected(reference)
+        assert last_id == replayed_id
+
+        # with the stream trimmed up to the keyframe only the keyframe can rebuild the book
+        await conn.xtrim('book-BINANCE-BTC-USDT', minid=snap_id)
+        keyframed, last_id = await load_book(conn, 'BINANCE', 'BTC-USDT')
+        assert keyframed.to_dict() == expected(reference) and last_id == replayed_id
+        replayed, _ = await load_book(conn, 'BINANCE', 'BTC-USDT', snap_key=None)
+        assert replayed.to_dict() == {'bid': {}, 'ask': {}}
+
+        # a keyframe older than the first entry of the stream is skipped
+        await conn.xtrim('book-BINANCE-BTC-USDT', maxlen=10)
+        book, _ = await load_book(conn, 'BINANCE', 'BTC-USDT')
+        assert book.to_dict() == {'bid': {}, 'ask': {}}
+        await conn.aclose()
+    asyncio.run(run())
+
+
+def test_load_book_keyframe_older_than_the_stream(caplog):
+    fakeredis = pytest.importorskip('fakeredis')
+
+    async def run():
+        conn = fakeredis.aioredis.FakeRedis(decode_responses=True)
+        rng = random.Random(13)
+        reference = {'bid': {100.0 - i: 1.0 for i in range(50)}, 'ask': {101.0 + i: 1.0 for i in range(50)}}
+        update = {'exchange': 'BINANCE', 'symbol': 'BTC-USDT', 'timestamp': 1.0, 'receipt_timestamp': 1.0}
+        stream = CustomBookStream(ssl=False)
+        await write(stream, conn, [{**update, 'book': {side: dict(levels) for side, levels in reference.items()}}])
+        await write(stream, conn, [{**update, 'delta': delta} for delta in random_deltas(rng, reference, 100)])
+        book, snap_id = await load_book(conn, 'BINANCE', 'BTC-USDT', snap_key=None)
+        snapshots = CustomBookSnapshotRedis(ssl=False)
+        await snapshots.write_batch(conn, [{**update, 'book': book.to_dict(), 'stream_id': snap_id}])
+
+        # the feed's next snapshot entry, then the stream trimmed up to it, past the keyframe
+        await write(stream, conn, [{**update, 'delta': delta} for delta in random_deltas(rng, reference, 100)])
+        await write(stream, conn, [{**update, 'book': expected(reference)}])
+        snapshot_id = (await conn.xrevrange('book-BINANCE-BTC-USDT', count=1))[0][0]
+        await write(stream, conn, [{**update, 'delta': delta} for delta in random_deltas(rng, reference, 100)])
+        await conn.xtrim('book-BINANCE-BTC-USDT', minid=snapshot_id)
+
+        with caplog.at_level('INFO', logger='orderbook'):
+            fallback, last_id = await load_book(conn, 'BINANCE', 'BTC-USDT')
+        assert f"Snapshot book-snap-BINANCE-BTC-USDT at {snap_id} is older than book-BINANCE-BTC-USDT" in caplog.text
+        replayed, replayed_id = await load_book(conn, 'BINANCE', 'BTC-USDT', snap_key=None)
+        assert fallback.to_dict() == replayed.to_dict() == expected(reference)
+        assert last_id == replayed_id
+        await conn.aclose()
+    asyncio.run(run())
@@ -0,0 +1,111 @@
+"""
+Tests of retry_buffer.RetryBuffer: rows over max_rows are dropped or spilled, spilled rows are replayed before
+the ones in memory, and a spill file left by a previous run (possibly cut short by a crash) is reloaded.
+
+    cd feed && python -m pytest tests/test_retry_buffer.py
+"""
+import os
+import pytest
+from retry_buffer import RetryBuffer
+
+
+def rows(start: int, count: int) -> list:
+    return [{'id': i} for i in range(start, start + count)]
+
+
+def replay(buffer: RetryBuffer, max_rows: int = 7) -> list:
+    replayed = []
+    while len(buffer):
+        batch = buffer.peek(max_rows)
+        replayed.extend(batch)
+        buffer.commit(len(batch))
+    return replayed
+
+
+def test_drop_oldest():
+    buffer = RetryBuffer(max_rows=10)
+    buffer.append(rows(0, 25))
+    assert len(buffer) == 10 and buffer.dropped == 15
+    assert replay(buffer) == rows(15, 10)
+
+
+def test_unknown_policy_and_missing_path():
+    with pytest.raises(ValueError):
+        RetryBuffer(overflow='block')
+    with pytest.raises(ValueError):
+        RetryBuffer(overflow='spill')
+
+
+def test_failed_write_leaves_rows_in_place(tmp_path):
+    buffer = RetryBuffer(max_rows=10, overflow='spill', spill_path=str(tmp_path / 'spill'))
+    buffer.append(rows(0, 15))
+    first = buffer.peek(3)
+    # nothing committed: the same rows are offered again
+    assert buffer.peek(3) == first == rows(0, 3)
+    buffer.append(rows(15, 5))
+    assert buffer.peek(3) == first
+
+
+def test_spill_and_reload(tmp_path):
+    path = str(tmp_path / 'spill')
+    buffer = RetryBuffer(max_rows=10, overflow='spill', spill_path=path)
+    buffer.append(rows(0, 25))
+    assert len(buffer) == 25 and buffer.spill_rows == 15 and buffer.dropped == 0
+    # spilled rows are older than those in memory, so they go out first
+    assert buffer.peek(100) == rows(0, 15)
+    buffer.commit(len(buffer.peek(4)))
+    # a new overflow is appended after the spilled rows still pending
+    buffer.append(rows(25, 5))
+    assert buffer.spill_rows == 16
+    assert replay(buffer) == rows(4, 26)
+    assert not os.path.exists(path)
+    assert buffer.stats() == '0 rows in memory, 0 spilled, 20 spilled and 0 dropped in total'
+
+
+def test_spill_file_starts_over_once_replayed(tmp_path):
+    path = str(tmp_path / 'spill')
+    buffer = RetryBuffer(max_rows=5, overflow='spill', spill_path=path)
+    for start in range(0, 100, 10):
+        buffer.append(rows(start, 10))
+        assert replay(buffer, 3) == rows(start, 10)
+        assert not os.path.exists(path)
+    assert buffer.spilled == 50
+
+
+def test_restart_replays_the_spill_file(tmp_path):
+    path = str(tmp_path / 'spill')
+    buffer = RetryBuffer(max_rows=10, overflow='spill', spill_path=path)
+    buffer.append(rows(0, 25))
+    # a writer shutting down moves what it still holds to disk
+    assert buffer.spill_pending() == 10
+    assert len(buffer.rows) == 0 and buffer.spill_rows == 25
+
+    reloaded = RetryBuffer(max_rows=10, overflow='spill', spill_path=path)
+    assert len(reloaded) == 25
+    reloaded.append(rows(25, 3))
+    assert replay(reloaded) == rows(0, 28)
+
+
+def test_reload_truncates_a_torn_row(tmp_path):
+    path = str(tmp_path / 'spill')
+    buffer = RetryBuffer(max_rows=0, overflow='spill', spill_path=path)
+    buffer.append(rows(0, 5))
+    size = os.path.getsize(path)
+    # the last row was being written when the process died
+    os.truncate(path, size - 3)
+    reloaded = RetryBuffer(max_rows=10, overflow='spill', spill_path=path)
+    assert len(reloaded) == 4
+    reloaded.append(rows(5, 20))
+    assert replay(reloaded) == rows(0, 4) + rows(5, 20)
+
+
+def test_spill_max_bytes_drops_the_rest(tmp_path):
+    path = str(tmp_path / 'spill')
+    buffer = RetryBuffer(max_rows=10, overflow='spill', spill_path=path, spill_max_bytes=200)
+    buffer.append(rows(0, 100))
+    assert 0 < buffer.spill_rows < 90
+    assert buffer.spill_rows + buffer.dropped == 90
+    assert os.path.getsize(path) < 200 + 50
+    replayed = replay(buffer)
+    assert replayed[:buffer.spilled] == rows(0, buffer.spilled)
+    assert replayed[buffer.spilled:] == rows(90, 10)
@@ -0,0 +1,171 @@
+"""
+Tests of ring_buffer.SharedRing: records come back in order across many wraparounds, a full ring drops and
+counts updates instead of blocking, a second handle attached to the same block (as a restarted writer
+would) carries on from tail, and drain stops reading the ring while the backend queues are full.
+
+    cd feed && python -m pytest tests/test_ring_buffer.py
+"""
+import asyncio
+import multiprocessing
+import os
+import random
+import time
+import pytest
+from ring_buffer import RingBufferCallback, SharedRing, drain
+from tests.conftest import Sink
+
+
+@pytest.fixture
+def ring():
+    ring = SharedRing(f"statarb-test-{os.getpid()}", capacity=4096)
+    yield ring
+    ring.close()
+    ring.unlink()
+
+
+def test_wraparound_keeps_order(ring):
+    rng = random.Random(3)
+    sent = received = 0
+    # variable sized records, so the end of the buffer is hit at every possible offset
+    while sent < 20000:
+        for _ in range(rng.randint(1, 40)):
+            assert ring.put({'id': sent, 'pad': 'x' * rng.randint(0, 200)})
+            sent += 1
+            if len(ring) > ring.capacity // 2:
+                break
+        for update in ring.get_many(rng.randint(1, 50)):
+            assert update['id'] == received
+            received += 1
+    for update in ring.get_many(sent):
+        assert update['id'] == received
+        received += 1
+    assert received == sent and len(ring) == 0 and ring.dropped == 0
+
+
+def test_full_ring_drops(ring):
+    accepted = 0
+    while ring.put({'id': accepted, 'pad': 'x' * 100}):
+        accepted += 1
+    assert accepted > 10
+    assert not ring.put({'id': accepted})
+    assert ring.dropped == 2
+    # draining part of the ring makes room again
+    assert [u['id'] for u in ring.get_many(5)] == list(range(5))
+    assert ring.put({'id': accepted})
+    ids = [u['id'] for u in ring.get_many(accepted)]
+    assert ids == list(range(5, accepted + 1))
+    assert ring.dropped == 2
+
+
+def test_record_larger_than_the_ring_is_dropped(ring):
+    assert not ring.put(b'x' * ring.capacity)
+    assert ring.dropped == 1
+    assert ring.put({'id': 0})
+    assert ring.get_many() == [{'id': 0}]
+
+
+def test_attached_reader_carries_on_from_tail(ring):
+    for i in range(10):
+        ring.put({'id': i})
+    assert [u['id'] for u in ring.get_many(4)] == [0, 1, 2, 3]
+    reader = SharedRing(ring.name, create=False, lock=ring.lock)
+    try:
+        assert reader.capacity == ring.capacity
+        assert [u['id'] for u in reader.get_many()] == list(range(4, 10))
+        ring.put({'id': 10})
+        assert reader.get_many() == [{'id': 10}]
+        assert len(ring) == 0
+    finally:
+        reader.close()
+
+
+def produce(ring: SharedRing, count: int):
+    sent = 0
+    while sent < count:
+        if ring.put({'id': sent, 'pad': 'x' * (sent % 300)}):
+            sent += 1
+        else:
+            time.sleep(0.0001)
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='the ring and its lock are inherited over fork')
+def test_forked_producer(ring):
+    process = multiprocessing.get_context('fork').Process(target=produce, args=(ring, 20000))
+    process.start()
+    received = 0
+    deadline = time.time() + 30
+    while received < 20000 and time.time() < deadline:
+        for update in ring.get_many(100):
+            assert update == {'id': received, 'pad': 'x' * (received % 300)}
+            received += 1
+    process.join()
+    assert received == 20000
+
+
+def test_peeked_updates_stay_until_commit(ring):
+    for i in range(10):
+        ring.put({'id': i})
+    assert [u['id'] for u in ring.peek(4)] == [0, 1, 2, 3]
+    # a writer dying here leaves them in the ring for the next one
+    assert [u['id'] for u in ring.peek(4)] == [0, 1, 2, 3]
+    ring.commit()
+    assert [u['id'] for u in ring.get_many()] == list(range(4, 10))
+
+
+def test_lock_held_by_a_dead_peer_drops(ring):
+    ring.lock.acquire()
+    try:
+        assert not ring.put({'id': 0})
+        assert ring.peek() == []
+    finally:
+        ring.lock.release()
+    assert ring.dropped == 1
+    assert ring.put({'id': 1})
+    assert ring.get_many() == [{'id': 1}]
+
+
+class QueueSink:
+    """
+    A started BackendQueue backend whose writer task does not keep up.
+    """
+    def __init__(self):
+        self.queue = asyncio.Queue()
+
+    async def write(self, update: dict):
+        await self.queue.put(update)
+
+
+def test_drain_copies_updates_to_every_sink(ring):
+    callback = RingBufferCallback(ring)
+    sinks = [Sink(), Sink()]
+
+    async def run():
+        for i in range(100):
+            await callback.write({'id': i})
+        task = asyncio.create_task(drain(ring, sinks, max_batch=7))
+        while len(sinks[-1].updates) < 100:
+            await asyncio.sleep(0.001)
+        task.cancel()
+    asyncio.run(run())
+    assert sinks[0].updates == sinks[1].updates == [{'id': i} for i in range(100)]
+    assert sinks[0].updates[0] is not sinks[1].updates[0]
+
+
+def test_drain_stops_while_the_queues_are_full(ring):
+    sink = QueueSink()
+
+    async def run():
+        for i in range(100):
+            ring.put({'id': i})
+        task = asyncio.create_task(drain(ring, [sink], max_batch=7, max_pending=20))
+        await asyncio.sleep(0.05)
+        # one batch over the limit at most, the rest is still in the ring
+        assert 20 <= sink.queue.qsize() < 27
+        assert len(ring) > 0
+        # a writer task catching up lets drain carry on
+        ids = []
+        while len(ids) < 100:
+            ids.append((await asyncio.wait_for(sink.queue.get(), 1))['id'])
+        task.cancel()
+        return ids
+    assert asyncio.run(run()) == list(range(100))
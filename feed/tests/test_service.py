@@ -0,0 +1,53 @@
+"""
+Tests of service: fan_out hands every sink but the last its own copy and accepts no sinks, and run_service starts the
+backends, runs the service and stops it.
+
+    cd feed && python -m pytest tests/test_service.py
+"""
+import asyncio
+from service import fan_out, run_service
+from tests.conftest import Sink
+
+
+class Service:
+    def __init__(self, sinks: list):
+        self.sinks = sinks
+        self.running = True
+        self.stopped = False
+
+    async def run(self):
+        await fan_out(self.sinks, {'id': 0})
+
+    async def stop(self):
+        self.stopped = True
+
+
+def test_fan_out():
+    sinks = [Sink(), Sink(), Sink()]
+    update = {'id': 1}
+    asyncio.run(fan_out(sinks, update))
+    assert [s.updates for s in sinks] == [[update]] * 3
+    # the last sink gets the update itself, the others copies
+    assert sinks[-1].updates[0] is update
+    assert sinks[0].updates[0] is not update and sinks[1].updates[0] is not sinks[0].updates[0]
+    asyncio.run(fan_out([], update))
+
+
+def test_run_service(tmp_path):
+    path = tmp_path / 'config.yaml'
+    path.write_text('service_symbols: [BTC-USDT]\n')
+    built = []
+
+    def build(config: dict):
+        assert config['service_symbols'] == ['BTC-USDT']
+        sink = Sink()
+        built.append(Service([sink]))
+        return built[-1], [sink]
+    run_service('test service', build, path=str(path))
+    service, = built
+    sink, = service.sinks
+    assert sink.started is False and sink.updates == [{'id': 0}]
+    assert service.stopped and not service.running
+
+    # nothing to run
+    run_service('test service', lambda config: None, path=str(path))
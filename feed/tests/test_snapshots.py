@@ -0,0 +1,118 @@
+"""
+Tests of snapshots.SnapshotService: a keyframe is written every count updates or every interval seconds, whichever
+comes first, and only for books that changed; load rebuilds the books from the keyframes written before (fakeredis).
+
+    cd feed && python -m pytest tests/test_snapshots.py
+"""
+import asyncio
+import random
+import pytest
+pytest.importorskip('numpy')
+from Custom_Redis import CustomBookSnapshotRedis, CustomBookStream
+from orderbook import OrderBook, load_book
+from snapshots import SnapshotService
+from tests.conftest import Sink
+
+STREAM = 'book-BINANCE-BTC-USDT'
+
+
+class KeyframeSink(Sink):
+    # stands in for CustomBookSnapshotRedis, whose key SnapshotService.load reads the keyframes from
+    key = 'book-snap'
+
+
+def loaded_service(interval: float, count: int):
+    redis, other = KeyframeSink(), Sink()
+    service = SnapshotService([('BINANCE', 'BTC-USDT')], redis, sinks=[other], interval=interval, count=count)
+    book = OrderBook('BINANCE', 'BTC-USDT')
+    book.load({'bid': {100.0: 1.0}, 'ask': {101.0: 2.0}})
+    service.books = {STREAM: book, 'book-BINANCE-ETH-USDT': OrderBook('BINANCE', 'ETH-USDT')}
+    service.last_ids = {STREAM: '5-0', 'book-BINANCE-ETH-USDT': '0-0'}
+    service.pending = {stream: 0 for stream in service.books}
+    service.written = {stream: 1000.0 for stream in service.books}
+    return service, redis, other
+
+
+def test_write_due_cadence():
+    service, redis, other = loaded_service(interval=60.0, count=10)
+
+    async def run():
+        # an unchanged book is never written, however long ago its last snapshot was
+        await service.write_due(2000.0)
+        assert redis.updates == []
+        # changed, but neither count updates nor interval seconds since the last snapshot
+        service.pending[STREAM] = 9
+        await service.write_due(1059.0)
+        assert redis.updates == []
+        # count updates
+        service.pending[STREAM] = 10
+        await service.write_due(1059.0)
+        assert len(redis.updates) == 1
+        assert service.pending[STREAM] == 0 and service.written[STREAM] == 1059.0
+        # interval seconds after the last snapshot, with a single update
+        service.pending[STREAM] = 1
+        await service.write_due(1118.0)
+        assert len(redis.updates) == 1
+        await service.write_due(1119.0)
+        assert len(redis.updates) == 2
+        # a book without a snapshot entry yet is skipped even when due
+        service.pending['book-BINANCE-ETH-USDT'] = 100
+        await service.write_due(1119.0)
+        assert len(redis.updates) == 2 and service.pending['book-BINANCE-ETH-USDT'] == 100
+    asyncio.run(run())
+
+    assert service.snapshots == 2
+    assert redis.updates == other.updates
+    assert redis.updates[0] is not other.updates[0]
+    assert redis.updates[0]['stream_id'] == '5-0'
+    assert redis.updates[0]['book'] == {'bid': {100.0: 1.0}, 'ask': {101.0: 2.0}}
+
+
+def test_load_starts_from_the_written_keyframe():
+    fakeredis = pytest.importorskip('fakeredis')
+    rng = random.Random(5)
+
+    def deltas(count: int):
+        for _ in range(count):
+            side, low = rng.choice((('bid', 50), ('ask', 101)))
+            yield {**update, 'delta': {side: [(float(rng.randint(low, low + 50)), rng.choice([0.0, 1.0, 2.5]))]}}
+
+    update = {'exchange': 'BINANCE', 'symbol': 'BTC-USDT', 'timestamp': 1.0, 'receipt_timestamp': 1.0}
+
+    async def run():
+        conn = fakeredis.aioredis.FakeRedis(decode_responses=True)
+        stream = CustomBookStream(ssl=False)
+        book = {'bid': {100.0 - i: 1.0 for i in range(50)}, 'ask': {101.0 + i: 1.0 for i in range(50)}}
+        await stream.write_batch(conn, [{**update, 'book': book}, *deltas(100)])
+
+        keyframes = CustomBookSnapshotRedis(ssl=False)
+        sink = KeyframeSink()
+        service = SnapshotService([('BINANCE', 'BTC-USDT')], sink, interval=3600.0, count=50, block=10)
+        await service.load(conn)
+        assert service.pending == {STREAM: 0}
+        replayed, replayed_id = await load_book(conn, 'BINANCE', 'BTC-USDT', snap_key=None)
+        assert service.books[STREAM].to_dict() == replayed.to_dict()
+        assert service.last_ids[STREAM] == replayed_id
+
+        # count updates read in one XREAD make one keyframe, as of the last of them
+        await stream.write_batch(conn, list(deltas(60)))
+        task = asyncio.create_task(service.follow(conn))
+        while not sink.updates:
+            await asyncio.sleep(0.01)
+        service.running = False
+        await task
+        assert len(sink.updates) == 1 and service.pending[STREAM] == 0
+        assert sink.updates[0]['stream_id'] == (await conn.xrevrange(STREAM, count=1))[0][0]
+        await keyframes.write_batch(conn, sink.updates)
+
+        await stream.write_batch(conn, list(deltas(20)))
+        replayed, replayed_id = await load_book(conn, 'BINANCE', 'BTC-USDT', snap_key=None)
+
+        # with the stream trimmed past its snapshot entry, only the keyframe can rebuild the book
+        await conn.xtrim(STREAM, minid=sink.updates[0]['stream_id'])
+        restarted = SnapshotService([('BINANCE', 'BTC-USDT')], keyframes)
+        await restarted.load(conn)
+        assert restarted.books[STREAM].to_dict() == replayed.to_dict()
+        assert restarted.last_ids[STREAM] == replayed_id
+        await conn.aclose()
+    asyncio.run(run())
@@ -0,0 +1,128 @@
+"""
+Tests of spill_log.SegmentLog: batches appended across several segments come back in order through peek()
+and commit(), segments are deleted once committed, and a log reopened after a restart replays what was
+not committed yet.
+
+    cd feed && python -m pytest tests/test_spill_log.py
+"""
+import os
+from spill_log import SegmentLog
+
+
+def batches(start: int, count: int, size: int = 10) -> list:
+    return [[{'id': i, 'row': j} for j in range(size)] for i in range(start, start + count)]
+
+
+def replay(log: SegmentLog, max_updates: int = 25) -> list:
+    updates = []
+    while log:
+        peeked = log.peek(max_updates)
+        updates.extend(peeked)
+        log.commit(len(peeked))
+    return updates
+
+
+def segment_files(directory) -> list:
+    return sorted(name for name in os.listdir(directory) if name.endswith('.seg'))
+
+
+def test_append_peek_commit_across_segments(tmp_path):
+    log = SegmentLog(str(tmp_path), segment_bytes=4096)
+    for batch in batches(0, 100):
+        log.append(batch)
+    assert log.pending == 100
+    assert len(segment_files(tmp_path)) > 3
+    assert log.peek(25) == log.peek(25)
+    updates = replay(log)
+    assert updates == [update for batch in batches(0, 100) for update in batch]
+    assert log.pending == 0 and not log
+    assert segment_files(tmp_path) == []
+    assert log.stats.rows == 1000 and log.stats.batches == 100
+    log.close()
+
+
+def test_peek_stops_at_the_end_of_the_head_segment(tmp_path):
+    log = SegmentLog(str(tmp_path), segment_bytes=4096)
+    for batch in batches(0, 100):
+        log.append(batch)
+    head = log.segments[0].records
+    assert len(log.peek(100000)) == head * 10
+    log.commit(head * 10)
+    assert len(log.segments) == len(segment_files(tmp_path))
+    assert log.peek(10)[0]['id'] == head
+    log.close()
+
+
+def test_interleaved_append_and_commit(tmp_path):
+    log = SegmentLog(str(tmp_path), segment_bytes=4096)
+    updates = []
+    for i in range(0, 200, 20):
+        for batch in batches(i, 20):
+            log.append(batch)
+        # replay about half of what is pending
+        for _ in range(3):
+            peeked = log.peek(40)
+            updates.extend(peeked)
+            log.commit(len(peeked))
+    updates.extend(replay(log))
+    assert updates == [update for batch in batches(0, 200) for update in batch]
+    log.close()
+
+
+def test_restart_replays_uncommitted_batches(tmp_path):
+    log = SegmentLog(str(tmp_path), segment_bytes=4096)
+    for batch in batches(0, 100):
+        log.append(batch)
+    # commit the whole head segment and part of the next one, then stop without closing cleanly
+    head = log.segments[0].records
+    log.commit(len(log.peek(100000)))
+    log.commit(len(log.peek(20)))
+    sequence = log.sequence
+    log.close()
+
+    reopened = SegmentLog(str(tmp_path), segment_bytes=4096)
+    # the partly committed segment is replayed from its start, so its committed batches come again
+    assert reopened.pending == 100 - head
+    assert reopened.sequence == sequence
+    for batch in batches(100, 10):
+        reopened.append(batch)
+    updates = replay(reopened)
+    assert updates == [update for batch in batches(head, 110 - head) for update in batch]
+    reopened.close()
+
+
+def test_restart_ignores_preallocated_space(tmp_path):
+    log = SegmentLog(str(tmp_path), segment_bytes=1 << 20)
+    for batch in batches(0, 3):
+        log.append(batch)
+    log.close()
+    reopened = SegmentLog(str(tmp_path), segment_bytes=1 << 20)
+    assert reopened.pending == 3
+    assert replay(reopened) == [update for batch in batches(0, 3) for update in batch]
+    reopened.close()
+
+
+def test_full_log_drops_the_oldest_segment(tmp_path):
+    log = SegmentLog(str(tmp_path), segment_bytes=4096, max_bytes=3 * 4096)
+    for batch in batches(0, 100):
+        log.append(batch)
+    assert len(segment_files(tmp_path)) == 3
+    assert log.disk_bytes <= 3 * 4096
+    assert log.dropped + log.pending == 100
+    updates = replay(log)
+    assert updates == [update for batch in batches(log.dropped, 100 - log.dropped) for update in batch]
+    log.close()
+
+
+def test_segment_dropped_while_replaying(tmp_path):
+    log = SegmentLog(str(tmp_path), segment_bytes=4096, max_bytes=2 * 4096)
+    for batch in batches(0, 10):
+        log.append(batch)
+    peeked = log.peek(10)
+    # the head segment makes room for new batches while peeked is being written
+    for batch in batches(10, 100):
+        log.append(batch)
+    log.commit(len(peeked))
+    assert log.dropped + log.pending == 110
+    assert replay(log)[-1] == {'id': 109, 'row': 9}
+    log.close()
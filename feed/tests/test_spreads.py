@@ -0,0 +1,71 @@
+"""
+Tests of spreads: the sliding-window statistics of SpreadStats against numpy over a window that has wrapped several
+times, its EWMA against a direct exponentially weighted average, and SpreadEngine on mid price changes.
+
+    cd feed && python -m pytest tests/test_spreads.py
+"""
+import math
+import pytest
+np = pytest.importorskip('numpy')
+from spreads import PairEngine, SpreadEngine, SpreadStats
+
+
+def test_window_statistics_match_numpy():
+    rng = np.random.default_rng(0)
+    window = 50
+    # a level far from zero makes the cancellation in the sliding update visible
+    values = 100.0 + np.cumsum(rng.normal(0, 0.01, 7 * window + 13))
+    stats = SpreadStats(window=window)
+    for i, value in enumerate(values):
+        previous = values[max(0, i - window):i]
+        result = stats.update(float(value), float(i))
+        current = values[max(0, i + 1 - window):i + 1]
+        assert result['window_mean'] == pytest.approx(np.mean(current), rel=1e-12)
+        if len(current) > 1:
+            assert result['window_std'] == pytest.approx(np.std(current, ddof=1), rel=1e-7)
+        else:
+            assert result['window_std'] is None
+        if len(previous) == window:
+            # z-score against the window before the new value
+            assert result['window_zscore'] == pytest.approx((value - np.mean(previous)) / np.std(previous, ddof=1), rel=1e-6)
+        else:
+            assert result['window_zscore'] is None
+
+
+def test_ewma_halflife():
+    halflife = 10.0
+    stats = SpreadStats(halflife=halflife, window=10)
+    times = [0.0, 1.0, 5.0, 5.0, 30.0, 31.5]
+    values = [1.0, 2.0, 0.5, 3.0, -1.0, 0.0]
+    mean = None
+    for t, value in zip(times, values):
+        result = stats.update(value, t)
+        if mean is None:
+            mean = value
+        else:
+            alpha = 1.0 - 0.5 ** ((t - last) / halflife)
+            mean = (1.0 - alpha) * mean + alpha * value
+        last = t
+        assert result['mean'] == pytest.approx(mean, rel=1e-12)
+    assert result['std'] > 0
+
+
+def test_pair_engine_is_abstract():
+    with pytest.raises(TypeError):
+        PairEngine([], [], reader=None)
+
+
+def test_spread_engine_publishes_log_spreads():
+    engine = SpreadEngine([('BINANCE', 'BTC-USDT', 'BITFINEX', 'BTC-USDT')], [], reader=None, publish_interval=10.0)
+    assert engine.observe('book-BINANCE-BTC-USDT', 30000.0, 100.0) == []
+    updates = engine.observe('book-BITFINEX-BTC-USDT', 30030.0, 101.0)
+    assert len(updates) == 1
+    assert updates[0]['symbol'] == 'BINANCE:BTC-USDT/BITFINEX:BTC-USDT'
+    assert updates[0]['spread'] == pytest.approx(math.log(30000.0 / 30030.0))
+    # folded into the statistics, not published within publish_interval
+    assert engine.observe('book-BINANCE-BTC-USDT', 30010.0, 102.0) == []
+    assert engine.stats[0].count == 2
+    # an unchanged mid price is not an observation
+    assert engine.observe('book-BINANCE-BTC-USDT', 30010.0, 120.0) == []
+    assert engine.stats[0].count == 2
+    assert len(engine.observe('book-BINANCE-BTC-USDT', 30020.0, 120.0)) == 1
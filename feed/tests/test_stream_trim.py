@@ -0,0 +1,35 @@
+"""
+Tests of the MINID trimming of CustomRedisStreamCallback against fakeredis: the cutoff follows the entry IDs
+Redis generates, so a client clock running ahead of the server does not trim the entries just written.
+
+    cd feed && python -m pytest tests/test_stream_trim.py
+"""
+import asyncio
+import time
+import pytest
+from Custom_Redis import CustomBookStream
+
+
+def test_minid_follows_the_server_clock():
+    fakeredis = pytest.importorskip('fakeredis')
+
+    async def run():
+        conn = fakeredis.aioredis.FakeRedis(decode_responses=True)
+        stream = CustomBookStream(ssl=False, minid_window=60, approximate=False)
+        key = 'book-BINANCE-BTC-USDT'
+        await conn.xadd(key, {'id': 'old'}, id=f"{int(time.time() * 1000) - 3600 * 1000}-0")
+        # receipt timestamps an hour ahead of the server
+        ahead = time.time() + 3600
+        update = {'exchange': 'BINANCE', 'symbol': 'BTC-USDT', 'timestamp': ahead, 'receipt_timestamp': ahead}
+        for i in range(3):
+            await stream.write_batch(conn, [{**update, 'id': i, 'delta': {'bid': [(100.0, float(i))], 'ask': []}}])
+        entries = await conn.xrange(key)
+        assert [fields['id'] for _, fields in entries] == ['0', '1', '2']
+        assert stream.latest_ms[key] == int(entries[-1][0].split('-')[0])
+        await conn.aclose()
+    asyncio.run(run())
+
+
+def test_maxlen_takes_precedence():
+    stream = CustomBookStream(ssl=False, maxlen=100, minid_window=60)
+    assert stream.trim_args('book-BINANCE-BTC-USDT') == {'maxlen': 100, 'approximate': True}
@@ -46,6 +46,13 @@ declare -A book_config
 declare -A oi_config
 declare -A funding_config
 declare -A liquidations_config
+declare -A book_levels_config
+declare -A book_snapshots_config
+declare -A nbbo_config
+declare -A spreads_config
+declare -A hedge_ratios_config
+declare -A basis_config
+declare -A bars_config
 
 # Configuration for 'trades' table
 trades_config[name]="trades"
@@ -137,8 +144,158 @@ liquidations_config[orderby_column]="timestamp, id"
 liquidations_config[compress_interval]="10 minutes"
 liquidations_config[retention_interval]="7 days"  # Only for production
 
+# Configuration for 'book_levels' table (BookLevelsTimeScale in feed/custom_timescaledb.py)
+book_levels_config[name]="book_levels"
+book_levels_config[create_command]="CREATE TABLE book_levels (
+    exchange TEXT,
+    symbol TEXT,
+    timestamp TIMESTAMPTZ,
+    receipt TIMESTAMPTZ,
+    update_type TEXT,
+    side TEXT,
+    price DOUBLE PRECISION[],
+    size DOUBLE PRECISION[],
+    order_id TEXT[],
+    PRIMARY KEY (exchange, symbol, receipt, update_type, side)
+);"
+book_levels_config[time_column]="receipt"
+book_levels_config[chunk_interval]="10 minutes"
+book_levels_config[segmentby_column]="exchange, symbol, side"
+book_levels_config[orderby_column]="receipt, update_type"
+book_levels_config[compress_interval]="10 minutes"
+book_levels_config[retention_interval]="7 days"  # Only for production
+
+# Configuration for 'book_snapshots' table (BookSnapshotTimeScale, written by feed/snapshots.py); kept as long as 'book', whose deltas replay on top of it
+book_snapshots_config[name]="book_snapshots"
+book_snapshots_config[create_command]="CREATE TABLE book_snapshots (
+    exchange TEXT,
+    symbol TEXT,
+    timestamp TIMESTAMPTZ,
+    receipt TIMESTAMPTZ,
+    stream_id TEXT,
+    data JSONB,
+    PRIMARY KEY (exchange, symbol, receipt)
+);"
+book_snapshots_config[time_column]="receipt"
+book_snapshots_config[chunk_interval]="1 hour"
+book_snapshots_config[segmentby_column]="exchange, symbol"
+book_snapshots_config[orderby_column]="receipt"
+book_snapshots_config[compress_interval]="1 hour"
+book_snapshots_config[retention_interval]="7 days"  # Only for production
+
+# Configuration for 'nbbo' table (NBBOTimeScale in feed/custom_timescaledb.py)
+nbbo_config[name]="nbbo"
+nbbo_config[create_command]="CREATE TABLE nbbo (
+    symbol TEXT,
+    timestamp TIMESTAMPTZ,
+    receipt TIMESTAMPTZ,
+    bid DOUBLE PRECISION,
+    bid_size DOUBLE PRECISION,
+    bid_exchange TEXT,
+    ask DOUBLE PRECISION,
+    ask_size DOUBLE PRECISION,
+    ask_exchange TEXT,
+    spreads JSONB,
+    PRIMARY KEY (symbol, receipt)
+);"
+nbbo_config[time_column]="receipt"
+nbbo_config[chunk_interval]="1 hour"
+nbbo_config[segmentby_column]="symbol"
+nbbo_config[orderby_column]="receipt"
+nbbo_config[compress_interval]="1 hour"
+nbbo_config[retention_interval]="7 days"  # Only for production
+
+# Configuration for 'spreads' table (SpreadTimeScale in feed/custom_timescaledb.py)
+spreads_config[name]="spreads"
+spreads_config[create_command]="CREATE TABLE spreads (
+    pair TEXT,
+    receipt TIMESTAMPTZ,
+    spread DOUBLE PRECISION,
+    mean DOUBLE PRECISION,
+    std DOUBLE PRECISION,
+    zscore DOUBLE PRECISION,
+    window_mean DOUBLE PRECISION,
+    window_std DOUBLE PRECISION,
+    window_zscore DOUBLE PRECISION,
+    PRIMARY KEY (pair, receipt)
+);"
+spreads_config[time_column]="receipt"
+spreads_config[chunk_interval]="1 hour"
+spreads_config[segmentby_column]="pair"
+spreads_config[orderby_column]="receipt"
+spreads_config[compress_interval]="1 hour"
+spreads_config[retention_interval]="30 days"  # Only for production
+
+# Configuration for 'hedge_ratios' table (HedgeTimeScale in feed/custom_timescaledb.py)
+hedge_ratios_config[name]="hedge_ratios"
+hedge_ratios_config[create_command]="CREATE TABLE hedge_ratios (
+    pair TEXT,
+    receipt TIMESTAMPTZ,
+    alpha DOUBLE PRECISION,
+    beta DOUBLE PRECISION,
+    residual DOUBLE PRECISION,
+    innovation DOUBLE PRECISION,
+    adf DOUBLE PRECISION,
+    PRIMARY KEY (pair, receipt)
+);"
+hedge_ratios_config[time_column]="receipt"
+hedge_ratios_config[chunk_interval]="1 hour"
+hedge_ratios_config[segmentby_column]="pair"
+hedge_ratios_config[orderby_column]="receipt"
+hedge_ratios_config[compress_interval]="1 hour"
+hedge_ratios_config[retention_interval]="30 days"  # Only for production
+
+# Configuration for 'basis' table (BasisTimeScale in feed/custom_timescaledb.py)
+basis_config[name]="basis"
+basis_config[create_command]="CREATE TABLE basis (
+    symbol TEXT,
+    receipt TIMESTAMPTZ,
+    spot DOUBLE PRECISION,
+    perp DOUBLE PRECISION,
+    basis DOUBLE PRECISION,
+    annualized_basis DOUBLE PRECISION,
+    funding_rate DOUBLE PRECISION,
+    annualized_funding DOUBLE PRECISION,
+    next_funding_time TIMESTAMPTZ,
+    carry DOUBLE PRECISION,
+    PRIMARY KEY (symbol, receipt)
+);"
+basis_config[time_column]="receipt"
+basis_config[chunk_interval]="1 hour"
+basis_config[segmentby_column]="symbol"
+basis_config[orderby_column]="receipt"
+basis_config[compress_interval]="1 hour"
+basis_config[retention_interval]="30 days"  # Only for production
+
+# Configuration for 'bars' table (BarsTimeScale in feed/custom_timescaledb.py)
+bars_config[name]="bars"
+bars_config[create_command]="CREATE TABLE bars (
+    exchange TEXT,
+    symbol TEXT,
+    bar TEXT,
+    timestamp TIMESTAMPTZ,
+    end_time TIMESTAMPTZ,
+    receipt TIMESTAMPTZ,
+    open DOUBLE PRECISION,
+    high DOUBLE PRECISION,
+    low DOUBLE PRECISION,
+    close DOUBLE PRECISION,
+    volume DOUBLE PRECISION,
+    notional DOUBLE PRECISION,
+    vwap DOUBLE PRECISION,
+    buy_volume DOUBLE PRECISION,
+    trades INTEGER,
+    PRIMARY KEY (exchange, symbol, bar, timestamp)
+);"
+bars_config[time_column]="timestamp"
+bars_config[chunk_interval]="1 day"
+bars_config[segmentby_column]="exchange, symbol, bar"
+bars_config[orderby_column]="timestamp"
+bars_config[compress_interval]="1 day"
+bars_config[retention_interval]="365 days"  # Only for production
+
 # Add new table configurations to the array
-table_configs=(trades_config book_config oi_config funding_config liquidations_config)
+table_configs=(trades_config book_config oi_config funding_config liquidations_config book_levels_config book_snapshots_config nbbo_config spreads_config hedge_ratios_config basis_config bars_config)
 
 # Function to create hypertable
 create_hypertable() {